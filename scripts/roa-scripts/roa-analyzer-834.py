@@ -3,135 +3,240 @@
 import argparse
 import pandas as pd
 import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from roa_dataset import read_roas, list_snapshot_dates, dataset_schema, iter_snapshots, target_flag_column
+from roa_events import classify_events, EventLogWriter, save_analyzer_state, load_analyzer_state, count_rows, truncate_rows
 
 # SUMMARY_CSV = '/Users/rakshita/Desktop/gatech/fall25/8903/code/output/final1/ipxo_roa_event_summary_834.csv'
 # DETAIL_CSV = '/Users/rakshita/Desktop/gatech/fall25/8903/code/output/final1/ipxo_roa_event_details_834.csv'
 
 IPXO_ASN = 'AS834'
 IPXO_REPO_URI = 'r.magellan.ipxo.com'
+# Only these columns are needed per day; the rest of the ROA is never looked at.
+DAY_COLUMNS = ['prefix', 'asn']
 
-def main(input_file, summary_file, event_file):
-    print("\n*************************************************************************************")
-    print("\n-------------------------- RPKI ROA IPXO ANALYSIS - ASN 834 -------------------------")
-    print("\n*************************************************************************************")
+def load_target_prefixes(input_file):
+    # With an ingest-time is_as834 column (roa-csv-parser.py --target_asns AS834), the AS834 prefixes of every day
+    # come from one read with the flag pushed down into Parquet. Returns None if the input has no such column.
+    flag = target_flag_column(IPXO_ASN)
+    if flag not in dataset_schema(input_file).names:
+        return None
+    targets = read_roas(input_file, columns=['snapshot_date', 'prefix'], filters=[(flag, '=', True)])
+    targets['snapshot_date'] = pd.to_datetime(targets['snapshot_date']).dt.date
+    return {day: set(prefixes) for day, prefixes in targets.groupby('snapshot_date')['prefix']}
 
-    try:
-        print("Fetching date range.")
-        all_dates = pd.read_parquet(input_file, columns=['snapshot_date'])['snapshot_date'].drop_duplicates()
-        sorted_dates = sorted(pd.to_datetime(all_dates).dt.date)
-        print(f" * Found {len(sorted_dates)} snapshot days to process.")
-    except Exception as e:
-        print(f"!!ERROR: Could not read the input file '{input_file}' to get dates.")
-        print(e)
-        return
+def day_targets(day_roas, day, target_prefixes):
+    if target_prefixes is not None:
+        return target_prefixes.get(day, set())
+    return set(day_roas[day_roas['asn'] == IPXO_ASN]['prefix'])
 
+def date_segments(dates, count):
+    # Splits the day pairs of dates into at most count contiguous runs; each segment repeats the last day of the
+    # one before it as its first (previous) day.
+    pairs = len(dates) - 1
+    count = min(count, pairs)
+    bounds = [round(pairs * k / count) for k in range(count + 1)]
+    return [dates[bounds[k]:bounds[k + 1] + 1] for k in range(count)]
+
+def segment_targets(target_prefixes, dates):
+    if target_prefixes is None:
+        return None
+    return {day: target_prefixes[day] for day in dates if day in target_prefixes}
+
+def analyze_days(input_file, dates, target_prefixes, event_log=None, prev_date_roas=None):
+    # Events of every day of dates against the day before it (the first day only serves as the previous day).
+    # prev_date_roas, if given, are the ROAs of the first day (e.g. from a saved state) and that day is not read.
+    # Each day's events go straight to event_log if given, else they are collected and returned.
+    # Returns (daily counts, per-day event frames, prefixes ever associated with AS834, prefixes that churned,
+    # (last day analyzed, its ROAs)), or None if the first day cannot be loaded.
     daily_count = []
     detailed_log = []
+    churned_prefixes = set()
 
     try:
-        print(f" * Loading initial data for {sorted_dates[0]}")
-        prev_date = sorted_dates[0]
-        prev_date_roas = pd.read_parquet(input_file, filters=[('snapshot_date', '=', prev_date)])
-        prev_asns_map = prev_date_roas.groupby('prefix')['asn'].apply(set)
+        print(f" * Loading initial data for {dates[0]}")
+        prev_date = dates[0]
+        # One pass over the input, day by day; the next day is read while the current pair is compared.
+        if prev_date_roas is None:
+            snapshots = iter_snapshots(input_file, columns=DAY_COLUMNS, dates=dates)
+            prev_date_roas = next(snapshots)[1].result()
+            prev_targets = day_targets(prev_date_roas, prev_date, target_prefixes)
+        else:
+            snapshots = iter_snapshots(input_file, columns=DAY_COLUMNS, dates=dates[1:])
+            prev_targets = day_targets(prev_date_roas, prev_date, None)
 
-        all_ipxo_prefixes = set(prev_date_roas[prev_date_roas['asn'] == IPXO_ASN]['prefix'])
+        all_ipxo_prefixes = set(prev_targets)
     except Exception as e:
-        print(f"!!ERROR: Could not load initial data for {sorted_dates[0]}. {e}")
-        return
+        print(f"!!ERROR: Could not load initial data for {dates[0]}. {e}")
+        return None
     
-    for i in range(1, len(sorted_dates)):
-        current_date = sorted_dates[i]
-        print(f" ** For {sorted_dates[i]} ")
+    for current_date, pending in snapshots:
+        print(f" ** For {current_date} ")
         
         try:
-            curr_date_roas = pd.read_parquet(input_file, filters=[('snapshot_date', '=', current_date)])
+            curr_date_roas = pending.result()
         except Exception as e:
             print(f"!!ERROR: Could not load data for {current_date}. Skipping day. {e}")
             continue
 
-        curr_asns_map = curr_date_roas.groupby('prefix')['asn'].apply(set)
-        all_ipxo_prefixes.update(set(curr_date_roas[curr_date_roas['asn'] == IPXO_ASN]['prefix']))
-        all_prefixes = set(prev_asns_map.index).union(set(curr_asns_map.index))
-        
-        creations, deletions, updates_to_ipxo, updates_from_ipxo = set(), set(), set(), set()
-
-
-        for prefix in all_prefixes:
-            # print(prefix)
-            prev_date_asns = prev_asns_map.get(prefix, set())
-            curr_date_asns = curr_asns_map.get(prefix, set())
-
-            # CREATION: prefix newly appeared with AS834 (none before)
-            if IPXO_ASN in curr_date_asns and len(prev_date_asns) == 0:
-                creations.add(prefix)
-                detailed_log.append({
-                    'date': current_date,
-                    'prefix': prefix,
-                    'event': 'creation',
-                    'prev_date_asns': list(prev_date_asns),
-                    'curr_date_asns': list(curr_date_asns)
-                })
-
-            # DELETION: prefix had AS834, now disappeared
-            elif IPXO_ASN in prev_date_asns and len(curr_date_asns) == 0:
-                deletions.add(prefix)
-                detailed_log.append({
-                    'date': current_date,
-                    'prefix': prefix,
-                    'event': 'deletion',
-                    'prev_date_asns': list(prev_date_asns),
-                    'curr_date_asns': list(curr_date_asns)
-                })
-
-            else:
-                # UPDATE TO IPXO: switched from another ASN to AS834
-                if IPXO_ASN in curr_date_asns and IPXO_ASN not in prev_date_asns and len(prev_date_asns) > 0:
-                    updates_to_ipxo.add(prefix)
-                    detailed_log.append({
-                        'date': current_date,
-                        'prefix': prefix,
-                        'event': 'update_to_AS834',
-                        'prev_date_asns': list(prev_date_asns),
-                        'curr_date_asns': list(curr_date_asns)
-                    })
-
-                # UPDATE FROM IPXO: switched from AS834 to another ASN
-                if IPXO_ASN in prev_date_asns and IPXO_ASN not in curr_date_asns and len(curr_date_asns) > 0:
-                    updates_from_ipxo.add(prefix)
-                    detailed_log.append({
-                        'date': current_date,
-                        'prefix': prefix,
-                        'event': 'update_from_AS834',
-                        'prev_date_asns': list(prev_date_asns),
-                        'curr_date_asns': list(curr_date_asns)
-                    })
+        curr_targets = day_targets(curr_date_roas, current_date, target_prefixes)
+        all_ipxo_prefixes.update(curr_targets)
+
+        events = classify_events(prev_date_roas, curr_date_roas, prev_targets, curr_targets, 'asn')
+        events.insert(0, 'date', current_date)
+        churned_prefixes.update(events['prefix'])
+        if event_log is not None:
+            event_log.write(events)
+        else:
+            detailed_log.append(events)
+        counts = events['event'].value_counts()
+        creations, deletions = counts.get('creation', 0), counts.get('deletion', 0)
+        updates_to_ipxo, updates_from_ipxo = counts.get('update_to_AS834', 0), counts.get('update_from_AS834', 0)
 
         daily_count.append({
             'date': current_date,
-            'creations': len(creations),
-            'deletions': len(deletions),
-            'updates_to_AS834': len(updates_to_ipxo),
-            'updates_from_AS834': len(updates_from_ipxo)
+            'creations': creations,
+            'deletions': deletions,
+            'updates_to_AS834': updates_to_ipxo,
+            'updates_from_AS834': updates_from_ipxo
         })
 
-        print(f" *** +{len(creations)}, -{len(deletions)}, to->{len(updates_to_ipxo)}, from<-{len(updates_from_ipxo)}")
-        prev_asns_map = curr_asns_map
+        print(f" *** +{creations}, -{deletions}, to->{updates_to_ipxo}, from<-{updates_from_ipxo}")
+        prev_date, prev_date_roas, prev_targets = current_date, curr_date_roas, curr_targets
 
-    summary_df = pd.DataFrame(daily_count)
-    details_df = pd.DataFrame(detailed_log)
+    return daily_count, detailed_log, all_ipxo_prefixes, churned_prefixes, (prev_date, prev_date_roas)
+
+def analyze_segment(input_file, dates, target_prefixes, prev_date_roas, part_file, last):
+    # Runs in a worker process: analyze_days() over one segment, with its events written to part_file (in the format
+    # of the final event log) instead of being sent back. Only the last segment returns its last day's ROAs.
+    part_log = EventLogWriter(part_file)
+    result = analyze_days(input_file, dates, target_prefixes, part_log, prev_date_roas)
+    part_log.close()
+    if result is None or last:
+        return result
+    return result[:4] + ((result[4][0], None),)
+
+def main(input_file, summary_file, event_file, workers=1, state_dir=None):
+    print("\n*************************************************************************************")
+    print("\n-------------------------- RPKI ROA IPXO ANALYSIS - ASN 834 -------------------------")
+    print("\n*************************************************************************************")
+
+    try:
+        print("Fetching date range.")
+        sorted_dates = list_snapshot_dates(input_file)
+        print(f" * Found {len(sorted_dates)} snapshot days to process.")
+    except Exception as e:
+        print(f"!!ERROR: Could not read the input file '{input_file}' to get dates.")
+        print(e)
+        return
+
+    try:
+        target_prefixes = load_target_prefixes(input_file)
+        if target_prefixes is not None:
+            print(f" * Using the ingest-time {target_flag_column(IPXO_ASN)} column.")
+    except Exception as e:
+        print(f"!!ERROR: Could not read the {target_flag_column(IPXO_ASN)} column of '{input_file}'. {e}")
+        return
+
+    # With a saved state, only the days after its last day are analyzed, against the ROAs it kept of that day.
+    state = None
+    if state_dir is not None:
+        try:
+            state = load_analyzer_state(state_dir)
+        except Exception as e:
+            print(f"!!ERROR: Could not read the analyzer state in '{state_dir}'. {e}")
+            return
+    if state is not None:
+        new_dates = [day for day in sorted_dates if day > state['last_date']]
+        print(f" * Resuming after {state['last_date']}: {len(new_dates)} new snapshot days.")
+        if not new_dates:
+            print("Nothing to do.")
+            return
+        sorted_dates = [state['last_date']] + new_dates
+        initial_roas = state['last_roas']
+    else:
+        initial_roas = None
+
+    # Rows of the output files this run appends to. Rows past the saved state's counts were written by a run that
+    # died before saving its state; they are cut off, as their days are analyzed again.
+    output_rows = {'summary': 0, 'events': 0}
+    if state is not None:
+        for name, path in (('summary', summary_file), ('events', event_file)):
+            output_rows[name] = count_rows(path)
+            saved = state['output_rows'].get(name)
+            if saved is not None and output_rows[name] > saved:
+                print(f"!WARNING: Dropping {output_rows[name] - saved} rows of '{path}' written after the saved state.")
+                truncate_rows(path, saved)
+                output_rows[name] = saved
+
+    # Events are written as they are found: Parquet (typed list columns) for a .parquet path, CSV otherwise.
+    event_log = EventLogWriter(event_file, append=state is not None)
+    # If any part of the analysis fails, the events this run wrote are discarded, so the log is left as it was.
+    completed = False
+    try:
+        if workers > 1 and len(sorted_dates) > 2:
+            # Day N only needs days N-1 and N: split the days into segments overlapping by one day, analyze them in
+            # worker processes and put the results back together in date order. Each worker writes its events to a
+            # part file next to the event log, streamed into it in segment order, so no segment's events are held in
+            # memory.
+            segments = date_segments(sorted_dates, workers)
+            print(f" * Analyzing {len(segments)} segments on {workers} worker processes.")
+            if os.path.dirname(event_file):
+                os.makedirs(os.path.dirname(event_file), exist_ok=True)
+            parts_dir = tempfile.mkdtemp(prefix='segments-', dir=os.path.dirname(event_file) or None)
+            extension = os.path.splitext(event_file)[1]
+            try:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    futures = [executor.submit(analyze_segment, input_file, segment, segment_targets(target_prefixes, segment),
+                                               initial_roas if k == 0 else None,
+                                               os.path.join(parts_dir, f"segment-{k}{extension}"), k == len(segments) - 1)
+                               for k, segment in enumerate(segments)]
+                    results = []
+                    for k, future in enumerate(futures):
+                        result = future.result()
+                        if result is not None:
+                            event_log.write_log(os.path.join(parts_dir, f"segment-{k}{extension}"))
+                        results.append(result)
+            finally:
+                shutil.rmtree(parts_dir, ignore_errors=True)
+        else:
+            results = [analyze_days(input_file, sorted_dates, target_prefixes, event_log, initial_roas)]
+        completed = all(result is not None for result in results)
+    finally:
+        if not completed:
+            event_log.abort()
+    if not completed:
+        print(f"!!ERROR: The analysis did not complete; the events it wrote to '{event_file}' were discarded.")
+        return
+
+    daily_count = [day for result in results for day in result[0]]
+    all_ipxo_prefixes = set().union(*(result[2] for result in results))
+    churned_prefixes = set().union(*(result[3] for result in results))
+    if state is not None:
+        all_ipxo_prefixes |= state['prefix_sets']['ever_ipxo']
+        churned_prefixes |= state['prefix_sets']['churned']
 
+    summary_df = pd.DataFrame(daily_count)
     output_dir = os.path.dirname(summary_file)
     os.makedirs(output_dir, exist_ok=True)
-    summary_df.to_csv(summary_file, index=False)
-    output_dir = os.path.dirname(event_file)
-    os.makedirs(output_dir, exist_ok=True)
-    details_df.to_csv(event_file, index=False)
+    if state is not None and os.path.exists(summary_file):
+        summary_df.to_csv(summary_file, mode='a', header=False, index=False)
+    else:
+        summary_df.to_csv(summary_file, index=False)
+    event_log.close()
+
+    if state_dir is not None:
+        last_date, last_roas = results[-1][4]
+        output_rows = {'summary': output_rows['summary'] + len(summary_df), 'events': output_rows['events'] + event_log.rows}
+        save_analyzer_state(state_dir, last_date, last_roas, {'ever_ipxo': all_ipxo_prefixes, 'churned': churned_prefixes}, output_rows)
+        print(f"\nSaved the analyzer state (through {last_date}) to {state_dir}")
 
     print(f"\nSaved summary (event count) to {summary_file}")
     print(f"Saved detailed events to {event_file}")
 
     print("\nFinding 'permanent' prefixes (associated with AS834 but never churned)")
-    churned_prefixes = set(details_df['prefix'])
     print(f" * Found {len(churned_prefixes)} total prefixes that churned.")
     print(f" * Found {len(all_ipxo_prefixes)} total prefixes ever associated with AS834.")
     permanent_prefixes = all_ipxo_prefixes - churned_prefixes
@@ -160,9 +265,23 @@ if __name__ == "__main__":
         '--detail_output_file_path', 
         type=str, 
         default=None,
-        help="The file path of the detailed file to be saved."
+        help="The file path of the detailed file to be saved: typed Parquet if it ends in .parquet, CSV otherwise."
+    )
+
+    parser.add_argument(
+        '--workers', 
+        type=int, 
+        default=1,
+        help="Number of worker processes; with more than one, the date range is split into segments analyzed in parallel."
+    )
+
+    parser.add_argument(
+        '--state_dir', 
+        type=str, 
+        default=None,
+        help="Directory keeping the analyzer state between runs. If it holds a state, only the days after it are analyzed and their summary rows and events are appended to the existing output files."
     )
 
     args = parser.parse_args()
-    main(args.file, args.summary_output_file_path, args.detail_output_file_path)
+    main(args.file, args.summary_output_file_path, args.detail_output_file_path, args.workers, args.state_dir)
 
@@ -3,19 +3,34 @@
 import argparse
 import pandas as pd
 import os
+from roa_dataset import read_roas, list_snapshot_dates, dataset_schema, iter_snapshots
 
 SUMMARY_CSV = '/Users/rakshita/Desktop/gatech/fall25/8903/code/output/final/ipxo_roa_event_summary_uri.csv'
 DETAIL_CSV = '/Users/rakshita/Desktop/gatech/fall25/8903/code/output/final/ipxo_roa_event_details_uri.csv'
 
 IPXO_REPO_URI = 'rsync://r.magellan.ipxo.com'
-
-def is_in_ipxo_repo(uri_set):
-    if not uri_set:
-        return False
-    for uri in uri_set:
-        if isinstance(uri, str) and uri.startswith(IPXO_REPO_URI):
-            return True
-    return False
+IPXO_REPO_HOST = 'r.magellan.ipxo.com'
+# Only these columns are needed per day; the rest of the ROA is never looked at.
+DAY_COLUMNS = ['prefix', 'uri']
+
+def load_target_prefixes(input_file):
+    # With an ingest-time repo_host column (roa-csv-parser.py --derived_columns repo_host), the Magellan prefixes of
+    # every day come from one read with the host pushed down into Parquet. Returns None if the input has no such column.
+    if 'repo_host' not in dataset_schema(input_file).names:
+        return None
+    targets = read_roas(input_file, columns=['snapshot_date', 'prefix'], filters=[('repo_host', '=', IPXO_REPO_HOST)])
+    targets['snapshot_date'] = pd.to_datetime(targets['snapshot_date']).dt.date
+    return {day: set(prefixes) for day, prefixes in targets.groupby('snapshot_date')['prefix']}
+
+def day_targets(day_roas, day, target_prefixes):
+    if target_prefixes is not None:
+        return target_prefixes.get(day, set())
+    return set(day_roas[day_roas['uri'].str.startswith(IPXO_REPO_URI, na=False)]['prefix'])
+
+def uri_sets(day_roas, prefixes):
+    # URI set per prefix, only for the prefixes that can have an event.
+    day_roas = day_roas[day_roas['prefix'].isin(prefixes)]
+    return day_roas.groupby('prefix', observed=True)['uri'].apply(set)
 
 def main(input_file):
     print("\n*************************************************************************************")
@@ -24,8 +39,7 @@ def main(input_file):
     
     try:
         print("Fetching date range...")
-        all_dates = pd.read_parquet(input_file, columns=['snapshot_date'])['snapshot_date'].drop_duplicates()
-        sorted_dates = sorted(pd.to_datetime(all_dates).dt.date)
+        sorted_dates = list_snapshot_dates(input_file)
         print(f" * Found {len(sorted_dates)} snapshot days to process.")
     except Exception as e:
         print(f"!!ERROR: Could not read the input file '{input_file}' to get dates.")
@@ -38,27 +52,34 @@ def main(input_file):
     try:
         print(f" * Loading initial data for {sorted_dates[0]}")
         prev_date = sorted_dates[0]
-        prev_date_roas = pd.read_parquet(input_file, filters=[('snapshot_date', '=', prev_date)])
-        prev_uri_map = prev_date_roas.groupby('prefix')['uri'].apply(set)
-
-        all_ipxo_prefixes = set(prev_date_roas[prev_date_roas['uri'].str.startswith(IPXO_REPO_URI, na=False)]['prefix'])
+        target_prefixes = load_target_prefixes(input_file)
+        if target_prefixes is not None:
+            print(" * Using the ingest-time repo_host column.")
+        # One pass over the input, day by day; the next day is read while the current pair is compared.
+        snapshots = iter_snapshots(input_file, columns=DAY_COLUMNS, dates=sorted_dates)
+        prev_date_roas = next(snapshots)[1].result()
+        prev_targets = day_targets(prev_date_roas, prev_date, target_prefixes)
+
+        all_ipxo_prefixes = set(prev_targets)
     except Exception as e:
         print(f"!!ERROR: Could not load initial data for {sorted_dates[0]}. {e}")
         return
     
-    for i in range(1, len(sorted_dates)):
-        current_date = sorted_dates[i]
-        print(f" ** For {sorted_dates[i]} ")
+    for current_date, pending in snapshots:
+        print(f" ** For {current_date} ")
         
         try:
-            curr_date_roas = pd.read_parquet(input_file, filters=[('snapshot_date', '=', current_date)])
+            curr_date_roas = pending.result()
         except Exception as e:
             print(f"!!ERROR: Could not load data for {current_date}. Skipping day. {e}")
             continue
 
-        curr_uri_map = curr_date_roas.groupby('prefix')['uri'].apply(set)
-        all_ipxo_prefixes.update(set(curr_date_roas[curr_date_roas['uri'].str.startswith(IPXO_REPO_URI, na=False)]['prefix']))
-        all_prefixes = set(prev_uri_map.index).union(set(curr_uri_map.index))
+        curr_targets = day_targets(curr_date_roas, current_date, target_prefixes)
+        all_ipxo_prefixes.update(curr_targets)
+        # Every event needs a Magellan URI on one of the two days, so only those prefixes are compared.
+        all_prefixes = prev_targets | curr_targets
+        prev_uri_map = uri_sets(prev_date_roas, all_prefixes)
+        curr_uri_map = uri_sets(curr_date_roas, all_prefixes)
 
         creations, deletions, updates_to_ipxo, updates_from_ipxo = set(), set(), set(), set()
 
@@ -67,8 +88,8 @@ def main(input_file):
             prev_date_uris = prev_uri_map.get(prefix, set())
             curr_date_uris = curr_uri_map.get(prefix, set())
 
-            in_ipxo_prev = is_in_ipxo_repo(prev_date_uris)
-            in_ipxo_curr = is_in_ipxo_repo(curr_date_uris)
+            in_ipxo_prev = prefix in prev_targets
+            in_ipxo_curr = prefix in curr_targets
 
             # CREATION: prefix newly appeared with Magellan URI (none before)
             if in_ipxo_curr and len(prev_date_uris) == 0:
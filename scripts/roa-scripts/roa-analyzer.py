@@ -0,0 +1,134 @@
+# This file logs events on prefixes for any number of targets (ASNs, repository URIs, or both) in one pass.
+
+import argparse
+import pandas as pd
+import os
+from roa_dataset import list_snapshot_dates, iter_snapshots
+from roa_events import TARGET_EVENT_TYPES, parse_target, target_prefixes, classify_events, EventLogWriter
+
+# Only these columns are needed per day; the rest of the ROA is never looked at.
+DAY_COLUMNS = ['prefix', 'asn', 'uri']
+SUMMARY_COLUMNS = ['date', 'target', 'creations', 'deletions', 'updates_to_target', 'updates_from_target']
+
+def main(input_file, target_specs, summary_file, event_file):
+    print("\n*************************************************************************************")
+    print("\n----------------------- RPKI ROA ANALYSIS - MULTIPLE TARGETS ------------------------")
+    print("\n*************************************************************************************")
+
+    try:
+        targets = [parse_target(spec) for spec in target_specs]
+    except ValueError as e:
+        print(f"!!ERROR: {e}")
+        return
+    print(f" * Tracking {len(targets)} targets: {', '.join(target['label'] for target in targets)}")
+
+    try:
+        print("Fetching date range.")
+        sorted_dates = list_snapshot_dates(input_file)
+        print(f" * Found {len(sorted_dates)} snapshot days to process.")
+    except Exception as e:
+        print(f"!!ERROR: Could not read the input file '{input_file}' to get dates.")
+        print(e)
+        return
+
+    daily_count = []
+    # Events are written as they are found: Parquet (typed list columns) for a .parquet path, CSV otherwise.
+    event_log = EventLogWriter(event_file, list_columns=['asn', 'uri'], target=True)
+
+    try:
+        print(f" * Loading initial data for {sorted_dates[0]}")
+        # One pass over the input for all targets; the next day is read while the current pair is compared.
+        snapshots = iter_snapshots(input_file, columns=DAY_COLUMNS, dates=sorted_dates)
+        prev_date_roas = next(snapshots)[1].result()
+        prev_targets = [target_prefixes(prev_date_roas, target) for target in targets]
+
+        all_target_prefixes = [set(prefixes) for prefixes in prev_targets]
+        churned_prefixes = [set() for target in targets]
+    except Exception as e:
+        print(f"!!ERROR: Could not load initial data for {sorted_dates[0]}. {e}")
+        return
+
+    for current_date, pending in snapshots:
+        print(f" ** For {current_date} ")
+
+        try:
+            curr_date_roas = pending.result()
+        except Exception as e:
+            print(f"!!ERROR: Could not load data for {current_date}. Skipping day. {e}")
+            continue
+
+        curr_targets = [target_prefixes(curr_date_roas, target) for target in targets]
+        for target, prev_prefixes, curr_prefixes, seen, churned in zip(targets, prev_targets, curr_targets, all_target_prefixes, churned_prefixes):
+            seen.update(curr_prefixes)
+
+            events = classify_events(prev_date_roas, curr_date_roas, prev_prefixes, curr_prefixes, ['asn', 'uri'], TARGET_EVENT_TYPES)
+            events.insert(0, 'date', current_date)
+            events.insert(1, 'target', target['label'])
+            churned.update(events['prefix'])
+            event_log.write(events)
+            counts = events['event'].value_counts()
+
+            daily_count.append({
+                'date': current_date,
+                'target': target['label'],
+                'creations': counts.get('creation', 0),
+                'deletions': counts.get('deletion', 0),
+                'updates_to_target': counts.get('update_to_target', 0),
+                'updates_from_target': counts.get('update_from_target', 0)
+            })
+
+            print(f" *** {target['label']}: +{daily_count[-1]['creations']}, -{daily_count[-1]['deletions']}, "
+                  f"to->{daily_count[-1]['updates_to_target']}, from<-{daily_count[-1]['updates_from_target']}")
+        prev_date_roas, prev_targets = curr_date_roas, curr_targets
+
+    summary_df = pd.DataFrame(daily_count, columns=SUMMARY_COLUMNS)
+    output_dir = os.path.dirname(summary_file)
+    os.makedirs(output_dir, exist_ok=True)
+    summary_df.to_csv(summary_file, index=False)
+    event_log.close()
+
+    print(f"\nSaved summary (event count) to {summary_file}")
+    print(f"Saved detailed events to {event_file}")
+
+    print("\nFinding 'permanent' prefixes (associated with a target but never churned)")
+    for target, seen, churned in zip(targets, all_target_prefixes, churned_prefixes):
+        permanent_prefixes = seen - churned
+        print(f" * {target['label']}: {len(seen)} prefixes ever associated, {len(churned)} churned, "
+              f"{len(permanent_prefixes)} permanent.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Analyzing RPKI ROA CSVs - several ASNs and/or repositories in one pass")
+
+    # Output of roa-csv-parser file
+    parser.add_argument(
+        '--file',
+        type=str,
+        default=None,
+        help="The file path of the Parquet file which is to be analyzer."
+    )
+
+    parser.add_argument(
+        '--targets',
+        type=str,
+        nargs='+',
+        default=['AS834'],
+        help="Targets to track: an ASN (AS834), a URI prefix (rsync://r.magellan.ipxo.com), or both joined with '+' (AS834+rsync://r.magellan.ipxo.com)."
+    )
+
+    parser.add_argument(
+        '--summary_output_file_path',
+        type=str,
+        default=None,
+        help="The file path of the summary file to be saved (one row per day and target)."
+    )
+
+    parser.add_argument(
+        '--detail_output_file_path',
+        type=str,
+        default=None,
+        help="The file path of the detailed file to be saved (one row per event, with its target): typed Parquet if it ends in .parquet, CSV otherwise."
+    )
+
+    args = parser.parse_args()
+    main(args.file, args.targets, args.summary_output_file_path, args.detail_output_file_path)
@@ -1,17 +1,63 @@
 # Fetches all ROAs associated to prefixes once associated to ASN 834 or Magellan Repo (depends upon CSV you feed it).
 
 import argparse
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import os
+from roa_dataset import scan_roas
+from roa_events import read_events
+from roa_prefix_set import MATCH_MODES, PrefixSet
 
-def main(prefix_details, fdata_file, output_file):
+# A ROA counts once in the deduplicated history per distinct combination of these columns.
+UNIQUE_COLUMNS = ['prefix', 'asn', 'max_len', 'not_before', 'not_after']
+# UNIQUE_COLUMNS = ['prefix', 'asn', 'max_len']
+
+def first_occurrences(batch, seen):
+    # Mask of the rows of batch whose UNIQUE_COLUMNS values were not seen before (in earlier batches or earlier
+    # in this one), and the updated seen: the sorted 64-bit hashes of every distinct row so far, so it grows with the
+    # unique history only.
+    hashes = pd.util.hash_pandas_object(batch.select(UNIQUE_COLUMNS).to_pandas(), index=False).to_numpy()
+    values, first = np.unique(hashes, return_index=True)
+    positions = np.minimum(np.searchsorted(seen, values), max(len(seen) - 1, 0))
+    new = seen[positions] != values if len(seen) else np.ones(len(values), dtype=bool)
+    mask = np.zeros(len(hashes), dtype=bool)
+    mask[first[new]] = True
+    return mask, np.union1d(seen, values[new])
+
+def match_prefixes(fdata_file, churned_prefixes, modes):
+    # Prefixes to pull for the churned ones under the given match modes, and the smallest max_len a row of each
+    # needs: 0 (every ROA of the prefix) unless the prefix only came in as an authorizing ROA of some churned prefix.
+    prefix_set = PrefixSet.from_roas(fdata_file)
+    queries = sorted(churned_prefixes)
+    thresholds = {}
+    for mode in modes:
+        matches = prefix_set.match(queries, mode)
+        print(f" * {mode}: {len(matches):,} (churned prefix, prefix, max_len) matches over {matches['prefix'].nunique():,} prefixes.")
+        if mode == 'authorized':
+            required = matches.groupby('prefix')['query_length'].min()
+        else:
+            required = pd.Series(0, index=pd.unique(matches['prefix']))
+        for prefix, length in required.items():
+            thresholds[prefix] = min(length, thresholds.get(prefix, length))
+    if 'exact' in modes:
+        thresholds.update((prefix, 0) for prefix in churned_prefixes)
+    return thresholds
+
+def authorized_rows(batch, thresholds):
+    prefixes = pd.Series(batch['prefix'].to_numpy(zero_copy_only=False))
+    return pa.array(batch['max_len'].to_numpy(zero_copy_only=False) >= prefixes.map(thresholds).to_numpy())
+
+def main(prefix_details, fdata_file, output_file, unique_output_file=None, columns=None, match=['exact']):
     print("\n*************************************************************************************")
     print("\n------------------- RPKI ROA CHURNED PREFIX HISTORY EXTRACTOR ----------------------")
     print("\n*************************************************************************************")
 
     print(f"Loading churned prefix list from: {prefix_details}")
     try:
-        details_df = pd.read_csv(prefix_details)
+        # Only the prefix column of the event log (CSV or Parquet) is needed.
+        details_df = read_events(prefix_details, columns=['prefix'])
         churned_prefixes = set(details_df['prefix'])
         print(f" * Found {len(churned_prefixes)} unique prefixes that churned.")
     except Exception as e:
@@ -19,32 +65,68 @@ def main(prefix_details, fdata_file, output_file):
         print(e)
         return
 
-    print(f"Loading full dataset from: {fdata_file}")
-    try:
-        df = pd.read_parquet(fdata_file)
-        print(f" * Successfully loaded {len(df):,} total ROA records.")
-    except Exception as e:
-        print(f"!!ERROR: Could not read the full data file '{fdata_file}'.")
-        print(e)
-        return
+    output_columns = columns
+    if unique_output_file is not None and columns is not None:
+        columns = output_columns = columns + [name for name in UNIQUE_COLUMNS if name not in columns]
 
-    print(f"\nFiltering for the {len(churned_prefixes)} churned prefixes.")
-    history_df = df[df['prefix'].isin(churned_prefixes)].copy()
-    print(f" * Found {len(history_df):,} total ROA records for all churned prefixes.")
-    unique_cols = ['prefix', 'asn', 'max_len', 'not_before', 'not_after']
-    # unique_cols = ['prefix', 'asn', 'max_len']
-    unique_history_df = history_df.drop_duplicates(subset=unique_cols)
-    print(f" ** Found {len(unique_history_df):,} total unique ROA records for all churned prefixes.")
+    thresholds = None
+    if match != ['exact']:
+        print(f"\nMatching the churned prefixes against the prefixes of {fdata_file} ({', '.join(match)}).")
+        try:
+            thresholds = match_prefixes(fdata_file, churned_prefixes, match)
+        except Exception as e:
+            print(f"!!ERROR: Could not match the churned prefixes against '{fdata_file}'.")
+            print(e)
+            return
+        churned_prefixes = set(thresholds)
+        print(f" * {len(churned_prefixes)} prefixes to extract.")
+        if any(thresholds.values()):
+            if columns is not None and 'max_len' not in columns:
+                columns = columns + ['max_len']
+        else:
+            thresholds = None
 
+    # The prefix filter and the column projection go into the Parquet scan, and matching rows are written out
+    # batch by batch, so memory follows the churned subset rather than the whole dataset.
+    print(f"\nScanning {fdata_file} for the {len(churned_prefixes)} churned prefixes.")
+    writers = {}
+    rows, unique_rows = 0, None
+    seen = np.array([], dtype=np.uint64)
     try:
-        output_dir = os.path.dirname(output_file)
-        if output_dir:
+        for output_dir in {os.path.dirname(path) for path in (output_file, unique_output_file) if path} - {''}:
             os.makedirs(output_dir, exist_ok=True)
-        history_df.to_parquet(output_file, index=False)
-        print(f"\nSuccessfully saved churned prefix history to: {output_file}\n")
+        for batch in scan_roas(fdata_file, columns=columns, prefixes=churned_prefixes):
+            if thresholds is not None:
+                # Prefixes pulled in only as authorizing ROAs keep just the ROAs whose max_len reaches a churned prefix.
+                batch = batch.filter(authorized_rows(batch, thresholds))
+                if output_columns is not None:
+                    batch = batch.select(output_columns)
+            if not writers:
+                writers['history'] = pq.ParquetWriter(output_file, batch.schema)
+                if unique_output_file is not None:
+                    writers['unique'] = pq.ParquetWriter(unique_output_file, batch.schema)
+            writers['history'].write_table(batch)
+            rows += batch.num_rows
+            if set(UNIQUE_COLUMNS) <= set(batch.column_names):
+                mask, seen = first_occurrences(batch, seen)
+                unique = batch.filter(mask)
+                unique_rows = (unique_rows or 0) + unique.num_rows
+                if unique_output_file is not None:
+                    writers['unique'].write_table(unique)
     except Exception as e:
-        print(f"!!ERROR: Could not save the output file '{output_file}'.")
+        print(f"!!ERROR: Could not extract the churned prefix history from '{fdata_file}' to '{output_file}'.")
         print(e)
+        return
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    print(f" * Found {rows:,} total ROA records for all churned prefixes.")
+    if unique_rows is not None:
+        print(f" ** Found {unique_rows:,} total unique ROA records for all churned prefixes.")
+    print(f"\nSuccessfully saved churned prefix history to: {output_file}\n")
+    if unique_output_file is not None:
+        print(f"Successfully saved the deduplicated churned prefix history to: {unique_output_file}\n")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Extract and save full ROA history for churned prefixes.")
@@ -53,7 +135,7 @@ if __name__ == "__main__":
         '--prefix_details', 
         type=str, 
         required=True,
-        help="Path to the CSV details file having churned prefix (event details output of roa-analyzer-*.py)."
+        help="Path to the CSV or Parquet details file having churned prefix (event details output of roa-analyzer-*.py)."
     )
     
     parser.add_argument(
@@ -70,5 +152,29 @@ if __name__ == "__main__":
         help="Path for the output Parquet file having all ROA associated to the churned prefix."
     )
 
+    parser.add_argument(
+        '--unique_output_file', 
+        type=str, 
+        default=None,
+        help="Optional path for a Parquet file with the deduplicated history (first ROA per prefix, asn, max_len, not_before and not_after)."
+    )
+
+    parser.add_argument(
+        '--columns', 
+        type=str, 
+        nargs='+',
+        default=None,
+        help="Only keep these columns in the output (all ROA columns by default)."
+    )
+
+    parser.add_argument(
+        '--match', 
+        type=str, 
+        nargs='+',
+        choices=MATCH_MODES,
+        default=['exact'],
+        help="Which prefixes' ROAs to extract for a churned prefix: the prefix itself (exact), its covering aggregates (covering), its more-specifics (more_specific), and/or the ROAs whose prefix and max_len authorize it (authorized)."
+    )
+
     args = parser.parse_args()
-    main(args.prefix_details, args.data_file, args.output_file)
\ No newline at end of file
+    main(args.prefix_details, args.data_file, args.output_file, args.unique_output_file, args.columns, args.match)
\ No newline at end of file
@@ -1,51 +1,303 @@
 # This file downloads the zipped ROA CSVs for year/month/date specified.
 
 import os
+import json
+import time
+import hashlib
+import threading
 import requests
+import urllib3
 import lzma
 import shutil
 import calendar
 import argparse
 from datetime import date
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+import pandas as pd
+import pyarrow as pa
+from roa_dataset import read_snapshot_table, collapse_repos, SnapshotWriter, derived_column_names, ENGINES, SCHEMAS, DERIVED_FIELDS
 
 roas_url = "https://ftp.ripe.net/rpki/"
-rir_repos = ['ripencc.tal'] #for now only ripe
+rir_repos = ['afrinic.tal', 'apnic.tal', 'arin.tal', 'lacnic.tal', 'ripencc.tal']
 
-def save_roas_csv(url, output_filepath):
+MANIFEST_FILENAME = "manifest.json"
+PART_SUFFIX = ".part"
+
+def make_session(workers):
+    # One pooled session shared by all download threads, so connections to the server are reused.
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(workers, 1))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def load_manifest(directory):
+    # The manifest records size/hash/validators of every completed download, keyed by file name.
+    manifest_path = os.path.join(directory, MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return {}
     try:
-        print(f"\n ----- Downloading from {url} -----")
-        response = requests.get(url, stream=True, timeout=30)
-        response.raise_for_status()
+        with open(manifest_path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"!WARNING: Could not read manifest {manifest_path} ({e}). Starting with an empty manifest.")
+        return {}
+
+
+def save_manifest(directory, manifest):
+    manifest_path = os.path.join(directory, MANIFEST_FILENAME)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
 
-        with open(output_filepath, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192): 
-                f.write(chunk)
+def file_sha256(filepath):
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
 
-        print(f"Successfully downloaded to {output_filepath}")
-        print(f"\n=======")
-        return True
 
-    except requests.exceptions.RequestException as e:
-        print(f"!!ERROR: Failed downloading ROA CSV from {url}. Error: {e}")
+def is_verified(output_filepath, entry, verify):
+    # A file counts as complete only if the manifest vouches for it; a bare existing file may be truncated.
+    if not entry or not entry.get('complete') or not os.path.exists(output_filepath):
         return False
+    if os.path.getsize(output_filepath) != entry.get('size'):
+        return False
+    return not verify or file_sha256(output_filepath) == entry.get('sha256')
+
+
+def save_roas_csv(url, output_filepath, session=None, retries=0, backoff=1.0, entry=None, verify=False, on_start=None):
+    # Returns (entry, transferred_bytes): the new manifest entry for the file, or (None, bytes) if the download failed.
+    # Data is streamed into <file>.part and only renamed onto the final path once it is complete.
+    # on_start(entry) is called with the validators of a new transfer so an interrupted one can be resumed safely.
+    http = session if session is not None else requests
+    part_filepath = output_filepath + PART_SUFFIX
+    transferred = 0
+    for attempt in range(retries + 1):
+        try:
+            headers = {}
+            have_file = is_verified(output_filepath, entry, verify)
+            part_size = os.path.getsize(part_filepath) if os.path.exists(part_filepath) else 0
+            if have_file:
+                if entry.get('etag'):
+                    headers['If-None-Match'] = entry['etag']
+                if entry.get('last_modified'):
+                    headers['If-Modified-Since'] = entry['last_modified']
+            elif part_size > 0:
+                # Only resume if the server copy is the one the partial file was started from: If-Range takes its
+                # strong ETag, else its Last-Modified date. Without either there is no way to tell, so start over.
+                etag = entry.get('etag') if entry else None
+                validator = etag if etag and not etag.startswith('W/') else (entry or {}).get('last_modified')
+                if validator:
+                    headers['Range'] = f"bytes={part_size}-"
+                    headers['If-Range'] = validator
+                else:
+                    print(f"!WARNING: No validator for {part_filepath}, restarting the download from byte 0.")
+                    os.remove(part_filepath)
+                    part_size = 0
+
+            print(f"\n ----- Downloading from {url} -----")
+            response = http.get(url, stream=True, timeout=30, headers=headers)
+
+            content_range = response.headers.get('Content-Range')
+            if response.status_code == 206 and not (content_range or '').startswith(f"bytes {part_size}-"):
+                # Not the range that was asked for, so the bytes cannot be appended to the partial file.
+                print(f"!WARNING: Unusable partial response for {url}, restarting the download from byte 0.")
+                response.close()
+                if os.path.exists(part_filepath):
+                    os.remove(part_filepath)
+                part_size = 0
+                response = http.get(url, stream=True, timeout=30)
+
+            if response.status_code == 304:
+                response.close()
+                print(f"Unchanged since last download, keeping {output_filepath}")
+                return entry, transferred
+
+            if response.status_code == 416:
+                # The partial file does not fit the server copy anymore, start over.
+                response.close()
+                if os.path.exists(part_filepath):
+                    os.remove(part_filepath)
+                raise requests.exceptions.ConnectionError(f"Range not satisfiable for {url}, restarting download")
+
+            response.raise_for_status()
+
+            if response.status_code == 206:
+                mode = 'ab'
+                total = content_range.rsplit('/', 1)[-1]
+                total = int(total) if total != '*' else None
+                print(f"Resuming {part_filepath} at byte {part_size}")
+            else:
+                mode = 'wb'
+                length = response.headers.get('Content-Length')
+                total = int(length) if length is not None and 'Content-Encoding' not in response.headers else None
+
+            last_modified = response.headers.get('Last-Modified')
+            etag = response.headers.get('ETag')
+            entry = {'url': url, 'complete': False, 'last_modified': last_modified, 'etag': etag}
+            if on_start is not None and mode == 'wb':
+                on_start(entry)
+
+            with open(part_filepath, mode) as f:
+                for chunk in response.iter_content(chunk_size=8192): 
+                    f.write(chunk)
+                    transferred += len(chunk)
+
+            size = os.path.getsize(part_filepath)
+            if total is not None and size != total:
+                raise requests.exceptions.ConnectionError(f"Truncated download of {url}: got {size} of {total} bytes")
+
+            entry.update({'complete': True, 'size': size, 'sha256': file_sha256(part_filepath)})
+            os.replace(part_filepath, output_filepath)
 
+            print(f"Successfully downloaded to {output_filepath}")
+            print(f"\n=======")
+            return entry, transferred
 
-def main(repos, year, month, day, directory):
+        except requests.exceptions.RequestException as e:
+            status = e.response.status_code if e.response is not None else None
+            # A missing snapshot (4xx) will not appear on retry, only retry network/server errors.
+            if attempt < retries and (status is None or status >= 500):
+                wait = backoff * (2 ** attempt)
+                print(f"!WARNING: Attempt {attempt + 1} for {url} failed ({e}). Retrying in {wait:.1f}s.")
+                time.sleep(wait)
+                continue
+            print(f"!!ERROR: Failed downloading ROA CSV from {url}. Error: {e}")
+            return None, transferred
+
+
+def download_snapshot(session, url, output_filepath, retries, backoff, manifest, manifest_lock, verify):
+    name = os.path.basename(output_filepath)
+    with manifest_lock:
+        old_entry = manifest.get(name)
+
+    def on_start(pending):
+        # Only record a pending transfer if there is no complete copy that it would shadow.
+        with manifest_lock:
+            if not (manifest.get(name) or {}).get('complete'):
+                manifest[name] = pending
+                save_manifest(os.path.dirname(output_filepath), manifest)
+
+    entry, transferred = save_roas_csv(url, output_filepath, session, retries, backoff, old_entry, verify, on_start)
+    if entry is None:
+        # Keep <file>.part around so the next run can resume it with a Range request.
+        return None, transferred
+    with manifest_lock:
+        manifest[name] = entry
+        save_manifest(os.path.dirname(output_filepath), manifest)
+    return entry is old_entry, transferred
+
+
+def stream_snapshot_frame(session, url, snapshot_date, repo, retries, backoff, engine='pandas'):
+    # Decompresses and parses the HTTP body on the fly, nothing is written to disk.
+    # Returns (table, transferred_bytes), table is None if the snapshot could not be fetched.
+    transferred = 0
+    for attempt in range(retries + 1):
+        try:
+            print(f"\n ----- Streaming from {url} -----")
+            response = session.get(url, stream=True, timeout=30)
+            response.raise_for_status()
+            response.raw.decode_content = True
+            with response:
+                frame = read_snapshot_table(response.raw, snapshot_date, repo, engine)
+                transferred += response.raw.tell()
+            print(f"Successfully parsed {len(frame)} ROAs from {url}")
+            return frame, transferred
+
+        except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, lzma.LZMAError, EOFError, pd.errors.EmptyDataError,
+                pd.errors.ParserError, ValueError, pa.ArrowException) as e:
+            status = getattr(getattr(e, 'response', None), 'status_code', None)
+            # A missing snapshot (4xx) will not appear on retry, only retry network/server/truncation errors.
+            # A body that is not a ROA CSV (e.g. an HTML error page) is retried the same way and then skipped.
+            if attempt < retries and (status is None or status >= 500):
+                wait = backoff * (2 ** attempt)
+                print(f"!WARNING: Attempt {attempt + 1} for {url} failed ({e}). Retrying in {wait:.1f}s.")
+                time.sleep(wait)
+                continue
+            print(f"!!ERROR: Failed streaming ROA CSV from {url}. Error: {e}")
+            return None, transferred
+
+
+def stream_day(session, snapshot_date, repo_urls, retries, backoff, engine='pandas'):
+    # All repos of one day are fetched by the same task so cross-TAL duplicates can be collapsed before writing.
+    frames = []
+    transferred = 0
+    for repo, url in repo_urls:
+        frame, size = stream_snapshot_frame(session, url, snapshot_date, repo, retries, backoff, engine)
+        transferred += size
+        if frame is not None:
+            frames.append(frame)
+    if len(frames) > 1:
+        merged, duplicates = collapse_repos(frames)
+        print(f" ** Collapsed {duplicates} ROAs published under multiple repos for {snapshot_date.date()}")
+        return merged, len(frames), transferred
+    return (frames[0] if frames else None), len(frames), transferred
+
+
+def stream_to_parquet(session, days, output_parquet, workers, retries, backoff, engine='pandas', compact=False, derived=()):
+    # Keeps up to `workers` days in flight and writes them in date order, so memory stays bounded
+    # to a window of days while network transfer and parsing overlap.
+    output_dir = os.path.dirname(output_parquet)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    writer = SnapshotWriter(output_parquet, compact, derived)
+    files_count = 0
+    bytes_count = 0
+    try:
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+            pending = []
+            days = iter(days)
+            while True:
+                while len(pending) < max(workers, 1):
+                    next_day = next(days, None)
+                    if next_day is None:
+                        break
+                    snapshot_date, repo_urls = next_day
+                    pending.append(pool.submit(stream_day, session, snapshot_date, repo_urls, retries, backoff, engine))
+                if not pending:
+                    break
+                frame, fetched, transferred = pending.pop(0).result()
+                files_count += fetched
+                bytes_count += transferred
+                if frame is not None:
+                    writer.write(frame)
+    finally:
+        # Even if the run is aborted, the days already written get a footer and stay readable.
+        written = writer.close()
+    if written:
+        print(f"\nStreamed {writer.rows} records into {output_parquet}.")
+    else:
+        print("\nNo data was written (no snapshot could be fetched).")
+    return files_count, bytes_count
+
+
+def main(repos, year, month, day, directory, workers=1, retries=3, backoff=1.0, base_url=roas_url, verify=False, output_parquet=None, engine='pandas', schema='legacy', derived_columns=None, target_asns=None):
         
     print("\n*************************************************************************************")
     print("\n--------------------------- RPKI ROA CSV Downloads ----------------------------------")
     print("\n*************************************************************************************")
-    print(f"\nDownloading RPKI ROAs to {directory}")
-    os.makedirs(directory, exist_ok=True)
+    if output_parquet:
+        print(f"\nStreaming RPKI ROAs straight into {output_parquet}")
+    elif directory:
+        print(f"\nDownloading RPKI ROAs to {directory}")
+        os.makedirs(directory, exist_ok=True)
+    else:
+        print("\n!!ERROR: Neither --dir nor --output_parquet specified. Please try again.")
+        return
 
     print(" * Checking which repositories to process...")
 
+    all_repos = []
     if len(repos) == 0:
         print("\n!!ERROR: No repos passed. Please try again.")
     elif 'all' in repos:
-        all_repos = repos
+        all_repos = list(rir_repos)
     else:
-        all_repos = []
         for repo in repos:
             if repo in rir_repos:
                 all_repos.append(repo)
@@ -62,6 +314,11 @@ def main(repos, year, month, day, directory):
         print("\n!!ERROR: Target Day specified but no month specified. Please try again.")
 
     files_count = 0
+    unchanged_count = 0
+    bytes_count = 0
+    jobs = {repo: [] for repo in all_repos}
+    if not base_url.endswith('/'):
+        base_url += '/'
 
     month_first = month if month else 1
     month_last = month if month else 12
@@ -85,24 +342,78 @@ def main(repos, year, month, day, directory):
                 month_str = str(current_month).zfill(2)
                 day_str = str(current_day).zfill(2)
 
-                url = f"{roas_url}{repo}/{year}/{month_str}/{day_str}/roas.csv.xz"
-                output_filename = f"{year}{month_str}{day_str}_roas.csv.xz"
-                output_filepath = os.path.join(directory, output_filename)
+                url = f"{base_url}{repo}/{year}/{month_str}/{day_str}/roas.csv.xz"
+                # The repo is part of the name so snapshots of different TALs for the same day do not collide.
+                output_filename = f"{year}{month_str}{day_str}_{repo}_roas.csv.xz"
+                output_filepath = os.path.join(directory or '', output_filename)
 
-                print(f"\n=======")
-                print(f"Starting download of {repo} for {year}/{month_str}/{day_str}")
+                jobs[repo].append((url, output_filepath))
 
-                if os.path.exists(output_filepath):
-                    print(f"!WARNING: {output_filepath} already exists. Skipping.")
-                    continue
+    if output_parquet:
+        try:
+            derived = derived_column_names(derived_columns, target_asns)
+        except ValueError as e:
+            print(f"!!ERROR: {e}")
+            return
+        days = {}
+        for repo in all_repos:
+            for url, output_filepath in jobs[repo]:
+                date_part = os.path.basename(output_filepath).split('_')[0]
+                days.setdefault(date_part, []).append((repo, url))
+        days = [(pd.to_datetime(date_part, format='%Y%m%d'), days[date_part]) for date_part in sorted(days)]
+        print(f"\n * Queued {len(days)} days with up to {workers} day(s) in flight.")
+        session = make_session(workers)
+        start_time = time.perf_counter()
+        files_count, bytes_count = stream_to_parquet(session, days, output_parquet, workers, retries, backoff, engine, schema == 'compact', derived)
+        session.close()
+        elapsed = time.perf_counter() - start_time
+        print(f"\n\nStreaming complete. Total ROA CSVs parsed are {files_count}.\n")
+        if elapsed > 0:
+            print(f" * Throughput: {files_count / elapsed:.2f} files/s, {bytes_count / elapsed / 1e6:.2f} MB/s "
+                  f"({bytes_count / 1e6:.2f} MB in {elapsed:.1f}s).\n")
+        return
 
-                if save_roas_csv(url, output_filepath):
-                    files_count += 1
-                else:
-                    if os.path.exists(output_filepath):
-                        os.remove(output_filepath)
+    manifest = load_manifest(directory)
+    manifest_lock = threading.Lock()
+    total_jobs = sum(len(repo_jobs) for repo_jobs in jobs.values())
+    print(f"\n * Queued {total_jobs} snapshots using {workers} worker(s) per repo, {len(manifest)} already in the manifest.")
+    session = make_session(workers * max(len(all_repos), 1))
+    start_time = time.perf_counter()
 
-    print(f"\n\nDownload complete. Total ROA CSVs downloaded are {files_count}.\n")
+    def record(result):
+        nonlocal files_count, unchanged_count, bytes_count
+        unchanged, transferred = result
+        bytes_count += transferred
+        if unchanged is None:
+            return
+        if unchanged:
+            unchanged_count += 1
+        else:
+            files_count += 1
+
+    if workers <= 1:
+        for repo in all_repos:
+            for url, output_filepath in jobs[repo]:
+                print(f"\n=======")
+                print(f"Starting download of {url}")
+                record(download_snapshot(session, url, output_filepath, retries, backoff, manifest, manifest_lock, verify))
+    else:
+        # One bounded pool per repo, all running at once, so every TAL progresses in parallel.
+        pools = {repo: ThreadPoolExecutor(max_workers=workers) for repo in all_repos}
+        futures = [pools[repo].submit(download_snapshot, session, url, output_filepath, retries, backoff, manifest, manifest_lock, verify)
+                   for repo in all_repos for url, output_filepath in jobs[repo]]
+        for future in as_completed(futures):
+            record(future.result())
+        for pool in pools.values():
+            pool.shutdown()
+
+    session.close()
+    elapsed = time.perf_counter() - start_time
+
+    print(f"\n\nDownload complete. Total ROA CSVs downloaded are {files_count}, {unchanged_count} were unchanged and skipped.\n")
+    if elapsed > 0:
+        print(f" * Throughput: {files_count / elapsed:.2f} files/s, {bytes_count / elapsed / 1e6:.2f} MB/s "
+              f"({bytes_count / 1e6:.2f} MB in {elapsed:.1f}s).\n")
 
 
 if __name__ == "__main__":
@@ -112,7 +423,7 @@ if __name__ == "__main__":
         '--repo', 
         nargs='+', 
         default=['ripencc.tal'],
-        help=f"Specify one or more repos to download from (e.g., ripencc.tal). Use 'all' for all repos. Defaults to 'ripe.net'. Pick from: {', '.join(rir_repos)}"
+        help=f"Specify one or more repos to download from (e.g., ripencc.tal). Use 'all' for all repos. Defaults to 'ripencc.tal'. Pick from: {', '.join(rir_repos)}"
     )
     parser.add_argument(
         '--year', 
@@ -137,9 +448,76 @@ if __name__ == "__main__":
     parser.add_argument(
         '--dir', 
         type=str, 
-        required=True,
+        default=None,
         help="The directory where the downloaded CSV files will be saved."
     )
+    parser.add_argument(
+        '--output_parquet', 
+        type=str, 
+        default=None,
+        help="Optional: Stream, decompress and parse the snapshots straight into this Parquet file instead of saving .csv.xz files to --dir."
+    )
+
+    parser.add_argument(
+        '--workers', 
+        type=int, 
+        default=1,
+        help="Number of snapshots downloaded concurrently per repo over a shared connection pool. Defaults to 1 (sequential)."
+    )
+    parser.add_argument(
+        '--retries', 
+        type=int, 
+        default=3,
+        help="Number of times a failed download is retried (with exponential backoff) before giving up."
+    )
+    parser.add_argument(
+        '--backoff', 
+        type=float, 
+        default=1.0,
+        help="Initial backoff in seconds between retries, doubled after every failed attempt."
+    )
+    parser.add_argument(
+        '--base_url', 
+        type=str, 
+        default=roas_url,
+        help=f"Root of the rpki/<repo>/<yyyy>/<mm>/<dd>/roas.csv.xz tree. Defaults to {roas_url}."
+    )
+
+    parser.add_argument(
+        '--verify',
+        action='store_true',
+        help="If set, re-hash existing files against the manifest before trusting them (otherwise only the size is checked)."
+    )
+
+    parser.add_argument(
+        '--engine',
+        type=str,
+        default='pandas',
+        choices=ENGINES,
+        help="CSV parsing engine used with --output_parquet: 'pandas' or 'arrow' (Arrow's multithreaded streaming CSV reader)."
+    )
+
+    parser.add_argument(
+        '--schema',
+        type=str,
+        default='legacy',
+        choices=SCHEMAS,
+        help="Column types written with --output_parquet: 'legacy' or 'compact' (see roa-csv-parser.py)."
+    )
+
+    parser.add_argument(
+        '--derived_columns',
+        type=str,
+        default=None,
+        help=f"Comma-separated columns computed while streaming with --output_parquet: {', '.join(DERIVED_FIELDS)} (see roa-csv-parser.py)."
+    )
+
+    parser.add_argument(
+        '--target_asns',
+        type=str,
+        default=None,
+        help="Comma-separated ASNs flagged with a boolean is_as<N> column when streaming with --output_parquet."
+    )
 
     args = parser.parse_args()
-    main(args.repo, args.year, args.month, args.day, args.dir)
+    main(args.repo, args.year, args.month, args.day, args.dir, args.workers, args.retries, args.backoff, args.base_url, args.verify, args.output_parquet, args.engine, args.schema, args.derived_columns, args.target_asns)
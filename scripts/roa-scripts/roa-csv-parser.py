@@ -1,80 +1,165 @@
 # This file unzips and parses from ROA CSVs and stores them in a CSV/Parquet file.
 
 import pandas as pd
-import pyarrow as pa
-import pyarrow.parquet as pq
 import glob
 import os
 import argparse
 import lzma
+import time
+import resource
+from datetime import datetime
+from itertools import groupby
+from concurrent.futures import ProcessPoolExecutor
+from roa_intervals import IntervalWriter
+from roa_dataset import snapshot_key, read_snapshot_table, collapse_repos, SnapshotWriter, parse_snapshot_to_fragment, load_ingest_manifest, save_ingest_manifest, fragment_schema, derived_column_names, ENGINES, SCHEMAS, DERIVED_FIELDS
 
-considered_columns = {
-    'URI': 'uri',
-    'ASN': 'asn',
-    'IP Prefix': 'prefix',
-    'Max Length': 'max_len',
-    'Not Before': 'not_before',
-    'Not After': 'not_after'
-}
+def clean_files(processed_files, clean):
+    if clean:
+        print("Cleaning up original .csv.xz files.")
+        for f_to_delete in processed_files:
+            try:
+                os.remove(f_to_delete)
+                print(f" * Deleted {f_to_delete}")
+            except OSError as e:
+                print(f"!!ERROR: Could not delete {f_to_delete}. Error: {e}")
+    else:
+        print("Original .csv.xz files were not deleted as per --clean flag.")
 
-def parse_csvs_and_save(zips, output_dir, output_filename, output_type, clean):
 
-    output_filename = output_filename + "." + output_type
-    output_filepath = os.path.join(output_dir, output_filename)
+def ingest_day(date_part):
+    # Ingest manifest key of a snapshot day, matching the partition directory names.
+    try:
+        return datetime.strptime(date_part, '%Y%m%d').date().isoformat()
+    except ValueError:
+        return date_part
+
+
+def parse_csvs_to_dataset(zips, output_dir, output_filename, clean, workers, engine='pandas', compact=False, append=False, derived=()):
+    # Every snapshot day becomes its own fragment under <output_dir>/<output_filename>/snapshot_date=<yyyy-mm-dd>/,
+    # parsed by a pool of worker processes so decompression and CSV parsing use all cores.
+    # With append, days already in the ingest manifest are refused and only new days are parsed.
+    dataset_dir = os.path.join(output_dir, output_filename)
+    os.makedirs(dataset_dir, exist_ok=True)
+
+    schema = 'compact' if compact else 'legacy'
+    manifest = load_ingest_manifest(dataset_dir)
+    if manifest['days'] and manifest['schema'] not in (None, schema):
+        print(f"!!ERROR: {dataset_dir} holds {manifest['schema']} schema snapshots; refusing to add {schema} ones. Use --schema {manifest['schema']}.")
+        return
+    # Compared by the columns they add, as derived columns the compact schema already has (af, prefix_len) add none.
+    if manifest['days'] and fragment_schema(compact, manifest.get('derived', [])).names != fragment_schema(compact, derived).names:
+        print(f"!!ERROR: {dataset_dir} was written with derived columns [{', '.join(manifest.get('derived', []))}]; refusing to add days with [{', '.join(derived)}].")
+        return
+    manifest['schema'] = schema
+    manifest['derived'] = list(derived)
+
+    days = [(date_part, list(group)) for date_part, group in groupby(sorted(zips, key=snapshot_key), key=lambda zip: snapshot_key(zip)[0])]
+    if append:
+        # Re-running over the whole download directory is the normal case, so days already ingested are only counted.
+        new_days = [(date_part, group) for date_part, group in days if ingest_day(date_part) not in manifest['days']]
+        print(f" * {len(new_days)} of {len(days)} snapshot days are new; skipping {len(days) - len(new_days)} already ingested.")
+        days = new_days
+        if not days:
+            print("\nNothing new to ingest.")
+            return
+    print(f" * Parsing {len(days)} snapshot days with {workers} worker process(es).")
 
     final_data = 0
+    collapsed_data = 0
+    processed_files = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(parse_snapshot_to_fragment, date_part, group, dataset_dir, engine, compact, derived) for date_part, group in days]
+        for (date_part, group), future in zip(days, futures):
+            try:
+                rows, duplicates, processed, errors = future.result()
+            except Exception as e:
+                print(f"!!ERROR: An unexpected error occurred with {date_part}. Error: {e}. Skipping day.")
+                continue
+            for error in errors:
+                print(f"!!ERROR: {error}")
+            if duplicates:
+                print(f" ** Collapsed {duplicates} ROAs published under multiple repos for {date_part}")
+            print(f" ** Processed {date_part} ({rows} records)")
+            if processed:
+                # Saved per day so an interrupted run leaves the manifest describing exactly the fragments written.
+                manifest['days'][ingest_day(date_part)] = {'files': sorted(os.path.basename(f) for f in processed), 'rows': rows,
+                                                           'ingested_at': datetime.now().isoformat(timespec='seconds')}
+                save_ingest_manifest(dataset_dir, manifest)
+            final_data += rows
+            collapsed_data += duplicates
+            processed_files.extend(processed)
+
+    if processed_files:
+        print(f"\nCompleted parsing {final_data} records ({collapsed_data} cross-repo duplicates collapsed). Saved the partitioned dataset to {dataset_dir}.\n")
+        clean_files(processed_files, clean)
+    else:
+        print("\nNo data was written. No files will be deleted.")
+
+
+def parse_csvs_and_save(zips, output_dir, output_filename, output_type, clean, engine='pandas', compact=False, derived=()):
+
+    # Interval files are Parquet too; the double extension tells them apart from per-day snapshot files.
+    output_filename = output_filename + (".intervals.parquet" if output_type == 'intervals' else "." + output_type)
+    output_filepath = os.path.join(output_dir, output_filename)
+
+    collapsed_data = 0
     os.makedirs(output_dir, exist_ok=True)
-    writer = None
+    writer = IntervalWriter(output_filepath, compact, derived) if output_type == 'intervals' else SnapshotWriter(output_filepath, compact, derived)
     processed_files = []
-    for zip in zips:
-        print(f" ** Processing {zip}")
+
+    # Snapshots of all repos for the same day are parsed together so cross-TAL duplicates can be collapsed.
+    zips = sorted(zips, key=snapshot_key)
+    for date_part, group in groupby(zips, key=lambda zip: snapshot_key(zip)[0]):
+        group = list(group)
         try:
-            base_name = os.path.basename(zip)
-            date_part = base_name.split('_')[0]
             snapshot_date = pd.to_datetime(date_part, format='%Y%m%d')
-            # Open the compressed file in text-reading mode
-            with lzma.open(zip, 'rt') as csv:
-                for chunk in pd.read_csv(csv, usecols=considered_columns.keys(), chunksize=100000):
-                    chunk = chunk.rename(columns=considered_columns)
-                    chunk["snapshot_date"] = snapshot_date
-                    table = pa.Table.from_pandas(chunk, preserve_index=False)
-                    if writer is None:
-                        writer = pq.ParquetWriter(output_filepath, table.schema)
-                    writer.write_table(table)
-                    final_data += len(chunk)
-            print(f" ** Processed {zip}")
-            processed_files.append(zip)
-        except (lzma.LZMAError, pd.errors.EmptyDataError, EOFError) as e:
-            print(f"!!ERROR: Failed to process {zip}. Error: {e}. Skipping file.")
-        except Exception as e:
-            print(f"!!ERROR: An unexpected error occurred with {zip}. Error: {e}. Skipping file.")
-
-    if writer:
-        writer.close()
-        print(f"\nCompleted parsing and combined {final_data} records. Saved the parsed data to {output_filepath}.\n")
-        if clean:
-            print("Cleaning up original .csv.xz files.")
-            for f_to_delete in processed_files:
-                try:
-                    os.remove(f_to_delete)
-                    print(f" * Deleted {f_to_delete}")
-                except OSError as e:
-                    print(f"!!ERROR: Could not delete {f_to_delete}. Error: {e}")
-        else:
-            print("Original .csv.xz files were not deleted as per --clean flag.")
+        except ValueError as e:
+            print(f"!!ERROR: Could not read the snapshot date of {', '.join(group)}. Error: {e}. Skipping.")
+            continue
+
+        frames = []
+        for zip in group:
+            print(f" ** Processing {zip}")
+            repo = snapshot_key(zip)[1]
+            try:
+                frames.append(read_snapshot_table(zip, snapshot_date, repo, engine))
+                print(f" ** Processed {zip}")
+                processed_files.append(zip)
+            except (lzma.LZMAError, pd.errors.EmptyDataError, EOFError) as e:
+                print(f"!!ERROR: Failed to process {zip}. Error: {e}. Skipping file.")
+            except Exception as e:
+                print(f"!!ERROR: An unexpected error occurred with {zip}. Error: {e}. Skipping file.")
+
+        # Days are written whole and in date order, so each day gets its own prefix-sorted row groups.
+        if len(frames) == 1:
+            writer.write(frames[0])
+        elif frames:
+            collapsed, duplicates = collapse_repos(frames)
+            collapsed_data += duplicates
+            print(f" ** Collapsed {duplicates} ROAs published under multiple repos for {date_part}")
+            writer.write(collapsed)
+
+    if writer.close():
+        print(f"\nCompleted parsing and combined {writer.rows} records ({collapsed_data} cross-repo duplicates collapsed). Saved the parsed data to {output_filepath}.\n")
+        if output_type == 'intervals':
+            print(f" * Stored {writer.rows} snapshot records as {writer.intervals} presence intervals.")
+        clean_files(processed_files, clean)
     
     else:
         print("\nNo data was written (writer was not initialized). No files will be deleted.")
 
 
-def main(file_directory, file_name, output_dir, output_filename, output_type, clean):
+def main(file_directory, file_name, output_dir, output_filename, output_type, clean, workers=1, engine='pandas', schema='legacy', append=False, derived_columns=None, target_asns=None):
 
     if file_directory is None and file_name is None:
         print("!!ERROR: Neither directory nor file path specified. Try again with either one of them.")
-    if output_type not in ['csv', 'parquet'] :
+    if output_type not in ['csv', 'parquet', 'dataset', 'intervals'] :
         print("!!ERROR: Invalid output type. Please try again.")
         print(output_type)
         return
+    if append and output_type != 'dataset':
+        print("!!ERROR: --append only works with --output_type dataset, where each new day becomes its own fragment.")
+        return
     
     os.makedirs(output_dir, exist_ok=True)
         
@@ -96,7 +181,28 @@ def main(file_directory, file_name, output_dir, output_filename, output_type, cl
         print(f" * In {file_directory}, found {len(zips)} files. Parsing now\n")
     
     
-    parse_csvs_and_save(zips,output_dir,output_filename,output_type, clean)
+    if engine not in ENGINES:
+        print(f"!!ERROR: Invalid engine '{engine}'. Pick from: {', '.join(ENGINES)}")
+        return
+    if schema not in SCHEMAS:
+        print(f"!!ERROR: Invalid schema '{schema}'. Pick from: {', '.join(SCHEMAS)}")
+        return
+    compact = schema == 'compact'
+    try:
+        derived = derived_column_names(derived_columns, target_asns)
+    except ValueError as e:
+        print(f"!!ERROR: {e}")
+        return
+
+    start_time = time.perf_counter()
+    if output_type == 'dataset':
+        parse_csvs_to_dataset(zips, output_dir, output_filename, clean, workers, engine, compact, append, derived)
+    else:
+        parse_csvs_and_save(zips,output_dir,output_filename,output_type, clean, engine, compact, derived)
+    elapsed = time.perf_counter() - start_time
+    # ru_maxrss is in KiB on Linux; worker processes of the dataset mode are reported under RUSAGE_CHILDREN.
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    print(f" * {engine} engine: parsed in {elapsed:.1f}s, peak RSS {peak_rss / 1024:.0f} MiB.")
 
 
 if __name__ == "__main__":
@@ -134,7 +240,7 @@ if __name__ == "__main__":
         '--output_type', 
         type=str, 
         default='parquet',
-        help="The output type of the file. Possible options are csv and parquet."
+        help="The output type of the file. Possible options are csv, parquet, dataset (a snapshot_date= partitioned Parquet directory) and intervals (one row per continuous presence of a ROA)."
     )
 
     parser.add_argument(
@@ -143,5 +249,48 @@ if __name__ == "__main__":
         help="If set, it deletes the original .csv.xz files after successful parsing."
     )
 
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=os.cpu_count(),
+        help="Number of worker processes parsing snapshots in parallel (only for --output_type dataset). Defaults to the number of CPUs."
+    )
+
+    parser.add_argument(
+        '--engine',
+        type=str,
+        default='pandas',
+        choices=ENGINES,
+        help="CSV parsing engine: 'pandas' (chunked pd.read_csv) or 'arrow' (Arrow's multithreaded streaming CSV reader on the raw xz bytes)."
+    )
+
+    parser.add_argument(
+        '--schema',
+        type=str,
+        default='legacy',
+        choices=SCHEMAS,
+        help="Column types of the output: 'legacy' (strings as in the CSV) or 'compact' (uint32 ASN, split prefix, uint8 max_len, parsed timestamps, date32 snapshot dates, dictionary-encoded strings)."
+    )
+
+    parser.add_argument(
+        '--append',
+        action='store_true',
+        help="With --output_type dataset, only ingest snapshot days not already in the dataset's ingest manifest, refusing duplicates."
+    )
+
+    parser.add_argument(
+        '--derived_columns',
+        type=str,
+        default=None,
+        help=f"Comma-separated columns to compute at ingest: {', '.join(DERIVED_FIELDS)} (repo_host is the host part of the URI)."
+    )
+
+    parser.add_argument(
+        '--target_asns',
+        type=str,
+        default=None,
+        help="Comma-separated ASNs (e.g. AS834) to flag at ingest; each adds a boolean is_as<N> column."
+    )
+
     args = parser.parse_args()
-    main(args.dir, args.file_path, args.output_dir, args.output_filename, args.output_type, args.clean)
+    main(args.dir, args.file_path, args.output_dir, args.output_filename, args.output_type, args.clean, args.workers, args.engine, args.schema, args.append, args.derived_columns, args.target_asns)
@@ -0,0 +1,90 @@
+# Logs every added, removed and modified ROA between consecutive snapshot days, over all columns of the ROA.
+
+import argparse
+import time
+import pandas as pd
+from roa_dataset import iter_snapshots, list_snapshot_dates, dataset_schema
+from roa_diff import Snapshot, diff_snapshots, ChangeLogWriter, FINGERPRINT_COLUMNS
+
+def main(input_file, output_file, start_date=None, end_date=None):
+    print("\n*************************************************************************************")
+    print("\n------------------------------- RPKI ROA DIFF ENGINE --------------------------------")
+    print("\n*************************************************************************************")
+
+    try:
+        print("Fetching date range.")
+        sorted_dates = list_snapshot_dates(input_file)
+        if start_date:
+            sorted_dates = [d for d in sorted_dates if d >= pd.to_datetime(start_date).date()]
+        if end_date:
+            sorted_dates = [d for d in sorted_dates if d <= pd.to_datetime(end_date).date()]
+        print(f" * Found {len(sorted_dates)} snapshot days to process.")
+        writer = ChangeLogWriter(output_file, dataset_schema(input_file))
+    except Exception as e:
+        print(f"!!ERROR: Could not read the input file '{input_file}' to get dates.")
+        print(e)
+        return
+
+    if len(sorted_dates) < 2:
+        print("!!ERROR: At least two snapshot days are needed for a diff.")
+        return
+
+    start_time = time.perf_counter()
+    prev = None
+    # One pass over the input: each day is read (the next one on a background thread while the current pair is
+    # diffed) and fingerprinted once, then kept as the previous day of the next diff.
+    for current_date, pending in iter_snapshots(input_file, columns=FINGERPRINT_COLUMNS, dates=sorted_dates):
+        try:
+            curr = Snapshot(current_date, pending.result())
+        except Exception as e:
+            print(f"!!ERROR: Could not load data for {current_date}. Skipping day. {e}")
+            continue
+
+        if prev is not None:
+            log = diff_snapshots(prev, curr)
+            writer.write(log)
+            counts = log['change'].value_counts()
+            print(f" ** For {current_date}: +{counts.get('added', 0)}, -{counts.get('removed', 0)}, ~{counts.get('modified', 0)}")
+        prev = curr
+
+    if writer.close():
+        elapsed = time.perf_counter() - start_time
+        print(f"\nSaved {writer.rows} changes to {output_file} ({elapsed:.1f}s).")
+    else:
+        print("\nNo changes were written.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Diffing RPKI ROA snapshots day over day")
+
+    # Output of roa-csv-parser file
+    parser.add_argument(
+        '--file',
+        type=str,
+        required=True,
+        help="The file path of the Parquet file (or dataset directory) which is to be diffed."
+    )
+
+    parser.add_argument(
+        '--output_file',
+        type=str,
+        required=True,
+        help="The file path of the change log: typed Parquet if it ends in .parquet, CSV otherwise."
+    )
+
+    parser.add_argument(
+        '--start_date',
+        type=str,
+        default=None,
+        help="First snapshot day (YYYY-MM-DD) to diff from. Defaults to the first day of the input."
+    )
+
+    parser.add_argument(
+        '--end_date',
+        type=str,
+        default=None,
+        help="Last snapshot day (YYYY-MM-DD) to diff to. Defaults to the last day of the input."
+    )
+
+    args = parser.parse_args()
+    main(args.file, args.output_file, args.start_date, args.end_date)
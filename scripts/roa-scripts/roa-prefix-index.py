@@ -0,0 +1,64 @@
+# This file builds the prefix point-lookup index (roa_prefix_index.py) of a ROA Parquet file, dataset directory or
+# interval file, and optionally looks up the history of a few prefixes through it.
+
+import argparse
+import time
+from roa_prefix_index import build_prefix_index, index_paths, PrefixLookup
+
+def main(input_file, prefixes, build):
+    print("\n*************************************************************************************")
+    print("\n------------------------- RPKI ROA PREFIX INDEX - BUILD ----------------------------")
+    print("\n*************************************************************************************")
+
+    if build:
+        try:
+            count = build_prefix_index(input_file)
+        except Exception as e:
+            print(f"!!ERROR: Could not build the prefix index of '{input_file}'. {e}")
+            return
+        clustered_path, index_path = index_paths(input_file)
+        print(f"\nSaved the prefix index of {count} prefixes to {index_path} (rows clustered by prefix in {clustered_path})")
+
+    try:
+        lookup = PrefixLookup(input_file)
+    except Exception as e:
+        print(f"!!ERROR: Could not open '{input_file}'. {e}")
+        return
+    if not lookup.indexed:
+        print(f"!WARNING: '{input_file}' has no usable prefix index; lookups scan the file with a prefix filter.")
+
+    for prefix in prefixes:
+        start = time.perf_counter()
+        rows = lookup.stored(prefix)
+        elapsed = time.perf_counter() - start
+        print(f"\n * {prefix}: {len(rows)} {'intervals' if lookup.intervals else 'rows'} in {elapsed * 1000:.1f} ms")
+        print(rows.to_string(index=False, max_rows=20))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Building a prefix point-lookup index of RPKI ROAs")
+
+    # Output of roa-csv-parser or roa-collection-prefix-match file
+    parser.add_argument(
+        '--file',
+        type=str,
+        required=True,
+        help="The Parquet file, dataset directory or interval file to index (or to look prefixes up in)."
+    )
+
+    parser.add_argument(
+        '--prefix',
+        type=str,
+        nargs='*',
+        default=[],
+        help="Prefixes to look up and print after building."
+    )
+
+    parser.add_argument(
+        '--no_build',
+        action='store_true',
+        help="Only look prefixes up in an existing index."
+    )
+
+    args = parser.parse_args()
+    main(args.file, args.prefix, not args.no_build)
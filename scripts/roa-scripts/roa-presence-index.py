@@ -0,0 +1,69 @@
+# This file builds the prefix x day presence index (roa_presence.py) of a ROA Parquet file and prints a few
+# statistics from it.
+
+import argparse
+from roa_presence import build_presence_index, PresenceIndex
+
+def main(input_file, index_dir, target_asn, flap_threshold):
+    print("\n*************************************************************************************")
+    print("\n------------------------ RPKI ROA PRESENCE INDEX - BUILD ---------------------------")
+    print("\n*************************************************************************************")
+
+    if input_file is not None:
+        try:
+            days = build_presence_index(input_file, index_dir, target_asn)
+        except Exception as e:
+            print(f"!!ERROR: Could not build the presence index of '{input_file}'. {e}")
+            return
+        print(f"\nSaved the presence index of {days} snapshot days to {index_dir}")
+
+    try:
+        index = PresenceIndex(index_dir)
+    except Exception as e:
+        print(f"!!ERROR: Could not open the presence index in '{index_dir}'. {e}")
+        return
+
+    print(f" * {len(index.prefixes)} prefixes and {len(index.pairs)} (prefix, asn) pairs over {len(index.dates)} snapshot days.")
+    authorized = index.lifetimes('target')
+    authorized = authorized[authorized > 0]
+    print(f" * {len(authorized)} prefixes were authorized to {index.target_asn}, for {authorized.mean() if len(authorized) else 0:.1f} days on average.")
+    flapping = index.flapping(flap_threshold, 'target')
+    print(f" * {len(flapping)} prefixes flapped (to {index.target_asn}) more than {flap_threshold} times.")
+    print("\nEvents per day:")
+    print(index.event_counts().to_string(index=False))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Building a prefix x day presence index of RPKI ROAs")
+
+    # Output of roa-csv-parser file
+    parser.add_argument(
+        '--file', 
+        type=str, 
+        default=None,
+        help="The file path of the Parquet file to index. Without it, an existing index is only queried."
+    )
+
+    parser.add_argument(
+        '--index_dir', 
+        type=str, 
+        required=True,
+        help="The directory the index is written to (or read from)."
+    )
+
+    parser.add_argument(
+        '--target_asn', 
+        type=str, 
+        default='AS834',
+        help="The ASN whose authorizations get their own bitset."
+    )
+
+    parser.add_argument(
+        '--flap_threshold', 
+        type=int, 
+        default=1,
+        help="Report prefixes whose target authorization came back more than this many times."
+    )
+
+    args = parser.parse_args()
+    main(args.file, args.index_dir, args.target_asn.upper(), args.flap_threshold)
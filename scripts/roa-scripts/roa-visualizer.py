@@ -1,40 +1,86 @@
 import argparse
 import pandas as pd
+import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 import seaborn as sns
 import os
-
-def compute_intervals(example_df):
-    # Given per-day ROA snapshot rows, compute continuous intervals per ASN
-    example_df = example_df.sort_values("snapshot_date")
-    intervals = []
-    for asn, group in example_df.groupby("asn"):
-        group = group.sort_values("snapshot_date")
-
-        start = group['snapshot_date'].iloc[0]
-        prev = start
-
-        for current in group['snapshot_date'].iloc[1:]:
-            if (current - prev).days > 1:
-                intervals.append((asn, start, prev))
-                start = current
-            prev = current
-        intervals.append((asn, start, prev))
-
-    return pd.DataFrame(intervals, columns=["asn", "start", "end"])
-
-def timeline_plot(df, output_dir):
+from functools import cached_property
+from concurrent.futures import ProcessPoolExecutor
+from roa_dataset import read_roas
+from roa_islands import find_islands, island_days, load_islands, prefix_islands, select_islands
+from roa_prefix_index import PrefixLookup, prefix_rows
+from roa_events import read_events
+
+BASE_COLUMNS = ['snapshot_date', 'prefix', 'asn', 'max_len']
+
+class HistoryCube:
+    # The history file's rows deduplicated once on the columns the selected plots need (some of BASE_COLUMNS), and
+    # the aggregates the plots share, each computed on first use.
+
+    def __init__(self, base, islands=None):
+        self.base = base
+        self.given_islands = islands
+
+    @cached_property
+    def pairs(self):
+        # Distinct (prefix, asn), in order of first appearance.
+        return self.base[['prefix', 'asn']].drop_duplicates()
+
+    @cached_property
+    def roas(self):
+        # Distinct (prefix, asn, max_len).
+        return self.base[['prefix', 'asn', 'max_len']].drop_duplicates()
+
+    @cached_property
+    def asns_per_prefix(self):
+        return self.pairs.groupby('prefix', observed=True).size()
+
+    @cached_property
+    def roas_per_prefix(self):
+        return self.roas.groupby('prefix', observed=True).size()
+
+    @cached_property
+    def roas_per_day(self):
+        return self.base.groupby('snapshot_date').size()
+
+    @cached_property
+    def daily_roas_per_prefix(self):
+        return self.base.groupby(['snapshot_date', 'prefix'], observed=True).size()
+
+    @cached_property
+    def islands(self):
+        return self.given_islands if self.given_islands is not None else find_islands(self.base)
+
+    @cached_property
+    def most_common_prefix(self):
+        # The prefix with the most distinct origin ASNs (the first of them on a tie).
+        return self.pairs['prefix'].value_counts().index[0]
+
+    def part(self, names):
+        # A cube holding only the given aggregates, computed here, e.g. to send to a worker process.
+        part = HistoryCube(None)
+        part.__dict__.update({name: getattr(self, name) for name in names})
+        return part
+
+def timeline_plot(cube, output_dir, lookup, islands=None):
+    # lookup: a PrefixLookup of the history file, so only the chosen prefix's rows are read from disk (or those rows
+    # already read, keyed by prefix); islands: the load_islands() table of the history file, so its intervals are not
+    # recomputed.
     print("\n ** Generating ROA timeline with merged intervals")
 
-    unique_pairs = df[['prefix', 'asn']].drop_duplicates()
-    most_common_prefix = unique_pairs['prefix'].value_counts().index[0]
-    example_df = df[df['prefix'] == most_common_prefix].copy()
+    most_common_prefix = cube.most_common_prefix
+    example_df = prefix_rows(lookup, most_common_prefix, columns=['snapshot_date', 'asn']).copy()
 
     # Ensure datetime
     example_df['snapshot_date'] = pd.to_datetime(example_df['snapshot_date'])
+    # Compact histories carry a categorical ASN covering every prefix; only this prefix's ASNs should be plotted.
+    example_df['asn'] = example_df['asn'].astype(str)
 
-    intervals = compute_intervals(example_df)
+    if islands is not None:
+        intervals = prefix_islands(islands, most_common_prefix)
+    else:
+        intervals = find_islands(example_df, by=['asn'])
     print(f"\n--- Computed Intervals for {most_common_prefix} ---")
     print(intervals.sort_values("start").to_string(index=False)) 
     print("---------------------------------------------------\n")
@@ -87,21 +133,11 @@ def timeline_plot(df, output_dir):
     plt.savefig(out_path, dpi=200)
     print(f" *** Saved interval timeline to: {out_path}\n")
 
-def observed_distribution_lifetime(df, output_dir):
+def observed_distribution_lifetime(cube, output_dir):
     print("\n ** CDF for Continuous ROA Lifetimes")
 
-    unique_cols = ['prefix', 'asn', 'max_len']
-    df_sorted = df[unique_cols + ['snapshot_date']].drop_duplicates().sort_values(by=unique_cols + ['snapshot_date'])
-    df_sorted['snapshot_date'] = pd.to_datetime(df_sorted['snapshot_date'])
-    df_sorted['prev_date'] = df_sorted.groupby(unique_cols)['snapshot_date'].shift(1)
-    df_sorted['gap'] = (df_sorted['snapshot_date'] - df_sorted['prev_date']).dt.days
-    df_sorted['new_island'] = ((df_sorted['gap'] > 1) | (df_sorted['gap'].isna())).astype(int)
-    df_sorted['island_id'] = df_sorted.groupby(unique_cols)['new_island'].cumsum()
-
-    island_lifetimes = df_sorted.groupby(unique_cols + ['island_id'])['snapshot_date'].agg(['min','max']).reset_index()
-    island_lifetimes['lifetime_days'] = (island_lifetimes['max'] - island_lifetimes['min']).dt.days + 1
-
-    lifetimes = island_lifetimes['lifetime_days'].sort_values().values
+    # One island per continuous run of a (prefix, asn, max_len) ROA.
+    lifetimes = island_days(cube.islands).sort_values().values
     cdf = (pd.Series(range(1, len(lifetimes)+1))) / len(lifetimes)
 
     plt.figure(figsize=(12,6))
@@ -115,16 +151,10 @@ def observed_distribution_lifetime(df, output_dir):
     plt.savefig(os.path.join(output_dir, "cdf_continuous_lifetime.png"))
     print(" *** CDF Plot Generated!")
 
-def unique_asns_per_prefix(df, output_dir):
+def unique_asns_per_prefix(cube, output_dir):
     print("\n ** CDF: Unique ASNs per Prefix")
 
-    asn_per_prefix = (
-        df.groupby('prefix')['asn']
-          .nunique()
-          .reset_index(name='asn_count')
-    )
-
-    counts = asn_per_prefix['asn_count'].sort_values().values
+    counts = cube.asns_per_prefix.sort_values().values
     cdf = pd.Series(range(1, len(counts)+1)) / len(counts)
 
     plt.figure(figsize=(12,6))
@@ -139,15 +169,8 @@ def unique_asns_per_prefix(df, output_dir):
     print(" *** CDF Plot Generated!")
 
 
-def unique_roas_over_time(df, output_dir):
-    active_counts = (
-        df[['snapshot_date', 'max_len', 'asn', 'prefix']]
-        .drop_duplicates()
-        .groupby('snapshot_date')
-        .size()
-        .reset_index(name='distinct_roas')
-        .sort_values('snapshot_date')
-    )
+def unique_roas_over_time(cube, output_dir):
+    active_counts = cube.roas_per_day.reset_index(name='distinct_roas').sort_values('snapshot_date')
 
     plt.figure(figsize=(12, 6))
     plt.plot(active_counts['snapshot_date'], active_counts['distinct_roas'],
@@ -166,7 +189,9 @@ def unique_roas_over_time(df, output_dir):
 def plot_churn_timeline_from_events(event_csv, output_dir):
     print(" ** Plotting Churn Timeline from Event Log")
 
-    event_df = pd.read_csv(event_csv)
+    # Only the two columns plotted, from either a CSV or a Parquet event log.
+    event_df = read_events(event_csv, columns=['date', 'event'])
+    event_df['event'] = event_df['event'].astype(str)
 
     event_df['date'] = pd.to_datetime(event_df['date'], errors='coerce')
     churn_summary = (
@@ -192,17 +217,10 @@ def plot_churn_timeline_from_events(event_csv, output_dir):
     plt.savefig(path)
     print(f" *** Plot saved to {path}")
 
-def cdf_roas_per_prefix(df, output_dir):
+def cdf_roas_per_prefix(cube, output_dir):
     print("\n ** Generating CDF for Number of ROAs per Prefix (unique by prefix-asn-max_len)")
 
-    unique_df = df[['prefix', 'asn', 'max_len']].drop_duplicates()
-
-    roas_per_prefix = (
-        unique_df.groupby('prefix')
-                 .size()
-                 .reset_index(name='roa_count')
-                 .sort_values('roa_count')
-    )
+    roas_per_prefix = cube.roas_per_prefix.reset_index(name='roa_count').sort_values('roa_count')
 
     print(f" *** Processed {len(roas_per_prefix)} prefixes across dataset.")
     print(" *** Median number of ROAs per prefix:",
@@ -225,19 +243,14 @@ def cdf_roas_per_prefix(df, output_dir):
     plt.savefig(path)
     print(f" *** CDF Plot saved to {path}")
 
-def cdf_median_roas_per_prefix(df, output_dir):
+def cdf_median_roas_per_prefix(cube, output_dir):
     print("\n ** Generating CDF for Median Number of ROAs per Prefix (unique prefix-asn-max_len per day)")
 
-    dedup = df[['snapshot_date', 'prefix', 'asn', 'max_len']].drop_duplicates()
-
-    daily_counts = (
-        dedup.groupby(['snapshot_date', 'prefix'])
-             .size()   # counts unique (asn,max_len)
-             .reset_index(name='roa_count')
-    )
+    # Counts unique (asn, max_len) per day and prefix.
+    daily_counts = cube.daily_roas_per_prefix.reset_index(name='roa_count')
 
     medians = (
-        daily_counts.groupby('prefix')['roa_count']
+        daily_counts.groupby('prefix', observed=True)['roa_count']
                     .median()
                     .reset_index()
     )
@@ -259,19 +272,20 @@ def cdf_median_roas_per_prefix(df, output_dir):
     plt.savefig(path)
     print(f" *** CDF Plot saved to {path}")
 
-def avg_roa_duration_per_asn(df, output_dir):
+def avg_roa_duration_per_asn(cube, output_dir):
     print("\n ** CDF: Average Active ROA Duration per ASN (Robust)")
 
-    df['date_only'] = pd.to_datetime(df['snapshot_date']).dt.normalize()
-
+    islands = cube.islands
+    # Distinct days of a (prefix, asn, max_len) ROA: the days of its islands.
     roa_lifetimes = (
-        df.groupby(['prefix', 'asn', 'max_len'])['date_only']
-          .nunique() # Counts distinct days only
-          .reset_index(name='active_days')
+        islands.assign(active_days=island_days(islands))
+               .groupby(['prefix', 'asn', 'max_len'], observed=True)['active_days']
+               .sum()
+               .reset_index(name='active_days')
     )
 
     avg_lifetime = (
-        roa_lifetimes.groupby('asn')['active_days']
+        roa_lifetimes.groupby('asn', observed=True)['active_days']
                      .mean()
                      .reset_index(name='avg_days')
     )
@@ -290,33 +304,95 @@ def avg_roa_duration_per_asn(df, output_dir):
     plt.savefig(os.path.join(output_dir, "cdf_avg_active_duration_robust.png"))
     print(" *** CDF Plot Generated!")
 
-def main(history_file, output_dir, event_csv):
+# Plots in the order they are rendered, with the history columns each one needs (islands come from their cache).
+PLOTS = {
+    'lifetime': [],
+    'asns_per_prefix': ['prefix', 'asn'],
+    'roas_over_time': BASE_COLUMNS,
+    'churn': [],
+    'roas_per_prefix': ['prefix', 'asn', 'max_len'],
+    'median_roas_per_prefix': BASE_COLUMNS,
+    'asn_duration': [],
+    'timeline': ['prefix', 'asn'],
+}
+ISLAND_PLOTS = ['lifetime', 'asn_duration', 'timeline']
+# The cube aggregates each plot draws; a plot rendered in a worker process is sent only these.
+PLOT_INPUTS = {
+    'lifetime': ['islands'],
+    'asns_per_prefix': ['asns_per_prefix'],
+    'roas_over_time': ['roas_per_day'],
+    'churn': [],
+    'roas_per_prefix': ['roas_per_prefix'],
+    'median_roas_per_prefix': ['daily_roas_per_prefix'],
+    'asn_duration': ['islands'],
+    'timeline': ['most_common_prefix'],
+}
+
+def render_plot(plot, cube, output_dir, event_csv=None, lookup=None, islands=None):
+    renderers = {
+        'lifetime': lambda: observed_distribution_lifetime(cube, output_dir),
+        'asns_per_prefix': lambda: unique_asns_per_prefix(cube, output_dir),
+        'roas_over_time': lambda: unique_roas_over_time(cube, output_dir),
+        'churn': lambda: plot_churn_timeline_from_events(event_csv, output_dir),
+        'roas_per_prefix': lambda: cdf_roas_per_prefix(cube, output_dir),
+        'median_roas_per_prefix': lambda: cdf_median_roas_per_prefix(cube, output_dir),
+        'asn_duration': lambda: avg_roa_duration_per_asn(cube, output_dir),
+        'timeline': lambda: timeline_plot(cube, output_dir, lookup, islands),
+    }
+    renderers[plot]()
+
+def plot_slice(plot, cube, output_dir, event_csv, lookup, islands):
+    # render_plot() arguments holding only what the plot draws: its aggregates and, for the timeline, the rows and
+    # islands of its one prefix.
+    if plot != 'timeline':
+        return plot, cube.part(PLOT_INPUTS[plot]), output_dir, event_csv
+    prefix = cube.most_common_prefix
+    rows = {prefix: prefix_rows(lookup, prefix, columns=['snapshot_date', 'asn'])}
+    return plot, cube.part(PLOT_INPUTS[plot]), output_dir, None, rows, select_islands(islands, [prefix]) if islands is not None else None
+
+def main(history_file, output_dir, event_csv, plots=list(PLOTS), workers=1):
     print("\n*************************************************************************************")
     print("\n-------------------------- RPKI ROA HISTORY VISUALIZER ----------------------------")
     print("\n*************************************************************************************")
     print(f"Loading data from: {history_file}")
+    plots = [name for name in PLOTS if name in plots]
+    if 'churn' in plots and event_csv is None:
+        print("!WARNING: No event file given; skipping the churn timeline.")
+        plots.remove('churn')
+    # Only the columns the selected plots need are read, and the rows are deduplicated on them once.
+    columns = [name for name in BASE_COLUMNS if any(name in PLOTS[plot] for plot in plots)]
     try:
-        df = pd.read_parquet(history_file)
-        df['snapshot_date'] = pd.to_datetime(df['snapshot_date']).dt.date
-        print(f" * Successfully loaded {len(df):,} total historical records.")
+        base = None
+        if columns:
+            df = read_roas(history_file, columns=columns)
+            print(f" * Successfully loaded {len(df):,} total historical records.")
+            base = df.drop_duplicates()
+            del df
+        lookup = PrefixLookup(history_file) if 'timeline' in plots else None
+        # Islands of every (prefix, asn, max_len), computed once and cached next to the history file.
+        islands = load_islands(history_file) if any(plot in ISLAND_PLOTS for plot in plots) else None
     except Exception as e:
         print(f"!!ERROR: Could not read the history file '{history_file}'.")
         print(e)
         return
+    cube = HistoryCube(base, islands)
     
     os.makedirs(output_dir, exist_ok=True)
     print(f" * Plots will be saved to: {output_dir}")
 
     # Plots
     # scatter_plot_for_prefix(df, output_dir)
-    observed_distribution_lifetime(df, output_dir)
-    unique_asns_per_prefix(df, output_dir)
-    unique_roas_over_time(df, output_dir)
-    plot_churn_timeline_from_events(event_csv, output_dir)
-    cdf_roas_per_prefix(df, output_dir)
-    cdf_median_roas_per_prefix(df, output_dir)
-    avg_roa_duration_per_asn(df, output_dir)
-    timeline_plot(df, output_dir)
+    if workers > 1 and len(plots) > 1:
+        # Each plot is rendered (headless) in a worker process that is sent only the aggregates it draws; the
+        # shared ones are still computed once, here.
+        print(f" * Rendering {len(plots)} plots on {workers} worker processes.")
+        with ProcessPoolExecutor(max_workers=workers, initializer=matplotlib.use, initargs=('Agg',)) as executor:
+            futures = [executor.submit(render_plot, *plot_slice(plot, cube, output_dir, event_csv, lookup, islands)) for plot in plots]
+            for future in futures:
+                future.result()
+    else:
+        for plot in plots:
+            render_plot(plot, cube, output_dir, event_csv, lookup, islands)
 
     print("\nAnalysis complete.")
 
@@ -327,14 +403,14 @@ if __name__ == "__main__":
         '--history_file', 
         type=str, 
         required=True,
-        help="Path to the Parquet file from 'roa-collection-prefix-match' (with all records)."
+        help="Path to the Parquet file from 'roa-collection-prefix-match' (with all records), or an interval file from roa-csv-parser.py --output_type intervals."
     )
 
     parser.add_argument(
         '--event_file', 
         type=str, 
-        required=True,
-        help="Event file having all IPXO related ROA dated."
+        default=None,
+        help="Event file having all IPXO related ROA dated (needed for the churn plot)."
     )
     
     parser.add_argument(
@@ -344,5 +420,21 @@ if __name__ == "__main__":
         help="Directory to save the output .png plot files."
     )
 
+    parser.add_argument(
+        '--plots', 
+        type=str, 
+        nargs='+',
+        choices=list(PLOTS),
+        default=list(PLOTS),
+        help="Plots to render (all by default); only the columns they need are read."
+    )
+
+    parser.add_argument(
+        '--workers', 
+        type=int, 
+        default=1,
+        help="Number of worker processes; with more than one, the plots are rendered in parallel."
+    )
+
     args = parser.parse_args()
-    main(args.history_file, args.output_dir, args.event_file)
\ No newline at end of file
+    main(args.history_file, args.output_dir, args.event_file, args.plots, args.workers)
\ No newline at end of file
@@ -0,0 +1,600 @@
+# Shared helpers for turning ROA CSV snapshots into the consolidated Parquet dataset.
+# Used by roa-csv-parser.py and by the streaming mode of roa-csv-fetch.py.
+
+import os
+import re
+import json
+import lzma
+import socket
+import inspect
+from datetime import date
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+import pyarrow.csv as pacsv
+import pyarrow.compute as pc
+
+considered_columns = {
+    'URI': 'uri',
+    'ASN': 'asn',
+    'IP Prefix': 'prefix',
+    'Max Length': 'max_len',
+    'Not Before': 'not_before',
+    'Not After': 'not_after'
+}
+
+DEFAULT_REPO = 'ripencc.tal'
+CHUNK_ROWS = 100000
+ENGINES = ['pandas', 'arrow']
+SCHEMAS = ['legacy', 'compact']
+ARROW_BLOCK_SIZE = 1 << 20
+
+# Schema of every fragment of a partitioned dataset; snapshot_date lives in the snapshot_date=<yyyy-mm-dd> directory name.
+ROA_SCHEMA = pa.schema([
+    ('uri', pa.string()),
+    ('asn', pa.string()),
+    ('prefix', pa.string()),
+    ('max_len', pa.int64()),
+    ('not_before', pa.string()),
+    ('not_after', pa.string()),
+    ('repo', pa.string()),
+])
+# Opt-in compact schema: numeric ASNs, the prefix split into address family and length next to the dictionary-encoded
+# prefix text (network bytes are derived per distinct prefix with parse_prefix() instead of being stored per row),
+# parsed validity timestamps and date32 snapshot dates. Written with zstd.
+COMPACT_SCHEMA = pa.schema([
+    ('uri', pa.dictionary(pa.int32(), pa.string())),
+    ('asn', pa.uint32()),
+    ('prefix', pa.dictionary(pa.int32(), pa.string())),
+    ('af', pa.uint8()),
+    ('prefix_len', pa.uint8()),
+    ('max_len', pa.uint8()),
+    ('not_before', pa.timestamp('s')),
+    ('not_after', pa.timestamp('s')),
+    ('repo', pa.dictionary(pa.int32(), pa.string())),
+])
+TIMESTAMP_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S']
+COMPACT_COMPRESSION = 'zstd'
+# Footer key listing the snapshot dates of a consolidated file, so date discovery is a metadata read.
+DATES_METADATA_KEY = 'roa.snapshot_dates'
+BLOOM_FILTER_FPP = 0.01
+WRITER_PARAMETERS = set(inspect.signature(pq.ParquetWriter.__init__).parameters)
+# Columns read by read_roas() when none are asked for; split prefix columns are only read on request.
+DEFAULT_COLUMNS = list(considered_columns.values()) + ['snapshot_date', 'repo']
+# Without an explicit type, the partition key would be inferred as a string and date filters would not match it.
+PARTITIONING = ds.partitioning(pa.schema([('snapshot_date', pa.date32())]), flavor='hive')
+FRAGMENT_FILENAME = 'part-0.parquet'
+# Optional columns computed at ingest so analyzers can filter on cheap typed columns instead of strings.
+# Besides these, every target ASN gets a boolean is_as<N> column (see target_flag_column()).
+DERIVED_FIELDS = {
+    'af': pa.uint8(),
+    'prefix_len': pa.uint8(),
+    'repo_host': pa.dictionary(pa.int32(), pa.string()),
+}
+TARGET_FLAG_PATTERN = re.compile(r'^is_as(\d+)$')
+URI_HOST_PATTERN = r'^[A-Za-z][A-Za-z0-9+.-]*://(?P<host>[^/]*)'
+# Lives in the dataset directory; the leading underscore keeps dataset discovery from treating it as data.
+INGEST_MANIFEST_FILENAME = '_ingest_manifest.json'
+
+def snapshot_key(zip):
+    # File names are <yyyymmdd>_<repo>_roas.csv.xz; older downloads (<yyyymmdd>_roas.csv.xz) were RIPE only.
+    parts = os.path.basename(zip).split('_')
+    repo = parts[1] if len(parts) > 2 else DEFAULT_REPO
+    return parts[0], repo
+
+
+def read_snapshot_chunks(source, snapshot_date, repo):
+    # source is either a path to a .csv.xz file or a binary stream of xz-compressed CSV (e.g. an HTTP body).
+    # Open the compressed file in text-reading mode
+    with lzma.open(source, 'rt') as csv:
+        for chunk in pd.read_csv(csv, usecols=considered_columns.keys(), chunksize=CHUNK_ROWS):
+            chunk = chunk.rename(columns=considered_columns)
+            chunk["snapshot_date"] = snapshot_date
+            chunk["repo"] = repo
+            yield chunk
+
+
+def read_snapshot_batches(source, snapshot_date, repo):
+    # Arrow engine: the xz stream is read as bytes and parsed by Arrow's multithreaded streaming CSV reader.
+    # The header is renamed and the considered columns projected at read time, yielding Arrow tables directly.
+    with lzma.open(source, 'rb') as raw:
+        header = raw.readline().decode('utf-8').rstrip('\r\n').split(',')
+        column_names = [considered_columns.get(name, name) for name in header]
+        reader = pacsv.open_csv(
+            raw,
+            read_options=pacsv.ReadOptions(column_names=column_names, block_size=ARROW_BLOCK_SIZE),
+            convert_options=pacsv.ConvertOptions(
+                include_columns=list(considered_columns.values()),
+                column_types={field.name: field.type for field in ROA_SCHEMA if field.name in considered_columns.values()},
+            ),
+        )
+        date_value = pa.scalar(snapshot_date)
+        repo_value = pa.scalar(repo, pa.string())
+        # Small blocks keep memory low; batches are coalesced so row groups keep the pandas engine's CHUNK_ROWS size.
+        pending, pending_rows = [], 0
+        for batch in reader:
+            pending.append(pa.RecordBatch.from_arrays(
+                batch.columns + [pa.repeat(date_value, batch.num_rows), pa.repeat(repo_value, batch.num_rows)],
+                names=batch.schema.names + ['snapshot_date', 'repo'],
+            ))
+            pending_rows += batch.num_rows
+            if pending_rows >= CHUNK_ROWS:
+                table = pa.Table.from_batches(pending)
+                yield table.slice(0, CHUNK_ROWS)
+                pending = table.slice(CHUNK_ROWS).to_batches()
+                pending_rows -= CHUNK_ROWS
+        if pending:
+            yield pa.Table.from_batches(pending)
+
+
+def read_snapshot(source, snapshot_date, repo, engine='pandas'):
+    # Yields DataFrame chunks (pandas engine) or Arrow tables (arrow engine); the writers below accept both.
+    if engine == 'arrow':
+        return read_snapshot_batches(source, snapshot_date, repo)
+    return read_snapshot_chunks(source, snapshot_date, repo)
+
+
+def read_snapshot_table(source, snapshot_date, repo, engine='pandas'):
+    # Whole snapshot as one Arrow table, for callers that need all of a day at once.
+    return pa.concat_tables(to_table(chunk) for chunk in read_snapshot(source, snapshot_date, repo, engine))
+
+
+def to_table(chunk, schema=None):
+    if isinstance(chunk, pd.DataFrame):
+        if schema is not None:
+            chunk = chunk[schema.names]
+        return pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+    table = pa.Table.from_batches([chunk]) if isinstance(chunk, pa.RecordBatch) else chunk
+    if schema is not None:
+        table = table.select(schema.names).cast(schema)
+    return table
+
+
+def collapse_repos(frames):
+    # The same ROA can be published under several TALs; its rows from different repos become one row listing every
+    # TAL it was seen under. Repeats of a ROA within one repo are kept, as on single-repo days: the n-th copy from
+    # each repo is collapsed with the n-th copies from the others. Repos are summed as bits per group (Arrow
+    # group-bys, nothing per ROA in Python) and the distinct bit sets are then turned into sorted TAL lists.
+    table = pa.concat_tables([to_table(frame) for frame in frames])
+    group_cols = list(considered_columns.values()) + ["snapshot_date"]
+    repos = sorted(pc.unique(table['repo']).to_pylist())
+    bits = pc.shift_left(pa.scalar(1, pa.int64()), pc.cast(pc.index_in(table['repo'], value_set=pa.array(repos, pa.string())), pa.int64()))
+    copies = (table.select(group_cols).append_column('bit', bits)
+                   .group_by(group_cols + ['bit'], use_threads=False).aggregate([([], 'count_all')]))
+    collapsed = []
+    for n in range(pc.max(copies['count_all']).as_py() or 0):
+        # ROAs with an n-th copy in at least one repo, with the repos that have one.
+        nth = copies.filter(pc.greater(copies['count_all'], n))
+        collapsed.append(nth.group_by(group_cols, use_threads=False).aggregate([('bit', 'sum')]))
+    collapsed = pa.concat_tables(collapsed) if collapsed else copies.select(group_cols).append_column('bit_sum', copies['bit'])
+    masks = pc.unique(collapsed['bit_sum'])
+    names = pa.array([','.join(repo for k, repo in enumerate(repos) if mask >> k & 1) for mask in masks.to_pylist()], pa.string())
+    collapsed = collapsed.select(group_cols).append_column('repo', pc.take(names, pc.index_in(collapsed['bit_sum'], value_set=masks)))
+    return collapsed, len(table) - len(collapsed)
+
+
+def parse_prefix(text):
+    # 'a.b.c.d/len' or 'x:y::/len' -> (address family, network as 16 left-aligned bytes, length)
+    address, _, length = text.partition('/')
+    if ':' in address:
+        return 6, socket.inet_pton(socket.AF_INET6, address), int(length) if length else 128
+    return 4, socket.inet_pton(socket.AF_INET, address).ljust(16, b'\0'), int(length) if length else 32
+
+
+def split_prefixes(prefixes):
+    # Returns the dictionary-encoded prefix plus its address family and length.
+    # Every distinct prefix is parsed once, the results are then taken per row.
+    encoded = prefixes.dictionary_encode().combine_chunks() if isinstance(prefixes, pa.ChunkedArray) else prefixes.dictionary_encode()
+    parsed = [parse_prefix(text) for text in encoded.dictionary.to_pylist()]
+    return (
+        encoded,
+        pa.array([af for af, _, _ in parsed], pa.uint8()).take(encoded.indices),
+        pa.array([length for _, _, length in parsed], pa.uint8()).take(encoded.indices),
+    )
+
+
+def parse_timestamps(values, column='timestamp'):
+    # Values matching none of TIMESTAMP_FORMATS become nulls; they are counted (empty or missing values aside) and
+    # reported, so a format change upstream does not go unnoticed as a column of nulls.
+    parsed = pc.coalesce(*[pc.strptime(values, format=fmt, unit='s', error_is_null=True) for fmt in TIMESTAMP_FORMATS])
+    failed = pc.and_(pc.is_null(parsed), pc.invert(pc.fill_null(pc.equal(values, ''), True)))
+    count = pc.sum(failed).as_py() or 0
+    if count:
+        examples = pc.unique(pc.filter(values, failed)).to_pylist()[:3]
+        print(f"!WARNING: {count} {column} values could not be parsed and are stored as null (e.g. {examples}).")
+    return parsed
+
+
+def compact_table(table):
+    # Converts a legacy (string-typed) table to COMPACT_SCHEMA; a snapshot_date column, if present, becomes date32.
+    prefix, af, prefix_len = split_prefixes(table['prefix'])
+    columns = {
+        'uri': table['uri'].dictionary_encode(),
+        'asn': pc.replace_substring_regex(table['asn'], pattern='^AS', replacement='').cast(pa.uint32()),
+        'prefix': prefix,
+        'af': af,
+        'prefix_len': prefix_len,
+        'max_len': table['max_len'].cast(pa.uint8()),
+        'not_before': parse_timestamps(table['not_before'], 'not_before'),
+        'not_after': parse_timestamps(table['not_after'], 'not_after'),
+    }
+    fields = list(COMPACT_SCHEMA)
+    if 'snapshot_date' in table.column_names:
+        columns['snapshot_date'] = table['snapshot_date'].cast(pa.date32())
+        fields.insert(COMPACT_SCHEMA.get_field_index('repo'), pa.field('snapshot_date', pa.date32()))
+    columns['repo'] = table['repo'].dictionary_encode()
+    schema = pa.schema(fields)
+    return pa.Table.from_arrays([columns[field.name] for field in schema], schema=schema)
+
+
+def target_flag_column(asn):
+    # 'AS834' or 834 -> 'is_as834'
+    return f"is_as{int(str(asn).upper().removeprefix('AS'))}"
+
+
+def derived_column_names(derived_columns, target_asns):
+    # Validated list of derived columns from the comma-separated --derived_columns/--target_asns options.
+    names = [name.strip() for name in (derived_columns or '').split(',') if name.strip()]
+    for name in names:
+        if name not in DERIVED_FIELDS:
+            raise ValueError(f"Unknown derived column '{name}'. Pick from: {', '.join(DERIVED_FIELDS)}")
+    names += [target_flag_column(asn.strip()) for asn in (target_asns or '').split(',') if asn.strip()]
+    return list(dict.fromkeys(names))
+
+
+def derived_field(name):
+    return pa.field(name, DERIVED_FIELDS[name] if name in DERIVED_FIELDS else pa.bool_())
+
+
+def add_derived_columns(table, derived):
+    # Appends the derived columns to a legacy or compact table; columns it already has (e.g. af and prefix_len
+    # of the compact schema) are left as they are.
+    for name in derived:
+        if name in table.column_names:
+            continue
+        if name in ('af', 'prefix_len'):
+            _, af, prefix_len = split_prefixes(table['prefix'])
+            column = af if name == 'af' else prefix_len
+        elif name == 'repo_host':
+            uri = table['uri'].cast(pa.string())
+            column = pc.struct_field(pc.extract_regex(uri, URI_HOST_PATTERN), [0]).dictionary_encode()
+        else:
+            asn = int(TARGET_FLAG_PATTERN.match(name).group(1))
+            target = asn if pa.types.is_integer(table.schema.field('asn').type) else f"AS{asn}"
+            column = pc.fill_null(pc.equal(table['asn'], target), False)
+        field = derived_field(name)
+        table = table.append_column(field, column.cast(field.type))
+    return table
+
+
+def writer_options(schema, compact, sort_columns):
+    # Column statistics, page indexes, a prefix bloom filter and the sort order are written where pyarrow supports them.
+    options = {'compression': COMPACT_COMPRESSION if compact else 'snappy', 'write_statistics': True}
+    if 'write_page_index' in WRITER_PARAMETERS:
+        options['write_page_index'] = True
+    if 'bloom_filter_options' in WRITER_PARAMETERS:
+        options['bloom_filter_options'] = {'prefix': {'ndv': CHUNK_ROWS, 'fpp': BLOOM_FILTER_FPP}}
+    if 'sorting_columns' in WRITER_PARAMETERS and hasattr(pq.SortingColumn, 'from_ordering'):
+        options['sorting_columns'] = pq.SortingColumn.from_ordering(schema, [(name, 'ascending') for name in sort_columns])
+    return options
+
+
+def sort_day(table):
+    # Rows of a day are ordered by prefix so row-group and page statistics on prefix are selective.
+    keys = [name for name in ['snapshot_date', 'prefix'] if name in table.column_names]
+    return table.sort_by([(name, 'ascending') for name in keys])
+
+
+class SnapshotWriter:
+    # Appends whole snapshot days to a single Parquet file in the order they are written (callers go by date).
+    # Each day is sorted by prefix and starts its own row groups, so per-day filters prune to exactly that day.
+    # The schema is taken from the first day; derived columns (derived_column_names()) are appended to every day.
+
+    def __init__(self, output_filepath, compact=False, derived=()):
+        self.output_filepath = output_filepath
+        self.compact = compact
+        self.derived = derived
+        self.writer = None
+        self.rows = 0
+        self.dates = set()
+
+    def write(self, day):
+        table = sort_day(to_table(day))
+        if self.compact:
+            table = compact_table(table)
+        table = add_derived_columns(table, self.derived)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.output_filepath, table.schema,
+                                           **writer_options(table.schema, self.compact, ['snapshot_date', 'prefix']))
+        elif not table.schema.equals(self.writer.schema):
+            # e.g. a collapsed multi-repo day built by pandas in a run using the arrow engine
+            table = table.cast(self.writer.schema)
+        self.writer.write_table(table, row_group_size=CHUNK_ROWS)
+        self.rows += len(table)
+        self.dates.update(pd.to_datetime(pc.unique(table['snapshot_date']).to_pandas()).dt.date)
+
+    def close(self):
+        # Returns False if nothing was ever written (and so no file was created).
+        if self.writer is None:
+            return False
+        self.writer.add_key_value_metadata({DATES_METADATA_KEY: json.dumps(sorted(d.isoformat() for d in self.dates))})
+        self.writer.close()
+        return True
+
+
+def fragment_dir(dataset_dir, snapshot_date):
+    return os.path.join(dataset_dir, f"snapshot_date={snapshot_date:%Y-%m-%d}")
+
+
+def fragment_schema(compact=False, derived=()):
+    schema = COMPACT_SCHEMA if compact else ROA_SCHEMA
+    for name in derived:
+        if name not in schema.names:
+            schema = schema.append(derived_field(name))
+    return schema
+
+
+def write_fragment(day, dataset_dir, snapshot_date, compact=False, derived=()):
+    # Writes one snapshot as its own fragment, cast to ROA_SCHEMA (plus derived columns) so every fragment has
+    # the same schema, and sorted by prefix like the days of a consolidated file.
+    # The file is renamed into place only when complete, so readers never see half a day.
+    output_dir = fragment_dir(dataset_dir, snapshot_date)
+    os.makedirs(output_dir, exist_ok=True)
+    output_filepath = os.path.join(output_dir, FRAGMENT_FILENAME)
+    tmp_filepath = output_filepath + '.tmp'
+    schema = fragment_schema(compact, derived)
+    table = sort_day(to_table(day, ROA_SCHEMA))
+    table = add_derived_columns(compact_table(table) if compact else table, derived).cast(schema)
+    with pq.ParquetWriter(tmp_filepath, schema, **writer_options(schema, compact, ['prefix'])) as writer:
+        writer.write_table(table, row_group_size=CHUNK_ROWS)
+    os.replace(tmp_filepath, output_filepath)
+    return len(table)
+
+
+def load_ingest_manifest(dataset_dir):
+    # The ingest manifest records which snapshot days a dataset holds, the schema they were written with and the
+    # files each day came from. Fragments already on disk but missing from it (datasets written before the
+    # manifest, or a run killed between renaming a fragment and saving the manifest) are adopted as ingested; without
+    # a recorded schema, the schema and derived columns are taken from the fragments themselves.
+    manifest_path = os.path.join(dataset_dir, INGEST_MANIFEST_FILENAME)
+    manifest = {'schema': None, 'days': {}}
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"!WARNING: Could not read ingest manifest {manifest_path} ({e}). Rebuilding it from the fragments on disk.")
+    if os.path.isdir(dataset_dir):
+        snapshot_dates = list_snapshot_dates(dataset_dir)
+        for snapshot_date in snapshot_dates:
+            manifest['days'].setdefault(snapshot_date.isoformat(), {'files': None, 'rows': None})
+        if snapshot_dates and manifest.get('schema') is None:
+            manifest['schema'], manifest['derived'] = fragment_layout(dataset_schema(dataset_dir))
+    return manifest
+
+
+def fragment_layout(schema):
+    # (schema name, derived columns) of fragments written with schema: compact fragments store ASNs as integers.
+    compact = pa.types.is_integer(schema.field('asn').type)
+    base = COMPACT_SCHEMA if compact else ROA_SCHEMA
+    return ('compact' if compact else 'legacy'), [name for name in schema.names if name not in base.names and name != 'snapshot_date']
+
+
+def save_ingest_manifest(dataset_dir, manifest):
+    manifest_path = os.path.join(dataset_dir, INGEST_MANIFEST_FILENAME)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def parse_snapshot_to_fragment(date_part, zips, dataset_dir, engine='pandas', compact=False, derived=()):
+    # Process pool worker: parses all repos of one day into that day's fragment.
+    # Returns (rows, collapsed duplicates, processed files, error messages).
+    snapshot_date = pd.to_datetime(date_part, format='%Y%m%d')
+    frames = []
+    processed = []
+    errors = []
+    for zip in zips:
+        try:
+            frames.append(read_snapshot_table(zip, snapshot_date, snapshot_key(zip)[1], engine))
+            processed.append(zip)
+        except (lzma.LZMAError, pd.errors.EmptyDataError, EOFError) as e:
+            errors.append(f"Failed to process {zip}. Error: {e}. Skipping file.")
+        except Exception as e:
+            errors.append(f"An unexpected error occurred with {zip}. Error: {e}. Skipping file.")
+    if not frames:
+        return 0, 0, processed, errors
+    duplicates = 0
+    if len(frames) > 1:
+        frame, duplicates = collapse_repos(frames)
+    else:
+        frame = frames[0]
+    rows = write_fragment(frame, dataset_dir, snapshot_date, compact, derived)
+    return rows, duplicates, processed, errors
+
+
+def dataset_schema(path):
+    if os.path.isdir(path):
+        return ds.dataset(path, format='parquet', partitioning=PARTITIONING).schema
+    return pq.read_schema(path)
+
+
+def decode_asns(values):
+    # Compact uint32 ASNs back to the 'AS<n>' labels used everywhere else, as a categorical to stay small.
+    codes, uniques = pd.factorize(values)
+    return pd.Categorical.from_codes(codes, categories=[f"AS{int(asn)}" for asn in uniques])
+
+
+def read_roas(path, columns=None, filters=None):
+    # Reads either a single consolidated Parquet file or a snapshot_date= partitioned dataset directory,
+    # in the legacy or the compact schema. Compact frames keep categorical prefix/uri/repo/asn columns,
+    # so group them with observed=True. Interval files (roa_intervals.py) are expanded back into per-day rows.
+    if os.path.isdir(path):
+        if columns is None:
+            columns = [name for name in dataset_schema(path).names if name in DEFAULT_COLUMNS]
+        table = pq.read_table(path, columns=columns, filters=filters, partitioning=PARTITIONING)
+        # date32 snapshot dates become datetime64 rather than one datetime.date object per row
+        df = table.to_pandas(date_as_object=False)
+    else:
+        from roa_intervals import is_interval_file, read_interval_roas
+        if is_interval_file(path):
+            df = read_interval_roas(path, columns, filters)
+        else:
+            if columns is None:
+                columns = [name for name in dataset_schema(path).names if name in DEFAULT_COLUMNS]
+            df = pq.read_table(path, columns=columns, filters=filters).to_pandas(date_as_object=False)
+    if 'asn' in df.columns and pd.api.types.is_numeric_dtype(df['asn']):
+        df['asn'] = decode_asns(df['asn'])
+    return df
+
+
+def row_group_dates(metadata):
+    # The single snapshot date of every row group, from its statistics; None if any row group has no statistics
+    # or mixes days (older files).
+    dates = []
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        column = next(row_group.column(j) for j in range(row_group.num_columns) if row_group.column(j).path_in_schema == 'snapshot_date')
+        stats = column.statistics
+        if stats is None or not stats.has_min_max or stats.min != stats.max:
+            return None
+        dates.append(pd.Timestamp(stats.min).date())
+    return dates
+
+
+def list_snapshot_dates(path):
+    # Sorted snapshot dates from metadata only: partition directory names for a dataset, the footer written by
+    # SnapshotWriter, or per-row-group statistics. Only older files with days mixed inside a row group
+    # fall back to reading the snapshot_date column.
+    if os.path.isdir(path):
+        dates = []
+        for name in os.listdir(path):
+            key, _, value = name.partition('=')
+            if key == 'snapshot_date' and any(f.endswith('.parquet') for f in os.listdir(os.path.join(path, name))):
+                dates.append(date.fromisoformat(value))
+        return sorted(dates)
+
+    metadata = pq.ParquetFile(path).metadata
+    footer = metadata.metadata or {}
+    if DATES_METADATA_KEY.encode() in footer:
+        return sorted(date.fromisoformat(d) for d in json.loads(footer[DATES_METADATA_KEY.encode()]))
+
+    dates = row_group_dates(metadata)
+    if dates is not None:
+        return sorted(set(dates))
+
+    all_dates = read_roas(path, columns=['snapshot_date'])['snapshot_date'].drop_duplicates()
+    return sorted(pd.to_datetime(all_dates).dt.date)
+
+
+def snapshot_loader(path, columns=None):
+    # A function reading one snapshot day as read_roas(path, columns, [('snapshot_date', '=', day)]) would, but with
+    # the source opened (and planned) once: the dataset is discovered once, a snapshot file is memory-mapped and its
+    # row groups are indexed by day, and an interval file's intervals are read once and expanded per day.
+    if os.path.isdir(path):
+        dataset = ds.dataset(path, format='parquet', partitioning=PARTITIONING, filesystem=pafs.LocalFileSystem(use_mmap=True))
+        if columns is None:
+            columns = [name for name in dataset.schema.names if name in DEFAULT_COLUMNS]
+
+        def load(snapshot_date):
+            table = dataset.to_table(columns=columns, filter=pc.field('snapshot_date') == pa.scalar(snapshot_date, pa.date32()))
+            return table.to_pandas(date_as_object=False)
+    else:
+        from roa_intervals import is_interval_file, read_intervals, expand_intervals, to_day
+        if is_interval_file(path):
+            if columns is None:
+                stored = pq.read_schema(path).names
+                columns = [name for name in DEFAULT_COLUMNS if name in stored or name == 'snapshot_date']
+            intervals = read_intervals(path, columns=[name for name in columns if name != 'snapshot_date'] + ['copies', 'first_seen', 'last_seen'])
+            first_seen = intervals['first_seen'].to_numpy().astype('datetime64[D]')
+            last_seen = intervals['last_seen'].to_numpy().astype('datetime64[D]')
+
+            def load(snapshot_date):
+                day = to_day(snapshot_date)
+                return expand_intervals(intervals[(first_seen <= day) & (last_seen >= day)], np.array([day]), columns)
+        else:
+            parquet_file = pq.ParquetFile(path, memory_map=True)
+            if columns is None:
+                columns = [name for name in parquet_file.schema_arrow.names if name in DEFAULT_COLUMNS]
+            dates = row_group_dates(parquet_file.metadata)
+            row_groups = {}
+            for i, row_group_date in enumerate(dates or []):
+                row_groups.setdefault(row_group_date, []).append(i)
+
+            def load(snapshot_date):
+                if dates is None:
+                    # Days mixed inside row groups: let the reader filter rows.
+                    table = pq.read_table(path, columns=columns, filters=[('snapshot_date', '=', snapshot_date)], memory_map=True)
+                else:
+                    table = parquet_file.read_row_groups(row_groups.get(snapshot_date, []), columns=columns)
+                return table.to_pandas(date_as_object=False)
+
+    def load_roas(snapshot_date):
+        df = load(snapshot_date)
+        if 'asn' in df.columns and pd.api.types.is_numeric_dtype(df['asn']):
+            df['asn'] = decode_asns(df['asn'])
+        return df
+    return load_roas
+
+
+def iter_snapshots(path, columns=None, dates=None, prefetch=1):
+    # Yields (snapshot_date, future) for every day in date order (all days of path unless dates is given); the
+    # future's result() is that day's ROAs, or raises what loading the day raised. Up to prefetch later days are
+    # loaded on a background thread while the caller works on the current one.
+    if dates is None:
+        dates = list_snapshot_dates(path)
+    load = snapshot_loader(path, columns)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = []
+        for i, snapshot_date in enumerate(dates):
+            while len(pending) <= prefetch and i + len(pending) < len(dates):
+                pending.append(executor.submit(load, dates[i + len(pending)]))
+            yield snapshot_date, pending.pop(0)
+
+
+def plain_batch(table):
+    # Dictionary columns re-encoded with just the values they hold (a filtered batch otherwise drags the whole
+    # day's dictionary along) and compact numeric ASNs as 'AS<n>' labels, so every batch of a scan has one schema.
+    columns = []
+    for name, column in zip(table.column_names, table.columns):
+        if name == 'asn' and pa.types.is_integer(column.type):
+            column = pc.dictionary_encode(pc.binary_join_element_wise('AS', pc.cast(column, pa.string()), ''))
+        elif pa.types.is_dictionary(column.type):
+            column = pc.dictionary_encode(pc.cast(column, column.type.value_type))
+        columns.append(column)
+    return pa.table(columns, names=table.column_names)
+
+
+def scan_roas(path, columns=None, prefixes=None, batch_size=CHUNK_ROWS):
+    # Streams the ROAs of path (file, dataset directory or interval file) as Arrow tables of at most batch_size
+    # rows, in file order. Only the given columns are read, and with prefixes only rows whose prefix is in that
+    # set: the filter is pushed into the Parquet scan, so row groups whose prefix statistics rule them out are
+    # skipped and memory is bounded by a batch, not the input.
+    from roa_intervals import is_interval_file
+    if not os.path.isdir(path) and is_interval_file(path):
+        filters = [('prefix', 'in', sorted(prefixes))] if prefixes is not None else None
+        table = pa.Table.from_pandas(read_roas(path, columns=columns, filters=filters), preserve_index=False)
+        batches = table.to_batches(max_chunksize=batch_size)
+        for batch in batches:
+            yield plain_batch(pa.Table.from_batches([batch]))
+        if not batches:
+            yield plain_batch(table)
+        return
+
+    dataset = ds.dataset(path, format='parquet', partitioning=PARTITIONING if os.path.isdir(path) else None)
+    if columns is None:
+        columns = [name for name in dataset.schema.names if name in DEFAULT_COLUMNS]
+    row_filter = pc.field('prefix').isin(pa.array(sorted(prefixes), pa.string())) if prefixes is not None else None
+    empty = True
+    for batch in dataset.to_batches(columns=columns, filter=row_filter, batch_size=batch_size):
+        if batch.num_rows:
+            empty = False
+            yield plain_batch(pa.Table.from_batches([batch]))
+    if empty:
+        # Still one (empty) batch, so callers always see the schema.
+        yield plain_batch(pa.schema([dataset.schema.field(name) for name in columns]).empty_table())
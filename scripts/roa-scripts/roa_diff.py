@@ -0,0 +1,164 @@
+# Day-over-day ROA diff engine: every ROA row gets a 64-bit fingerprint over all considered columns, and added,
+# removed and modified ROAs come from set operations on the fingerprint arrays of two consecutive snapshots.
+# Used by roa-diff.py.
+
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from roa_dataset import considered_columns, COMPACT_COMPRESSION
+from roa_events import is_csv_log
+
+FINGERPRINT_COLUMNS = list(considered_columns.values())
+# A removed and an added ROA with the same identity are reported as one modification of that ROA.
+IDENTITY_COLUMNS = ['prefix', 'asn']
+ATTRIBUTE_COLUMNS = ['max_len', 'uri', 'not_before', 'not_after']
+# Keys removed and added ROAs are paired on, closest first: a re-signed ROA (new validity dates) keeps its max_len
+# and uri, so it is paired with its own earlier version rather than with another ROA of the same prefix and ASN.
+PAIRING_KEYS = [IDENTITY_COLUMNS + ['max_len', 'uri'], IDENTITY_COLUMNS + ['max_len'], IDENTITY_COLUMNS + ['uri'], IDENTITY_COLUMNS]
+CHANGES = ['added', 'removed', 'modified']
+
+
+def fingerprint(df, columns=FINGERPRINT_COLUMNS):
+    # uint64 per row; the same for legacy strings and compact categoricals of equal values, so fingerprints of
+    # two days of one input are comparable whatever categories each day was read with. Plain string columns are
+    # hashed as they are: uri and prefix are nearly unique per day, so factorizing them first (categorize) costs
+    # more than it saves, and the hashes are the same either way.
+    return pd.util.hash_pandas_object(df[columns], index=False, categorize=False).to_numpy()
+
+
+class Snapshot:
+    # One day's ROAs with their fingerprints, computed once and reused as the previous day of the next diff.
+
+    def __init__(self, snapshot_date, df):
+        self.snapshot_date = snapshot_date
+        self.df = df[FINGERPRINT_COLUMNS].reset_index(drop=True)
+        self.fingerprints = fingerprint(self.df)
+        self.sorted_fingerprints = np.sort(self.fingerprints)
+
+
+def only_in(snapshot, other):
+    # Rows of snapshot whose fingerprint is not in other, one per distinct fingerprint. Looked up in the other day's
+    # sorted fingerprints, which each Snapshot sorts once for both diffs it is part of.
+    mask = ~contains(other.sorted_fingerprints, snapshot.fingerprints)
+    rows = snapshot.df[mask].assign(_fp=snapshot.fingerprints[mask])
+    rows = rows.drop_duplicates('_fp')
+    # Categories differ between days; plain values keep the joins below cheap and well-typed.
+    for name in rows.select_dtypes('category').columns:
+        rows[name] = rows[name].astype(rows[name].cat.categories.dtype)
+    return rows
+
+
+def contains(sorted_values, values):
+    # Boolean mask of values found in the sorted array sorted_values.
+    if not len(sorted_values):
+        return np.zeros(len(values), dtype=bool)
+    positions = np.minimum(np.searchsorted(sorted_values, values), len(sorted_values) - 1)
+    return sorted_values[positions] == values
+
+
+def pair_by_identity(removed, added):
+    # Pairs are taken on the closest key first (see PAIRING_KEYS): in each round the n-th removed and the n-th added
+    # ROA of the same key (in fingerprint order) form one modification, and the rest go on to the next key.
+    removed, added = removed.sort_values('_fp'), added.sort_values('_fp')
+    pairs = []
+    for key in PAIRING_KEYS:
+        removed, added = rank_by_key(removed, key), rank_by_key(added, key)
+        found = removed.merge(added, on=['_key', '_n'], suffixes=('_old', '_new'))
+        removed = removed[~removed['_fp'].isin(found['_fp_old'])]
+        added = added[~added['_fp'].isin(found['_fp_new'])]
+        pairs.append(found)
+    return removed, added, pd.concat(pairs, ignore_index=True)
+
+
+def rank_by_key(rows, key):
+    # _key: fingerprint of the key columns; _n: rank of the row among the rows of its key.
+    rows = rows.assign(_key=fingerprint(rows, key))
+    return rows.assign(_n=rows.groupby('_key', sort=False).cumcount())
+
+
+def diff_snapshots(prev, curr):
+    # Change log between two Snapshots, dated with the later day: one row per added, removed or modified ROA, with
+    # old_*/new_* attributes (null on the side that does not exist) and, for modifications, the changed columns.
+    removed, added, pairs = pair_by_identity(only_in(prev, curr), only_in(curr, prev))
+
+    logs = []
+    for change, rows, sides in (('added', added, ['new']), ('removed', removed, ['old'])):
+        log = rows[IDENTITY_COLUMNS].copy()
+        for name in ATTRIBUTE_COLUMNS:
+            for side in ['old', 'new']:
+                log[f"{side}_{name}"] = rows[name] if side in sides else None
+        log['change'] = change
+        log['changed'] = None
+        logs.append(log)
+
+    log = pairs[[f"{name}_old" for name in IDENTITY_COLUMNS]].rename(columns=lambda name: name[:-len('_old')])
+    changed = pd.DataFrame({name: (pairs[f"{name}_old"] != pairs[f"{name}_new"]) & ~(pairs[f"{name}_old"].isna() & pairs[f"{name}_new"].isna())
+                            for name in ATTRIBUTE_COLUMNS})
+    for name in ATTRIBUTE_COLUMNS:
+        log[f"old_{name}"] = pairs[f"{name}_old"]
+        log[f"new_{name}"] = pairs[f"{name}_new"]
+    log['change'] = 'modified'
+    # Each distinct set of changed columns is built once, as a bit code per row, and then mapped onto the rows.
+    codes = changed.to_numpy().astype(np.int64) @ (1 << np.arange(len(ATTRIBUTE_COLUMNS)))
+    names = {code: [name for k, name in enumerate(ATTRIBUTE_COLUMNS) if code >> k & 1] for code in np.unique(codes).tolist()}
+    log['changed'] = pd.Series(codes, index=log.index).map(names).astype(object)
+    logs.append(log)
+
+    log = pd.concat([log for log in logs if len(log)] or logs[-1:], ignore_index=True)
+    log.insert(0, 'date', curr.snapshot_date)
+    return log[['date', 'change'] + IDENTITY_COLUMNS + [f"{side}_{name}" for name in ATTRIBUTE_COLUMNS for side in ['old', 'new']] + ['changed']]
+
+
+def change_log_schema(input_schema):
+    # Typed schema of the change log; attribute types follow the input (strings for legacy files, uint8/timestamps for
+    # compact ones), with dictionary columns stored as their values and ASNs as 'AS<n>' labels.
+    def value_type(name):
+        if name == 'asn':
+            return pa.string()
+        field_type = input_schema.field(name).type
+        return field_type.value_type if pa.types.is_dictionary(field_type) else field_type
+
+    fields = [
+        pa.field('date', pa.date32()),
+        pa.field('change', pa.dictionary(pa.int8(), pa.string())),
+    ] + [pa.field(name, value_type(name)) for name in IDENTITY_COLUMNS]
+    fields += [pa.field(f"{side}_{name}", value_type(name)) for name in ATTRIBUTE_COLUMNS for side in ['old', 'new']]
+    fields.append(pa.field('changed', pa.list_(pa.string())))
+    return pa.schema(fields)
+
+
+class ChangeLogWriter:
+    # Streams per-day change logs into one Parquet file (or CSV, by extension, with the rule of the event logs:
+    # is_csv_log()) so a year of diffs never sits in memory.
+
+    def __init__(self, output_file, input_schema):
+        self.output_file = output_file
+        self.schema = change_log_schema(input_schema)
+        self.csv = is_csv_log(output_file)
+        self.writer = None
+        self.rows = 0
+
+    def write(self, log):
+        output_dir = os.path.dirname(self.output_file)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        if self.csv:
+            log.to_csv(self.output_file, mode='w' if self.writer is None else 'a', header=self.writer is None, index=False)
+            self.writer = True
+        else:
+            log = log.assign(date=pd.to_datetime(log['date']).dt.date)
+            table = pa.Table.from_pandas(log, schema=self.schema, preserve_index=False)
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.output_file, self.schema, compression=COMPACT_COMPRESSION)
+            self.writer.write_table(table)
+        self.rows += len(log)
+
+    def close(self):
+        # Returns False if nothing was ever written.
+        if self.writer is None:
+            return False
+        if not self.csv:
+            self.writer.close()
+        return True
@@ -0,0 +1,387 @@
+# Vectorized classification of day-over-day prefix events around a target (an ASN or a repository).
+# Used by roa-analyzer-834.py and roa-analyzer.py.
+
+import os
+import re
+import json
+import shutil
+import tempfile
+from datetime import date
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from roa_dataset import CHUNK_ROWS, COMPACT_COMPRESSION, decode_asns
+
+# Event names as written to the detail CSV, in classification order.
+EVENT_TYPES = ['creation', 'deletion', 'update_to_AS834', 'update_from_AS834']
+# Event names used by roa-analyzer.py, where the target is given on the command line.
+TARGET_EVENT_TYPES = ['creation', 'deletion', 'update_to_target', 'update_from_target']
+ASN_PATTERN = re.compile(r'^AS\d+$', re.IGNORECASE)
+# Files of an analyzer state directory (save_analyzer_state()): state.json points to the state-* directory holding
+# the last day's ROAs and one <name>.parquet per prefix set.
+STATE_FILENAME = 'state.json'
+STATE_LAST_DAY_FILENAME = 'last_day.parquet'
+STATE_FILES_PREFIX = 'state-'
+# Parts of a Parquet event log that runs append to (EventLogWriter with append): a directory under the log's name
+# holding one file per run, in order. Files starting with '.' (a run's part while it is written) are not read.
+EVENT_LOG_PART = 'part-{:05d}.parquet'
+
+
+def is_csv_log(path):
+    # The format rule of every log (event logs, roa_diff.py's change logs): a .parquet path is typed Parquet, any
+    # other path is CSV.
+    return not path.endswith('.parquet')
+
+
+def in_prefixes(day_roas, prefixes):
+    # Boolean mask of rows whose prefix is in prefixes. Done in Arrow, which handles string, Arrow-backed and
+    # dictionary (compact) prefix columns alike; pandas isin() is several times slower on the categoricals.
+    value_set = pa.array(list(prefixes), pa.string())
+    mask = pc.is_in(pa.array(day_roas['prefix']), value_set=value_set)
+    return np.asarray(mask.to_numpy(zero_copy_only=False), dtype=bool)
+
+
+def value_lists(day_roas, column):
+    # Distinct values of column per prefix, as plain lists.
+    # Split out of one sorted array rather than with a per-group groupby apply.
+    pairs = day_roas[['prefix', column]].astype(object).drop_duplicates().sort_values('prefix', kind='stable')
+    keys, starts = np.unique(pairs['prefix'].to_numpy(), return_index=True)
+    values = np.split(pairs[column].to_numpy(), starts[1:])
+    return dict(zip(keys, (group.tolist() for group in values)))
+
+
+def parse_target(spec):
+    # A target is an ASN ('AS834'), a URI prefix ('rsync://r.magellan.ipxo.com') or both joined with '+', which
+    # matches ROAs that authorize that ASN and are published under that URI. Returns {'label', 'asn', 'uri'}.
+    target = {'label': spec, 'asn': None, 'uri': None}
+    for part in spec.split('+'):
+        if ASN_PATTERN.match(part) and target['asn'] is None:
+            target['asn'] = part.upper()
+        elif '://' in part and target['uri'] is None:
+            target['uri'] = part
+        else:
+            raise ValueError(f"Invalid target '{spec}': expected AS<n>, a URI prefix such as rsync://host, or AS<n>+<URI prefix>.")
+    target['label'] = '+'.join(part for part in (target['asn'], target['uri']) if part)
+    return target
+
+
+def column_matches(values, match):
+    # match() applied to a column; on a categorical only to its categories, so each distinct value is tested once.
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        category_matches = np.asarray(match(pd.Series(values.cat.categories)), dtype=bool)
+        codes = values.cat.codes.to_numpy()
+        return np.where(codes >= 0, category_matches[codes], False)
+    return np.asarray(match(values), dtype=bool)
+
+
+def target_prefixes(day_roas, target):
+    # Distinct prefixes of one day with at least one ROA matching target.
+    mask = np.ones(len(day_roas), dtype=bool)
+    if target['asn'] is not None:
+        mask &= column_matches(day_roas['asn'], lambda values: values == target['asn'])
+    if target['uri'] is not None:
+        mask &= column_matches(day_roas['uri'], lambda values: values.str.startswith(target['uri'], na=False))
+    return pd.unique(day_roas['prefix'].to_numpy()[mask])
+
+
+def classify_events(prev_roas, curr_roas, prev_targets, curr_targets, column, event_types=EVENT_TYPES):
+    # prev_targets/curr_targets: prefixes that had/have the target on the previous/current day. Per candidate prefix,
+    # four flags (had target, has target, present before, present now) decide the event, with the same rules as the
+    # original per-prefix loop:
+    #   creation:    has target and was not present before
+    #   deletion:    had target and is not present now
+    #   update_to:   has target, did not have it, and was present before
+    #   update_from: had target, does not have it, and is present now
+    # Only prefixes with the target on one of the two days can have an event, so both days are first cut down to
+    # those prefixes. Returns one row per event with prefix, event and the prefix's values of column (or of each of
+    # a list of columns) on both days.
+    prev_targets = pd.Index(list(prev_targets), dtype=object)
+    curr_targets = pd.Index(list(curr_targets), dtype=object)
+    candidates = prev_targets.union(curr_targets)
+    prev_roas = prev_roas[in_prefixes(prev_roas, candidates)]
+    curr_roas = curr_roas[in_prefixes(curr_roas, candidates)]
+
+    had_target = candidates.isin(prev_targets)
+    has_target = candidates.isin(curr_targets)
+    present_before = candidates.isin(prev_roas['prefix'].astype(object).unique())
+    present_now = candidates.isin(curr_roas['prefix'].astype(object).unique())
+
+    conditions = [
+        has_target & ~present_before,
+        had_target & ~present_now,
+        has_target & ~had_target & present_before,
+        had_target & ~has_target & present_now,
+    ]
+    event = np.select(conditions, event_types, default='')
+    events = pd.DataFrame({'prefix': candidates[event != ''], 'event': event[event != '']})
+
+    for name in [column] if isinstance(column, str) else column:
+        for day, day_roas in (('prev', prev_roas), ('curr', curr_roas)):
+            lists = value_lists(day_roas[in_prefixes(day_roas, events['prefix'])], name)
+            events[f"{day}_date_{name}s"] = [lists.get(prefix, []) for prefix in events['prefix']]
+    return events
+
+
+def event_log_schema(list_columns=('asn',), target=False):
+    # Typed event log: date32 dates, a dictionary-encoded event, and the prev/curr values of each list column as
+    # real lists (ASNs as list<uint32> numbers, other columns as list<string>).
+    fields = [pa.field('date', pa.date32())]
+    if target:
+        fields.append(pa.field('target', pa.dictionary(pa.int16(), pa.string())))
+    fields += [pa.field('prefix', pa.string()), pa.field('event', pa.dictionary(pa.int8(), pa.string()))]
+    for name in list_columns:
+        value_type = pa.uint32() if name == 'asn' else pa.string()
+        fields += [pa.field(f"{day}_date_{name}s", pa.list_(value_type)) for day in ['prev', 'curr']]
+    return pa.schema(fields)
+
+
+def asn_lists(lists):
+    # list<string> of 'AS<n>' labels to list<uint32> numbers, without touching Python objects per value.
+    lists = pa.array(lists, pa.list_(pa.string()))
+    numbers = pc.cast(pc.utf8_slice_codeunits(lists.flatten(), 2), pa.uint32())
+    return pa.ListArray.from_arrays(lists.offsets, numbers, mask=lists.is_null())
+
+
+class EventLogWriter:
+    # Streams per-day event frames into one Parquet file (or CSV, by extension, as before), buffering up to
+    # CHUNK_ROWS events per row group so memory stays flat however many events a run produces.
+    # With append, events are added after those of an existing log: CSV rows are appended in place, a Parquet
+    # log becomes a directory of parts (EVENT_LOG_PART) and each run adds its own part on close(), so the events
+    # already logged are never rewritten. read_events() and the analyzers read either layout.
+
+    def __init__(self, output_file, list_columns=('asn',), target=False, append=False):
+        self.output_file = output_file
+        self.schema = event_log_schema(list_columns, target)
+        self.csv = is_csv_log(output_file)
+        if append and not os.path.exists(output_file) and os.path.isdir(output_file + '.tmp'):
+            # A single-file log whose move into a directory of parts (open()) was interrupted.
+            os.replace(output_file + '.tmp', output_file)
+        self.append = append and os.path.exists(output_file)
+        # Size of an appended CSV log before this run, so abort() can cut it back.
+        self.csv_size = os.path.getsize(output_file) if self.append and self.csv else None
+        self.part_file = None
+        self.writer = None
+        self.pending = []
+        self.pending_rows = 0
+        self.rows = 0
+
+    def open(self):
+        output_dir = os.path.dirname(self.output_file)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        if self.csv:
+            self.writer = True
+            return
+        if not self.append:
+            self.writer = pq.ParquetWriter(self.output_file, self.schema, compression=COMPACT_COMPRESSION)
+            return
+        if os.path.isfile(self.output_file):
+            # The single file becomes the first part; it is moved, not rewritten.
+            os.makedirs(self.output_file + '.tmp', exist_ok=True)
+            os.replace(self.output_file, os.path.join(self.output_file + '.tmp', EVENT_LOG_PART.format(0)))
+            os.replace(self.output_file + '.tmp', self.output_file)
+        self.part_file = os.path.join(self.output_file, EVENT_LOG_PART.format(len(log_parts(self.output_file))))
+        self.writer = pq.ParquetWriter(hidden_path(self.part_file), self.schema, compression=COMPACT_COMPRESSION)
+
+    def write(self, events):
+        if self.csv:
+            first = self.writer is None
+            if first:
+                self.open()
+            events.to_csv(self.output_file, mode='a' if self.append or not first else 'w', header=first and not self.append, index=False)
+        else:
+            self.pending.append(events)
+            self.pending_rows += len(events)
+            if self.pending_rows >= CHUNK_ROWS:
+                self.flush()
+        self.rows += len(events)
+
+    def write_log(self, path):
+        # Appends the events of another log of the same format and schema (e.g. one written by a worker process)
+        # without loading it whole: CSV lines are copied after its header line, Parquet in batches of CHUNK_ROWS.
+        if self.csv:
+            first = self.writer is None
+            if first:
+                self.open()
+            with open(path, 'rb') as src, open(self.output_file, 'ab' if self.append or not first else 'wb') as dst:
+                header = src.readline()
+                if first and not self.append:
+                    dst.write(header)
+                shutil.copyfileobj(src, dst)
+            self.rows += count_rows(path)
+            return
+        self.flush()
+        if self.writer is None:
+            self.open()
+        parquet_file = pq.ParquetFile(path)
+        for batch in parquet_file.iter_batches(batch_size=CHUNK_ROWS):
+            self.writer.write_table(pa.Table.from_batches([batch]).cast(self.schema))
+            self.rows += len(batch)
+        parquet_file.close()
+
+    def flush(self):
+        if not self.pending:
+            return
+        events = pd.concat(self.pending, ignore_index=True)
+        self.pending = []
+        self.pending_rows = 0
+        columns = {}
+        for field in self.schema:
+            values = events[field.name]
+            if field.name == 'date':
+                columns[field.name] = pa.array(pd.to_datetime(values).dt.date, pa.date32())
+            elif pa.types.is_list(field.type) and pa.types.is_uint32(field.type.value_type):
+                columns[field.name] = asn_lists(values)
+            elif pa.types.is_dictionary(field.type):
+                columns[field.name] = pa.array(values.astype(str), pa.string()).dictionary_encode().cast(field.type)
+            else:
+                columns[field.name] = pa.array(values, field.type)
+        table = pa.table(columns, schema=self.schema)
+        if self.writer is None:
+            self.open()
+        self.writer.write_table(table)
+
+    def close(self):
+        # Writes an empty log (header or schema only) if no event was ever written and there was no log to append to.
+        if self.csv:
+            if self.writer is None and not self.append:
+                pd.DataFrame(columns=self.schema.names).to_csv(self.output_file, index=False)
+            return
+        self.flush()
+        if self.writer is None:
+            if self.append:
+                return
+            self.open()
+        self.writer.close()
+        if self.append:
+            os.replace(hidden_path(self.part_file), self.part_file)
+
+    def abort(self):
+        # Discards everything written since the writer was created, e.g. when the analysis failed halfway: an appended
+        # CSV log is cut back to its old size, an unfinished Parquet part or a log this writer started is removed.
+        self.pending = []
+        self.pending_rows = 0
+        if self.writer is None:
+            return
+        if self.csv:
+            if self.append:
+                with open(self.output_file, 'rb+') as f:
+                    f.truncate(self.csv_size)
+            else:
+                os.remove(self.output_file)
+        else:
+            self.writer.close()
+            os.remove(hidden_path(self.part_file) if self.append else self.output_file)
+        self.writer = None
+        self.rows = 0
+
+
+def hidden_path(path):
+    return os.path.join(os.path.dirname(path), '.' + os.path.basename(path))
+
+
+def log_parts(path):
+    # Part files of a Parquet event log kept as a directory, in the order they were appended.
+    return [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith('.parquet') and not name.startswith(('.', '_'))]
+
+
+def read_events(path, columns=None):
+    # An event log written by EventLogWriter, Parquet or CSV; only the given columns are read.
+    if not is_csv_log(path):
+        return pq.read_table(path, columns=columns).to_pandas(date_as_object=False)
+    return pd.read_csv(path, usecols=columns)
+
+
+def save_analyzer_state(state_dir, last_date, last_roas, prefix_sets, output_rows=None):
+    # End-of-run state of an analyzer: the last analyzed day and its ROAs (prefix and asn, ASNs as uint32 numbers),
+    # plus named prefix sets (e.g. prefixes ever associated with the target) and the row counts of the run's output
+    # files at this state (output_rows, e.g. {'summary': rows, 'events': rows}). The files go into a fresh directory
+    # and state.json, replaced last, is what points to them, so a run that dies while saving leaves the previous
+    # state whole; the previous state's files are only removed after that.
+    os.makedirs(state_dir, exist_ok=True)
+    files_dir = tempfile.mkdtemp(prefix=f"{STATE_FILES_PREFIX}{last_date.isoformat()}-", dir=state_dir)
+    last_roas = last_roas[['prefix', 'asn']].drop_duplicates()
+    asns = pc.cast(pc.utf8_slice_codeunits(pa.array(last_roas['asn'].astype(str), pa.string()), 2), pa.uint32())
+    pq.write_table(pa.table({'prefix': pa.array(last_roas['prefix'].astype(str), pa.string()), 'asn': asns}),
+                   os.path.join(files_dir, STATE_LAST_DAY_FILENAME), compression=COMPACT_COMPRESSION)
+    for name, prefixes in prefix_sets.items():
+        pq.write_table(pa.table({'prefix': pa.array(sorted(prefixes), pa.string())}),
+                       os.path.join(files_dir, f"{name}.parquet"), compression=COMPACT_COMPRESSION)
+    state_file = os.path.join(state_dir, STATE_FILENAME)
+    with open(state_file + '.tmp', 'w') as f:
+        json.dump({'last_date': last_date.isoformat(), 'prefix_sets': sorted(prefix_sets), 'files': os.path.basename(files_dir),
+                   'output_rows': output_rows or {}}, f, indent=1)
+    os.replace(state_file + '.tmp', state_file)
+    # Files of earlier states, and of saves that died before state.json was replaced.
+    for name in os.listdir(state_dir):
+        if name.startswith(STATE_FILES_PREFIX) and name != os.path.basename(files_dir):
+            shutil.rmtree(os.path.join(state_dir, name), ignore_errors=True)
+    for name in [STATE_LAST_DAY_FILENAME] + [f"{name}.parquet" for name in prefix_sets]:
+        if os.path.exists(os.path.join(state_dir, name)):
+            os.remove(os.path.join(state_dir, name))
+
+
+def load_analyzer_state(state_dir):
+    # The state saved by save_analyzer_state(), or None if state_dir holds none: {'last_date': date, 'last_roas':
+    # frame of prefix/asn ('AS<n>' labels), 'prefix_sets': {name: set}, 'output_rows': {output: rows}}. States saved
+    # before the state-* directories keep their files next to state.json and have no output row counts.
+    state_file = os.path.join(state_dir, STATE_FILENAME)
+    if not os.path.exists(state_file):
+        return None
+    with open(state_file) as f:
+        state = json.load(f)
+    files_dir = os.path.join(state_dir, state.get('files', ''))
+    last_roas = pq.read_table(os.path.join(files_dir, STATE_LAST_DAY_FILENAME)).to_pandas()
+    last_roas['asn'] = decode_asns(last_roas['asn'])
+    prefix_sets = {name: set(pq.read_table(os.path.join(files_dir, f"{name}.parquet"))['prefix'].to_pylist())
+                   for name in state['prefix_sets']}
+    return {'last_date': date.fromisoformat(state['last_date']), 'last_roas': last_roas, 'prefix_sets': prefix_sets,
+            'output_rows': state.get('output_rows', {})}
+
+
+def count_rows(path):
+    # Rows of an output file (CSV with a header line, Parquet, or a directory of Parquet parts); 0 if it does not exist.
+    if not os.path.exists(path):
+        return 0
+    if os.path.isdir(path):
+        return sum(pq.read_metadata(part).num_rows for part in log_parts(path))
+    if not is_csv_log(path):
+        return pq.read_metadata(path).num_rows
+    with open(path, 'rb') as f:
+        return max(sum(1 for _ in f) - 1, 0)
+
+
+def truncate_rows(path, rows):
+    # Cuts an output file (CSV with a header line, or Parquet) back to its first rows rows, e.g. to the row count of
+    # a saved analyzer state when the run after it died between writing its outputs and saving its state.
+    if os.path.isdir(path):
+        # Parts wholly past rows are removed and only the part that rows ends in is cut.
+        kept = 0
+        for part in log_parts(path):
+            part_rows = pq.read_metadata(part).num_rows
+            if kept >= rows:
+                os.remove(part)
+            elif kept + part_rows > rows:
+                truncate_rows(part, rows - kept)
+            kept += part_rows
+        return
+    if not is_csv_log(path):
+        parquet_file = pq.ParquetFile(path)
+        with pq.ParquetWriter(path + '.tmp', parquet_file.schema_arrow, compression=COMPACT_COMPRESSION) as writer:
+            kept = 0
+            for batch in parquet_file.iter_batches(batch_size=CHUNK_ROWS):
+                if kept == rows:
+                    break
+                batch = batch.slice(0, rows - kept)
+                writer.write_batch(batch)
+                kept += len(batch)
+        parquet_file.close()
+        os.replace(path + '.tmp', path)
+        return
+    with open(path, 'rb+') as f:
+        f.readline()
+        for _ in range(rows):
+            f.readline()
+        f.truncate(f.tell())
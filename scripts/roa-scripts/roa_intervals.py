@@ -0,0 +1,201 @@
+# Run-length interval storage for ROA history: one row per continuous presence of a ROA instead of one per day.
+# Written by roa-csv-parser.py --output_type intervals; read_roas() in roa_dataset.py reads these files transparently.
+
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from roa_dataset import (ROA_SCHEMA, CHUNK_ROWS, DEFAULT_COLUMNS, DATES_METADATA_KEY, to_table, compact_table,
+                         writer_options, list_snapshot_dates, decode_asns, add_derived_columns)
+
+# A ROA is identified by all of its attributes, including the repos it was published under.
+INTERVAL_KEY = ROA_SCHEMA.names
+# Footer key telling interval files apart from per-day snapshot files.
+FORMAT_METADATA_KEY = 'roa.format'
+INTERVALS_FORMAT = 'intervals'
+DATE_OPS = {
+    '=': lambda dates, value: dates == value,
+    '==': lambda dates, value: dates == value,
+    '!=': lambda dates, value: dates != value,
+    '<': lambda dates, value: dates < value,
+    '<=': lambda dates, value: dates <= value,
+    '>': lambda dates, value: dates > value,
+    '>=': lambda dates, value: dates >= value,
+    'in': lambda dates, value: np.isin(dates, value),
+    'not in': lambda dates, value: ~np.isin(dates, value),
+}
+
+
+def is_interval_file(path):
+    try:
+        metadata = pq.read_metadata(path).metadata or {}
+    except (OSError, pa.ArrowInvalid):
+        return False
+    return metadata.get(FORMAT_METADATA_KEY.encode()) == INTERVALS_FORMAT.encode()
+
+
+def to_day(value):
+    if isinstance(value, (list, tuple, set, np.ndarray, pd.Series)):
+        return np.array([to_day(v) for v in value], dtype='datetime64[D]')
+    return np.datetime64(pd.Timestamp(value).date(), 'D')
+
+
+class IntervalWriter:
+    # Takes whole snapshot days in increasing date order, like SnapshotWriter, and writes one row per run of
+    # consecutive days on which a ROA was present, with first_seen/last_seen dates. A missing calendar day ends
+    # every run, so each interval covers only days that are snapshots and any day can be reconstructed exactly.
+    # Identical rows within a day are kept as a copies count.
+
+    def __init__(self, output_filepath, compact=False, derived=()):
+        self.output_filepath = output_filepath
+        self.compact = compact
+        self.derived = derived
+        self.writer = None
+        self.open = None
+        self.pending = []
+        self.pending_rows = 0
+        self.dates = []
+        self.rows = 0
+        self.intervals = 0
+
+    def write(self, day):
+        frame = day if isinstance(day, pd.DataFrame) else to_table(day).to_pandas()
+        if frame.empty:
+            return
+        snapshot_date = pd.Timestamp(frame['snapshot_date'].iloc[0]).date()
+        if self.dates and snapshot_date <= self.dates[-1]:
+            raise ValueError(f"Snapshot days must be written in increasing date order ({snapshot_date} after {self.dates[-1]}).")
+
+        roas = frame.groupby(INTERVAL_KEY, dropna=False, sort=False, observed=True).size().rename('copies').reset_index()
+        roas.index = pd.util.hash_pandas_object(roas, index=False).to_numpy()
+
+        if self.open is not None and (snapshot_date - self.dates[-1]).days > 1:
+            self.emit(self.open)
+            self.open = None
+        if self.open is None:
+            self.open = roas.assign(first_seen=snapshot_date)
+        else:
+            present = self.open.index.isin(roas.index)
+            self.emit(self.open[~present])
+            new = roas[~roas.index.isin(self.open.index)]
+            self.open = pd.concat([self.open[present], new.assign(first_seen=snapshot_date)])
+
+        self.dates.append(snapshot_date)
+        self.rows += len(frame)
+
+    def emit(self, closed):
+        # Intervals that ended on the last day written.
+        if closed.empty:
+            return
+        self.pending.append(closed.assign(last_seen=self.dates[-1]))
+        self.pending_rows += len(closed)
+        if self.pending_rows >= CHUNK_ROWS:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        closed = pd.concat(self.pending, ignore_index=True).sort_values(['last_seen', 'prefix'], kind='stable')
+        self.pending = []
+        self.pending_rows = 0
+        table = to_table(closed, ROA_SCHEMA)
+        if self.compact:
+            table = compact_table(table)
+        table = add_derived_columns(table, self.derived)
+        table = (table.append_column('copies', pa.array(closed['copies'].to_numpy(), pa.uint32()))
+                      .append_column('first_seen', pa.array(closed['first_seen'].to_numpy(), pa.date32()))
+                      .append_column('last_seen', pa.array(closed['last_seen'].to_numpy(), pa.date32())))
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.output_filepath, table.schema,
+                                           **writer_options(table.schema, self.compact, ['last_seen', 'prefix']))
+        self.writer.write_table(table, row_group_size=CHUNK_ROWS)
+        self.intervals += len(table)
+
+    def close(self):
+        # Returns False if no day was ever written (and so no file was created).
+        if self.open is None and not self.pending:
+            return False
+        if self.open is not None:
+            self.emit(self.open)
+            self.open = None
+        self.flush()
+        self.writer.add_key_value_metadata({
+            FORMAT_METADATA_KEY: INTERVALS_FORMAT,
+            DATES_METADATA_KEY: json.dumps([d.isoformat() for d in self.dates]),
+        })
+        self.writer.close()
+        return True
+
+
+def read_intervals(path, columns=None, filters=None):
+    # The stored intervals themselves, with first_seen/last_seen as datetime64.
+    df = pq.read_table(path, columns=columns, filters=filters).to_pandas(date_as_object=False)
+    if 'asn' in df.columns and pd.api.types.is_numeric_dtype(df['asn']):
+        df['asn'] = decode_asns(df['asn'])
+    return df
+
+
+def read_interval_roas(path, columns=None, filters=None):
+    # Reconstructs per-day snapshot rows from an interval file, as read_roas() returns them for a snapshot file.
+    # filters on snapshot_date pick the days to rebuild and are pushed down onto first_seen/last_seen;
+    # all other filters apply to the interval columns.
+    if columns is None:
+        stored = pq.read_schema(path).names
+        columns = [name for name in DEFAULT_COLUMNS if name in stored or name == 'snapshot_date']
+    days = to_day(list_snapshot_dates(path))
+    other_filters = []
+    for name, op, value in filters or []:
+        if name == 'snapshot_date':
+            days = days[DATE_OPS[op](days, to_day(value))]
+        else:
+            other_filters.append((name, op, value))
+    stored = [name for name in columns if name != 'snapshot_date']
+    if not len(days):
+        return read_intervals(path, columns=stored).iloc[:0].assign(snapshot_date=pd.Series(dtype='datetime64[ns]'))[columns]
+    other_filters += [('first_seen', '<=', days[-1].astype(object)), ('last_seen', '>=', days[0].astype(object))]
+    intervals = read_intervals(path, columns=stored + ['copies', 'first_seen', 'last_seen'], filters=other_filters)
+    return expand_intervals(intervals, days, columns)
+
+
+def expand_intervals(intervals, days, columns):
+    # Per-day rows of the given (sorted, datetime64[D]) days from intervals read with copies/first_seen/last_seen.
+    # Every interval covers the selected days between its first and last day, each `copies` times.
+    intervals = intervals.loc[intervals.index.repeat(intervals['copies'])]
+    first = np.searchsorted(days, intervals['first_seen'].to_numpy().astype('datetime64[D]'), side='left')
+    last = np.searchsorted(days, intervals['last_seen'].to_numpy().astype('datetime64[D]'), side='right')
+    counts = last - first
+    starts = np.repeat(first, counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    df = intervals.iloc[np.repeat(np.arange(len(intervals)), counts)].reset_index(drop=True)
+    df['snapshot_date'] = days[starts + offsets].astype('datetime64[ns]')
+    # Same row order as a snapshot file: by day, then by prefix text (categorical codes are not in text order).
+    sort_by = ['snapshot_date'] + (['prefix'] if 'prefix' in df.columns else [])
+    df = df.sort_values(sort_by, kind='stable', key=lambda col: col.astype(str) if isinstance(col.dtype, pd.CategoricalDtype) else col)
+    df = df[columns].reset_index(drop=True)
+    # Categories in order of first appearance, as for a snapshot file, so value_counts() ties break the same way.
+    for name in df.select_dtypes('category').columns:
+        categories = df[name].cat.categories
+        seen = pd.unique(df[name].cat.codes[df[name].cat.codes >= 0])
+        df[name] = df[name].cat.reorder_categories(list(categories[seen]) + list(categories.delete(seen)))
+    return df
+
+
+def read_snapshot_at(path, snapshot_date, columns=None):
+    # The exact ROA set of one snapshot day; empty if that day is not part of the file.
+    return read_interval_roas(path, columns=columns, filters=[('snapshot_date', '=', snapshot_date)])
+
+
+def presence_intervals(intervals, by=['asn']):
+    # Merges stored intervals into continuous (by..., start, end) runs, e.g. per ASN across max_len/uri/validity
+    # changes: runs that overlap or touch on consecutive days are joined, as compute_intervals() in the
+    # visualizer and validate-bgp.py do from per-day rows.
+    df = intervals[by + ['first_seen', 'last_seen']].sort_values(by + ['first_seen'], kind='stable')
+    reach = df.groupby(by, observed=True, sort=False)['last_seen'].cummax()
+    prev_reach = reach.groupby([df[name] for name in by], observed=True, sort=False).shift()
+    starts_run = prev_reach.isna() | ((df['first_seen'] - prev_reach) > pd.Timedelta(days=1))
+    runs = df.assign(run=starts_run.cumsum()).groupby('run', sort=False)
+    merged = runs[by].first()
+    merged['start'] = runs['first_seen'].min()
+    merged['end'] = runs['last_seen'].max()
+    return merged.reset_index(drop=True)
@@ -0,0 +1,92 @@
+# Continuous presence intervals ("islands"): the runs of consecutive calendar days on which a key was present.
+# find_islands() finds them for every key at once with a sort and a vectorized gap test; load_islands() does so for a
+# whole history file and caches the result next to it, keyed by the file's size and modification time, so every
+# plot and every prefix reuses one computation. Used by roa-visualizer.py, scatter_all_prefix.py and validate-bgp.py.
+
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from roa_dataset import read_roas
+from roa_intervals import is_interval_file, read_intervals, presence_intervals
+from roa_prefix_index import source_signature
+
+ISLAND_KEYS = ['prefix', 'asn', 'max_len']
+ISLANDS_SUFFIX = '.islands.parquet'
+DATASET_ISLANDS_FILENAME = '_islands.parquet'
+SOURCE_METADATA_KEY = 'roa.islands.source'
+
+
+def islands_path(path):
+    if os.path.isdir(path):
+        return os.path.join(path, DATASET_ISLANDS_FILENAME)
+    return path + ISLANDS_SUFFIX
+
+
+def find_islands(rows, by=ISLAND_KEYS):
+    # (by..., start, end) per island, from per-day rows (snapshot_date) or from stored intervals (first_seen and
+    # last_seen, merged where they overlap or touch). A day more than one calendar day after the previous day of
+    # the same key starts a new island.
+    if 'first_seen' in rows.columns:
+        return presence_intervals(rows, by)
+    df = rows[by + ['snapshot_date']].drop_duplicates()
+    df = df.assign(snapshot_date=pd.to_datetime(df['snapshot_date']).dt.normalize()).sort_values(by + ['snapshot_date'], kind='stable')
+    keys = df.groupby(by, observed=True, sort=False, dropna=False).ngroup().to_numpy()
+    days = df['snapshot_date'].to_numpy()
+    starts = np.ones(len(df), dtype=bool)
+    starts[1:] = (keys[1:] != keys[:-1]) | (days[1:] - days[:-1] > np.timedelta64(1, 'D'))
+    first = np.flatnonzero(starts)
+    last = np.append(first[1:], len(df)) - 1
+    result = df.iloc[first][by].reset_index(drop=True)
+    result['start'] = days[first]
+    result['end'] = days[last]
+    return result
+
+
+def merge_islands(islands, by=['asn']):
+    # Coarser islands, e.g. per ASN over all of its max_len values: islands of the same key that overlap or touch
+    # are joined.
+    return presence_intervals(islands.rename(columns={'start': 'first_seen', 'end': 'last_seen'}), by)
+
+
+def island_days(islands):
+    # Number of days in each island.
+    return (islands['end'] - islands['start']).dt.days + 1
+
+
+def load_islands(path):
+    # Islands per (prefix, asn, max_len) of a history file, dataset directory or interval file; computed from the key
+    # columns only and cached in <file>.islands.parquet (or _islands.parquet in a dataset directory).
+    cache_path = islands_path(path)
+    signature = source_signature(path)
+    if os.path.exists(cache_path):
+        table = pq.read_table(cache_path)
+        if (table.schema.metadata or {}).get(SOURCE_METADATA_KEY.encode(), b'').decode() == signature:
+            return table.to_pandas()
+    if not os.path.isdir(path) and is_interval_file(path):
+        rows = read_intervals(path, columns=ISLAND_KEYS + ['first_seen', 'last_seen'])
+    else:
+        rows = read_roas(path, columns=ISLAND_KEYS + ['snapshot_date'])
+    result = find_islands(rows)
+    result['asn'] = result['asn'].astype(str)
+    result['prefix'] = result['prefix'].astype(str)
+    result = result.sort_values(['prefix', 'asn', 'max_len', 'start'], ignore_index=True)
+    table = pa.Table.from_pandas(result, preserve_index=False)
+    pq.write_table(table.replace_schema_metadata({**(table.schema.metadata or {}), SOURCE_METADATA_KEY: signature}), cache_path)
+    return result
+
+
+def prefix_islands(islands, prefix, by=['asn']):
+    # Islands of one prefix of a load_islands() table (sorted by prefix), merged per by, in (by..., start) order.
+    first, last = islands['prefix'].searchsorted(prefix, side='left'), islands['prefix'].searchsorted(prefix, side='right')
+    selected = islands.iloc[first:last]
+    return merge_islands(selected, by).sort_values(by + ['start'], ignore_index=True)
+
+
+def select_islands(islands, prefixes):
+    # The rows of the given prefixes of a load_islands() table, still sorted by prefix (so prefix_islands() works on
+    # the result), e.g. to send to a worker process.
+    prefixes = sorted(set(prefixes))
+    first, last = islands['prefix'].searchsorted(prefixes, side='left'), islands['prefix'].searchsorted(prefixes, side='right')
+    return pd.concat([islands.iloc[a:b] for a, b in zip(first, last)] or [islands.iloc[:0]])
@@ -0,0 +1,202 @@
+# Prefix point lookups: a prefix-clustered copy of a ROA file (or dataset directory) plus a sidecar table mapping
+# every prefix to its row range in that copy, so one prefix's whole history is a read of one or two small row
+# groups instead of a scan. Built by roa-prefix-index.py; PrefixLookup reads through the index when there is
+# one and falls back to a prefix filter pushed into the Parquet scan when there is not.
+
+import os
+import json
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+from roa_dataset import (PARTITIONING, CHUNK_ROWS, COMPACT_COMPRESSION, DATES_METADATA_KEY, read_roas, decode_asns,
+                         list_snapshot_dates)
+from roa_intervals import is_interval_file, read_intervals, expand_intervals, to_day
+
+# Sidecar names: next to a file, or inside a dataset directory (leading underscores keep them out of the dataset).
+CLUSTERED_SUFFIX = '.by-prefix.parquet'
+INDEX_SUFFIX = '.prefix-index.parquet'
+DATASET_CLUSTERED_FILENAME = '_by_prefix.parquet'
+DATASET_INDEX_FILENAME = '_prefix_index.parquet'
+SOURCE_METADATA_KEY = 'roa.prefix_index.source'
+# Small row groups keep a lookup's read small; each bucket of the build is sorted in memory on its own.
+INDEX_ROW_GROUP_ROWS = 8192
+BUCKET_ROWS = 5000000
+
+
+def index_paths(path):
+    # (clustered copy, index) paths of a file or dataset directory.
+    if os.path.isdir(path):
+        return os.path.join(path, DATASET_CLUSTERED_FILENAME), os.path.join(path, DATASET_INDEX_FILENAME)
+    return path + CLUSTERED_SUFFIX, path + INDEX_SUFFIX
+
+
+def source_signature(path):
+    # Sizes and modification times of the source file(s); an index built from other contents is not used.
+    if os.path.isdir(path):
+        files = []
+        for root, dirs, names in os.walk(path):
+            dirs[:] = [name for name in dirs if not name.startswith('_')]
+            for name in names:
+                if name.endswith('.parquet') and not name.startswith('_'):
+                    stat = os.stat(os.path.join(root, name))
+                    files.append([os.path.relpath(os.path.join(root, name), path), stat.st_size, stat.st_mtime_ns])
+        return json.dumps(sorted(files))
+    stat = os.stat(path)
+    return json.dumps([stat.st_size, stat.st_mtime_ns])
+
+
+def build_prefix_index(path, bucket_rows=BUCKET_ROWS):
+    # Two passes with bounded memory: rows are first spread over hash buckets of about bucket_rows rows by prefix,
+    # then each bucket is sorted by prefix (and day, or first_seen for interval files) and appended to the
+    # clustered copy. Returns the number of prefixes indexed.
+    clustered_path, index_path = index_paths(path)
+    intervals = not os.path.isdir(path) and is_interval_file(path)
+    # Files and directories starting with '_' (the index itself, the ingest manifest) are not part of a dataset.
+    dataset = ds.dataset(path, format='parquet', partitioning=PARTITIONING if os.path.isdir(path) else None)
+    signature = source_signature(path)
+    schema = dataset.schema
+    plain_schema = pa.schema([field.with_type(field.type.value_type) if pa.types.is_dictionary(field.type) else field for field in schema])
+    buckets = max(1, -(-dataset.count_rows() // bucket_rows))
+    sort_keys = [('prefix', 'ascending'), ('first_seen' if intervals else 'snapshot_date', 'ascending')]
+
+    temp_dir = tempfile.mkdtemp(prefix='_prefix_index_', dir=os.path.dirname(os.path.abspath(clustered_path)))
+    try:
+        bucket_writers = [pq.ParquetWriter(os.path.join(temp_dir, f"bucket-{b}.parquet"), plain_schema) for b in range(buckets)]
+        first_rows = {}
+        offset = 0
+        for batch in dataset.to_batches(batch_size=CHUNK_ROWS):
+            table = pa.Table.from_batches([batch]).cast(plain_schema)
+            prefixes = pd.Series(table['prefix'].to_numpy(zero_copy_only=False))
+            first = prefixes.drop_duplicates()
+            for prefix, row in zip(first.to_numpy(), first.index.to_numpy() + offset):
+                first_rows.setdefault(prefix, row)
+            offset += len(table)
+            bucket = pd.util.hash_pandas_object(prefixes, index=False).to_numpy() % buckets
+            # One stable sort by bucket per batch, then each bucket's rows are a contiguous slice.
+            order = np.argsort(bucket, kind='stable')
+            table = table.take(order)
+            bounds = np.searchsorted(bucket[order], np.arange(buckets + 1))
+            for b in np.flatnonzero(np.diff(bounds)):
+                bucket_writers[b].write_table(table.slice(bounds[b], bounds[b + 1] - bounds[b]))
+        for writer in bucket_writers:
+            writer.close()
+
+        metadata = {SOURCE_METADATA_KEY: signature}
+        if not os.path.isdir(path):
+            metadata.update({key.decode(): value.decode() for key, value in (pq.read_metadata(path).metadata or {}).items()
+                             if not key.startswith(b'ARROW')})
+        else:
+            metadata[DATES_METADATA_KEY] = json.dumps([d.isoformat() for d in list_snapshot_dates(path)])
+        writer = pq.ParquetWriter(clustered_path + '.tmp', schema, compression=COMPACT_COMPRESSION)
+        ranges = []
+        written = 0
+        for b in range(buckets):
+            table = pq.read_table(os.path.join(temp_dir, f"bucket-{b}.parquet")).sort_by(sort_keys)
+            prefixes = table['prefix'].to_numpy(zero_copy_only=False)
+            if len(prefixes):
+                starts = np.concatenate([[0], np.flatnonzero(prefixes[1:] != prefixes[:-1]) + 1])
+                ranges.append(pd.DataFrame({'prefix': prefixes[starts], 'first_row': starts + written,
+                                            'rows': np.diff(np.append(starts, len(prefixes)))}))
+            # Encoded per row group, so each row group's dictionaries only hold its own values.
+            for start in range(0, len(table), INDEX_ROW_GROUP_ROWS):
+                writer.write_table(table.slice(start, INDEX_ROW_GROUP_ROWS).cast(schema))
+            written += len(table)
+        writer.add_key_value_metadata(metadata)
+        writer.close()
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    index = pd.concat(ranges, ignore_index=True) if ranges else pd.DataFrame({'prefix': [], 'first_row': [], 'rows': []})
+    index['order'] = index['prefix'].map(first_rows)
+    index = index.sort_values('prefix', ignore_index=True)
+    table = pa.table({'prefix': pa.array(index['prefix'], pa.string()),
+                      'first_row': pa.array(index['first_row'], pa.int64()),
+                      'rows': pa.array(index['rows'], pa.int64()),
+                      'order': pa.array(index['order'], pa.int64())})
+    pq.write_table(table.replace_schema_metadata({SOURCE_METADATA_KEY: metadata[SOURCE_METADATA_KEY]}), index_path)
+    os.replace(clustered_path + '.tmp', clustered_path)
+    return len(index)
+
+
+class PrefixLookup:
+    # Per-prefix reads of a ROA file, dataset directory or interval file. stored() returns the rows as stored
+    # (per-day rows, or intervals for an interval file); roas() always returns per-day rows, as read_roas() would.
+
+    def __init__(self, path):
+        self.path = path
+        self.intervals = not os.path.isdir(path) and is_interval_file(path)
+        self.indexed = False
+        self.days = None
+        clustered_path, index_path = index_paths(path)
+        if os.path.exists(clustered_path) and os.path.exists(index_path):
+            index = pq.read_table(index_path)
+            if (index.schema.metadata or {}).get(SOURCE_METADATA_KEY.encode(), b'').decode() == source_signature(path):
+                self.prefix_keys = index['prefix'].to_numpy(zero_copy_only=False)
+                self.first_rows = index['first_row'].to_numpy()
+                self.row_counts = index['rows'].to_numpy()
+                self.order = index['order'].to_numpy()
+                self.clustered = pq.ParquetFile(clustered_path, memory_map=True)
+                metadata = self.clustered.metadata
+                self.row_group_starts = np.cumsum([0] + [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)])
+                self.indexed = True
+            else:
+                print(f"!WARNING: The prefix index of '{path}' is out of date; rebuild it with roa-prefix-index.py. Reading without it.")
+
+    def prefixes(self):
+        # Every prefix, in order of first appearance in the source.
+        if self.indexed:
+            return list(self.prefix_keys[np.argsort(self.order, kind='stable')])
+        return list(pd.unique(read_roas(self.path, columns=['prefix'])['prefix'].to_numpy()) if not self.intervals
+                    else pd.unique(read_intervals(self.path, columns=['prefix'])['prefix'].to_numpy()))
+
+    def stored(self, prefix, columns=None):
+        if not self.indexed:
+            if self.intervals:
+                return read_intervals(self.path, columns=columns, filters=[('prefix', '=', prefix)])
+            return read_roas(self.path, columns=columns, filters=[('prefix', '=', prefix)])
+        i = np.searchsorted(self.prefix_keys, prefix)
+        if i == len(self.prefix_keys) or self.prefix_keys[i] != prefix:
+            first_row, rows = 0, 0
+        else:
+            first_row, rows = self.first_rows[i], self.row_counts[i]
+        first_group = max(np.searchsorted(self.row_group_starts, first_row, side='right') - 1, 0)
+        last_group = max(np.searchsorted(self.row_group_starts, first_row + rows, side='left'), first_group + 1)
+        table = self.clustered.read_row_groups(list(range(first_group, min(last_group, self.clustered.num_row_groups))), columns=columns)
+        table = table.slice(first_row - self.row_group_starts[first_group], rows)
+        # A row group's dictionaries hold the values of thousands of prefixes; keep only this prefix's.
+        table = pa.table({name: pc.dictionary_encode(column.cast(column.type.value_type)) if pa.types.is_dictionary(column.type) else column
+                          for name, column in zip(table.column_names, table.columns)})
+        df = table.to_pandas(date_as_object=False)
+        if 'asn' in df.columns and pd.api.types.is_numeric_dtype(df['asn']):
+            df['asn'] = decode_asns(df['asn'])
+        return df
+
+    def roas(self, prefix, columns=None):
+        if not self.intervals:
+            return self.stored(prefix, columns)
+        if not self.indexed:
+            return read_roas(self.path, columns=columns, filters=[('prefix', '=', prefix)])
+        if columns is None:
+            columns = [name for name in self.clustered.schema_arrow.names if name not in ('copies', 'first_seen', 'last_seen')] + ['snapshot_date']
+        stored = [name for name in columns if name != 'snapshot_date']
+        intervals = self.stored(prefix, stored + ['copies', 'first_seen', 'last_seen'])
+        if self.days is None:
+            self.days = to_day(list_snapshot_dates(self.path))
+        return expand_intervals(intervals, self.days, columns)
+
+
+def prefix_rows(source, prefix, columns=None, stored=False):
+    # Rows of one prefix from a PrefixLookup (read from disk), from a dict of per-prefix frames (e.g. the slice sent
+    # to a worker process) or from an already loaded frame (masked).
+    if isinstance(source, PrefixLookup):
+        return source.stored(prefix, columns) if stored else source.roas(prefix, columns)
+    if isinstance(source, dict):
+        rows = source[prefix]
+        return rows if columns is None else rows[columns]
+    rows = source[source['prefix'] == prefix]
+    return rows if columns is None else rows[columns]
@@ -0,0 +1,120 @@
+# Covering / more-specific / max_len-authorized prefix queries over the distinct (prefix, max_len) pairs of a ROA
+# file. Networks are 128-bit integers (IPv4 left-aligned, as in parse_prefix()) split into two uint64 halves, and
+# the set is kept as one hash table per prefix length: a bulk query is then one vectorized join per length instead
+# of a walk down a trie per query prefix. Used by roa-collection-prefix-match.py --match.
+
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.acero as ac
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from roa_dataset import PARTITIONING, parse_prefix
+from roa_prefix_index import source_signature
+
+PREFIX_SET_SUFFIX = '.prefix-set.parquet'
+DATASET_PREFIX_SET_FILENAME = '_prefix_set.parquet'
+SOURCE_METADATA_KEY = 'roa.prefix_set.source'
+MATCH_MODES = ['exact', 'covering', 'more_specific', 'authorized']
+KEY_COLUMNS = ['af', 'hi', 'lo']
+# MASKS[k]: the top k bits of a 64-bit half set.
+MASKS = np.array([((1 << 64) - 1) ^ ((1 << (64 - k)) - 1) for k in range(65)], dtype=np.uint64)
+
+
+def prefix_set_path(path):
+    if os.path.isdir(path):
+        return os.path.join(path, DATASET_PREFIX_SET_FILENAME)
+    return path + PREFIX_SET_SUFFIX
+
+
+def parse_prefixes(prefixes):
+    # Frame of the distinct prefix texts with af, hi/lo network halves and length; each text is parsed once.
+    texts = pd.unique(np.asarray(prefixes, dtype=object))
+    parsed = [parse_prefix(text) for text in texts]
+    networks = np.frombuffer(b''.join(network for _, network, _ in parsed), dtype='>u8').reshape(-1, 2).astype(np.uint64)
+    return pd.DataFrame({
+        'prefix': texts,
+        'af': np.array([af for af, _, _ in parsed], dtype=np.uint8),
+        'hi': networks[:, 0],
+        'lo': networks[:, 1],
+        'length': np.array([length for _, _, length in parsed], dtype=np.int64),
+    })
+
+
+def truncate(keys, length):
+    # keys with their networks cut down to the first length bits.
+    return keys.assign(hi=keys['hi'].to_numpy() & MASKS[min(length, 64)],
+                       lo=keys['lo'].to_numpy() & MASKS[max(length - 64, 0)])
+
+
+class PrefixSet:
+    # Distinct (prefix, max_len) pairs of a ROA file with parsed networks, grouped by prefix length.
+
+    def __init__(self, pairs):
+        keys = parse_prefixes(pairs['prefix'])
+        entries = pairs[['prefix', 'max_len']].merge(keys, on='prefix')
+        self.by_length = {length: group.drop(columns='length') for length, group in entries.groupby('length')}
+
+    @classmethod
+    def from_roas(cls, path):
+        # Built with one streaming group-by over the prefix and max_len columns, and cached next to the input
+        # (inside a dataset directory) until the input changes.
+        cache_path = prefix_set_path(path)
+        signature = source_signature(path)
+        if os.path.exists(cache_path):
+            table = pq.read_table(cache_path)
+            if (table.schema.metadata or {}).get(SOURCE_METADATA_KEY.encode(), b'').decode() == signature:
+                return cls(table.to_pandas())
+        dataset = ds.dataset(path, format='parquet', partitioning=PARTITIONING if os.path.isdir(path) else None)
+        table = ac.Declaration.from_sequence([
+            ac.Declaration('scan', ac.ScanNodeOptions(dataset, columns=['prefix', 'max_len'])),
+            ac.Declaration('project', ac.ProjectNodeOptions([pc.field('prefix').cast(pa.string()), pc.field('max_len').cast(pa.int64())],
+                                                            ['prefix', 'max_len'])),
+            ac.Declaration('aggregate', ac.AggregateNodeOptions([], keys=['prefix', 'max_len'])),
+        ]).to_table()
+        table = table.sort_by([('prefix', 'ascending'), ('max_len', 'ascending')])
+        pq.write_table(table.replace_schema_metadata({SOURCE_METADATA_KEY: signature}), cache_path)
+        return cls(table.to_pandas())
+
+    def covering(self, queries):
+        # (query, prefix, max_len) for every pair whose prefix covers a query prefix (the query itself included).
+        queries = parse_prefixes(queries).rename(columns={'prefix': 'query'})
+        matches = []
+        for length, entries in self.by_length.items():
+            candidates = queries[queries['length'] >= length]
+            if len(candidates):
+                found = truncate(candidates, length).merge(entries, on=KEY_COLUMNS)
+                matches.append(found[['query', 'prefix', 'max_len', 'length']])
+        return self.result(matches)
+
+    def more_specific(self, queries):
+        # (query, prefix, max_len) for every pair whose prefix lies inside a query prefix (the query itself included).
+        queries = parse_prefixes(queries).rename(columns={'prefix': 'query'})
+        matches = []
+        for length, candidates in queries.groupby('length'):
+            entries = pd.concat([entries for entry_length, entries in self.by_length.items() if entry_length >= length] or [pd.DataFrame(columns=['prefix', 'max_len'] + KEY_COLUMNS)])
+            if len(entries):
+                found = truncate(entries, length).merge(candidates, on=KEY_COLUMNS)
+                matches.append(found[['query', 'prefix', 'max_len', 'length']])
+        return self.result(matches)
+
+    def authorized(self, queries):
+        # Covering pairs whose max_len reaches the query's length, i.e. the ROAs that authorize the query prefix.
+        matches = self.covering(queries)
+        return matches[matches['max_len'] >= matches['query_length']].reset_index(drop=True)
+
+    def match(self, queries, mode):
+        if mode == 'exact':
+            matches = self.covering(queries)
+            return matches[matches['prefix'] == matches['query']].reset_index(drop=True)
+        return getattr(self, mode)(queries)
+
+    @staticmethod
+    def result(matches):
+        matches = [found for found in matches if len(found)]
+        if not matches:
+            return pd.DataFrame({'query': pd.Series(dtype=object), 'prefix': pd.Series(dtype=object),
+                                 'max_len': pd.Series(dtype=np.int64), 'query_length': pd.Series(dtype=np.int64)})
+        return pd.concat(matches, ignore_index=True).rename(columns={'length': 'query_length'})
@@ -0,0 +1,167 @@
+# Prefix x day presence index: stable integer IDs for prefixes and (prefix, asn) pairs, and one bit per ID and
+# snapshot day saved as memory-mapped .npy bitsets. Built by roa-presence-index.py; PresenceIndex answers
+# per-day event counts, lifetimes and flap counts with bit operations instead of re-scanning the Parquet input.
+
+import os
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from roa_dataset import CHUNK_ROWS, list_snapshot_dates, iter_snapshots
+
+META_FILENAME = 'presence.json'
+PREFIXES_FILENAME = 'prefixes.parquet'
+PAIRS_FILENAME = 'pairs.parquet'
+# Bitsets, one row per ID and one bit per snapshot day (day d is bit d % 8 of byte d // 8, little bit order).
+BITSETS = {
+    'present': 'present.npy',    # prefix has at least one ROA
+    'target': 'target.npy',      # prefix has a ROA authorizing the target ASN
+    'pairs': 'pairs.npy',        # (prefix, asn) pair has a ROA
+}
+POPCOUNT = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+
+
+def asn_number(label):
+    return int(str(label)[2:])
+
+
+class BitRows:
+    # Packed bit matrix of days columns whose rows grow as new IDs appear.
+
+    def __init__(self, days):
+        self.bits = np.zeros((1024, (days + 7) // 8), dtype=np.uint8)
+
+    def set(self, ids, day):
+        if len(ids) and ids.max() >= len(self.bits):
+            grown = np.zeros((max(2 * len(self.bits), ids.max() + 1), self.bits.shape[1]), dtype=np.uint8)
+            grown[:len(self.bits)] = self.bits
+            self.bits = grown
+        self.bits[ids, day >> 3] |= np.uint8(1 << (day & 7))
+
+    def save(self, path, rows):
+        np.save(path, self.bits[:rows])
+
+
+class IdMap:
+    # Stable IDs in order of first appearance; keys already seen keep their ID when new ones are added.
+
+    def __init__(self, dtype=object):
+        self.keys = pd.Index([], dtype=dtype)
+
+    def ids(self, keys):
+        # ID of every key, adding the ones not seen before.
+        found = self.keys.get_indexer(keys)
+        if (found < 0).any():
+            self.keys = self.keys.append(pd.Index(pd.unique(keys[found < 0])))
+            found = self.keys.get_indexer(keys)
+        return found
+
+
+def build_presence_index(input_file, output_dir, target_asn='AS834'):
+    # One pass over the snapshots (prefix and asn columns only). Returns the number of snapshot days indexed.
+    dates = list_snapshot_dates(input_file)
+    prefix_ids = IdMap()
+    pair_ids = IdMap(np.int64)
+    bitsets = {name: BitRows(len(dates)) for name in BITSETS}
+
+    for day, (snapshot_date, pending) in enumerate(iter_snapshots(input_file, columns=['prefix', 'asn'], dates=dates)):
+        day_roas = pending.result()
+        print(f" ** Indexing {snapshot_date}")
+        prefixes = day_roas['prefix'].to_numpy()
+        asns = day_roas['asn'].astype(object)
+        row_ids = prefix_ids.ids(prefixes)
+
+        bitsets['present'].set(np.unique(row_ids), day)
+        bitsets['target'].set(np.unique(row_ids[(asns == target_asn).to_numpy()]), day)
+        numbers = asns.map({label: asn_number(label) for label in asns.unique()}).to_numpy(np.int64)
+        bitsets['pairs'].set(pair_ids.ids((row_ids.astype(np.int64) << 32) | numbers), day)
+
+    os.makedirs(output_dir, exist_ok=True)
+    for name, filename in BITSETS.items():
+        bitsets[name].save(os.path.join(output_dir, filename), len(pair_ids.keys) if name == 'pairs' else len(prefix_ids.keys))
+    pq.write_table(pa.table({'prefix': pa.array(prefix_ids.keys.to_numpy(), pa.string())}), os.path.join(output_dir, PREFIXES_FILENAME))
+    pair_keys = pair_ids.keys.to_numpy(np.int64)
+    pq.write_table(pa.table({'prefix_id': pa.array(pair_keys >> 32, pa.int32()),
+                             'asn': pa.array(pair_keys & 0xFFFFFFFF, pa.uint32())}),
+                   os.path.join(output_dir, PAIRS_FILENAME))
+    with open(os.path.join(output_dir, META_FILENAME), 'w') as f:
+        json.dump({'dates': [d.isoformat() for d in dates], 'target_asn': target_asn, 'source': os.path.abspath(input_file)}, f, indent=1)
+    return len(dates)
+
+
+class PresenceIndex:
+    # Read side of a presence index directory. The bitsets are memory-mapped, so opening is near-instant and
+    # queries only touch the rows (and pages) they need.
+
+    def __init__(self, index_dir):
+        with open(os.path.join(index_dir, META_FILENAME)) as f:
+            meta = json.load(f)
+        self.dates = [pd.Timestamp(d).date() for d in meta['dates']]
+        self.target_asn = meta['target_asn']
+        self.bits = {name: np.load(os.path.join(index_dir, filename), mmap_mode='r') for name, filename in BITSETS.items()}
+        self.prefixes = pd.Index(pq.read_table(os.path.join(index_dir, PREFIXES_FILENAME))['prefix'].to_numpy(zero_copy_only=False))
+        pairs = pq.read_table(os.path.join(index_dir, PAIRS_FILENAME)).to_pandas()
+        self.pairs = pd.DataFrame({'prefix': self.prefixes[pairs['prefix_id']], 'asn': 'AS' + pairs['asn'].astype(str)})
+
+    def labels(self, name):
+        return pd.MultiIndex.from_frame(self.pairs) if name == 'pairs' else self.prefixes
+
+    def days(self, name, rows=slice(None)):
+        # Unpacked boolean presence (rows x days) of the given rows of a bitset.
+        return np.unpackbits(self.bits[name][rows], axis=1, count=len(self.dates), bitorder='little').astype(bool)
+
+    def day(self, name, day):
+        # Boolean column of one snapshot day (by position) over all rows of a bitset.
+        return (self.bits[name][:, day >> 3] >> (day & 7)) & 1 == 1
+
+    def history(self, key, name='present'):
+        # Presence of one prefix (for 'pairs', one (prefix, asn) pair) on every snapshot day, as a date-indexed
+        # boolean Series. Pair rows have their own IDs, so a prefix alone does not name a row of 'pairs'.
+        if name == 'pairs':
+            if not isinstance(key, tuple):
+                raise ValueError(f"history(..., 'pairs') takes a (prefix, asn) pair, got {key!r}")
+            prefix, asn = key
+            rows = np.flatnonzero(((self.pairs['prefix'] == prefix) & (self.pairs['asn'] == asn)).to_numpy())
+            if not len(rows):
+                raise KeyError(key)
+            row = rows[0]
+        else:
+            row = self.prefixes.get_loc(key)
+        return pd.Series(self.days(name, [row])[0], index=self.dates)
+
+    def lifetimes(self, name='present'):
+        # Number of snapshot days each prefix (or pair) was present; for 'target', days authorized to the target ASN.
+        counts = np.zeros(len(self.bits[name]), dtype=np.int64)
+        for start in range(0, len(counts), CHUNK_ROWS):
+            counts[start:start + CHUNK_ROWS] = POPCOUNT[self.bits[name][start:start + CHUNK_ROWS]].sum(axis=1)
+        return pd.Series(counts, index=self.labels(name))
+
+    def flap_counts(self, name='present'):
+        # Times each prefix (or pair) came back after being absent on a snapshot day: its runs of presence minus one.
+        counts = np.zeros(len(self.bits[name]), dtype=np.int64)
+        for start in range(0, len(counts), CHUNK_ROWS):
+            days = self.days(name, slice(start, start + CHUNK_ROWS))
+            runs = days[:, 0].astype(np.int64) + (days[:, 1:] & ~days[:, :-1]).sum(axis=1)
+            counts[start:start + CHUNK_ROWS] = np.maximum(runs - 1, 0)
+        return pd.Series(counts, index=self.labels(name))
+
+    def flapping(self, k, name='present'):
+        # Prefixes (or pairs) that flapped more than k times.
+        counts = self.flap_counts(name)
+        return counts[counts > k]
+
+    def event_counts(self):
+        # Per-day creation/deletion/update counts around the target ASN, with the rules of roa-analyzer-834.py.
+        rows = []
+        for day in range(1, len(self.dates)):
+            had, has = self.day('target', day - 1), self.day('target', day)
+            before, now = self.day('present', day - 1), self.day('present', day)
+            rows.append({
+                'date': self.dates[day],
+                'creations': int((has & ~before).sum()),
+                'deletions': int((had & ~now).sum()),
+                f"updates_to_{self.target_asn}": int((has & ~had & before).sum()),
+                f"updates_from_{self.target_asn}": int((had & ~has & now).sum()),
+            })
+        return pd.DataFrame(rows)
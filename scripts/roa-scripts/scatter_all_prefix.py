@@ -1,49 +1,33 @@
 import argparse
 import pandas as pd
+import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 import seaborn as sns
 import os
-from matplotlib.backends.backend_pdf import PdfPages
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.backends.backend_pdf import PdfPages, FigureCanvasPdf
+from roa_dataset import read_roas
+from roa_islands import find_islands, load_islands, prefix_islands, select_islands
+from roa_prefix_index import PrefixLookup, prefix_rows
 
 START_DATE = pd.Timestamp("2024-09-01")
 END_DATE = pd.Timestamp("2025-09-23")
 
-def compute_intervals(df):
-
-    if df.empty:
-        return pd.DataFrame(columns=["asn", "start", "end"])
-
-    all_intervals = []
-    
-    for asn, group in df.groupby('asn'):
-        group = group.sort_values('snapshot_date')
-        
-        group['prev_date'] = group['snapshot_date'].shift(1)
-        group['gap'] = (group['snapshot_date'] - group['prev_date']).dt.days
-        
-        group['new_island'] = ((group['gap'] > 1) | (group['gap'].isna())).astype(int)
-        group['island_id'] = group['new_island'].cumsum()
-        
-        intervals = group.groupby(['island_id'])['snapshot_date'].agg(['min', 'max']).reset_index()
-        intervals['asn'] = asn
-        intervals.rename(columns={'min': 'start', 'max': 'end'}, inplace=True)
-        all_intervals.append(intervals)
-    
-    if all_intervals:
-        return pd.concat(all_intervals)[['asn', 'start', 'end']]
-    else:
-        return pd.DataFrame(columns=["asn", "start", "end"])
-
-def plot_prefix_timeline(df, prefix, ax):
-    subset = df[df['prefix'] == prefix].copy()
-    subset['snapshot_date'] = pd.to_datetime(subset['snapshot_date'])
+def plot_prefix_timeline(df, prefix, ax, islands=None):
+    # df: a loaded history frame, or a PrefixLookup that reads only this prefix's rows from disk.
+    # islands: the load_islands() table of the history file; without it the intervals come from the rows.
+    subset = prefix_rows(df, prefix).copy()
+    subset['snapshot_date'] = pd.to_datetime(subset['snapshot_date']).dt.normalize()
+    # Compact histories carry a categorical ASN covering every prefix; only this prefix's ASNs should be plotted.
+    subset['asn'] = subset['asn'].astype(str)
 
     asns = sorted(subset['asn'].unique())
     
     y_map = {asn: i for i, asn in enumerate(asns)}
     
-    intervals = compute_intervals(subset)
+    intervals = prefix_islands(islands, prefix) if islands is not None else find_islands(subset, by=['asn'])
 
     # Colors
     palette = sns.color_palette("tab10", len(asns)) 
@@ -88,56 +72,106 @@ def plot_prefix_timeline(df, prefix, ax):
     plt.setp(ax.get_xticklabels(), rotation=45, ha='right')
 
 
-def generate_timeline_pdf(df, output_pdf, per_page=3):
-    prefixes = df['prefix'].unique()
+def timeline_page(df, batch, per_page, islands=None):
+    n_plots = len(batch)
+    
+    fig, axes = plt.subplots(
+        per_page, 1, 
+        figsize=(14, 4 * per_page),
+        constrained_layout=True
+    )
+
+    if per_page == 1:
+        axes = [axes]
+    
+    if n_plots < per_page:
+        for j in range(n_plots, per_page):
+            axes[j].axis('off')
+
+    for j, prefix in enumerate(batch):
+        print(f"Generating timeline for {prefix}...")
+        plot_prefix_timeline(df, prefix, axes[j], islands)
+
+    fig.suptitle(f"ROA Timelines ({START_DATE.date()} to {END_DATE.date()})", fontsize=16, y=1.02)
+    return fig
+
+def layout_timeline_page(rows, batch, per_page, islands=None):
+    # Runs in a worker process: builds one page from its prefixes' rows and lays it out the way
+    # PdfPages.savefig(bbox_inches='tight') would (with the PDF renderer's text metrics), so the main process only
+    # has to draw the returned figure into the PDF within the returned bounding box.
+    fig = timeline_page(rows, batch, per_page, islands)
+    FigureCanvasPdf(fig)
+    fig.draw_without_rendering()
+    bbox = fig.get_tightbbox().padded(plt.rcParams['savefig.pad_inches'])
+    fig.set_layout_engine('none')
+    return fig, bbox
+
+def generate_timeline_pdf(df, output_pdf, per_page=3, islands=None, workers=1):
+    prefixes = df.prefixes() if isinstance(df, PrefixLookup) else df['prefix'].unique()
     print(f"\nFound {len(prefixes)} unique prefixes.")
     os.makedirs(os.path.dirname(output_pdf), exist_ok=True)
+    batches = [prefixes[i:i+per_page] for i in range(0, len(prefixes), per_page)]
 
     with PdfPages(output_pdf) as pdf:
-        for i in range(0, len(prefixes), per_page):
-            batch = prefixes[i:i+per_page]
-            n_plots = len(batch)
-            
-            fig, axes = plt.subplots(
-                per_page, 1, 
-                figsize=(14, 4 * per_page),
-                constrained_layout=True
-            )
-
-            if per_page == 1:
-                axes = [axes]
-            
-            if n_plots < per_page:
-                for j in range(n_plots, per_page):
-                    axes[j].axis('off')
-
-            for j, prefix in enumerate(batch):
-                print(f"Generating timeline for {prefix}...")
-                plot_prefix_timeline(df, prefix, axes[j])
-
-            fig.suptitle(f"ROA Timelines ({START_DATE.date()} to {END_DATE.date()})", fontsize=16, y=1.02)
-            pdf.savefig(fig, bbox_inches='tight') 
-            plt.close(fig)
+        if workers > 1:
+            # Pages are built and laid out in worker processes (headless), each sent only the rows and islands of
+            # its own prefixes; the main process writes them into the one PDF in prefix order, so the file is the
+            # same as a serial run's. A few pages per worker are in flight at a time.
+            print(f" * Laying out {len(batches)} pages on {workers} worker processes.")
+            if isinstance(df, PrefixLookup):
+                page_rows = lambda batch: {prefix: df.roas(prefix) for prefix in batch}
+            else:
+                positions = df.groupby('prefix', observed=True, sort=False).indices
+                page_rows = lambda batch: {prefix: df.iloc[positions[prefix]] for prefix in batch}
+
+            def write_page(future):
+                fig, bbox = future.result()
+                pdf.savefig(fig, bbox_inches=bbox)
+                plt.close(fig)
+
+            pending = deque()
+            with ProcessPoolExecutor(max_workers=workers, initializer=matplotlib.use, initargs=('Agg',)) as executor:
+                for batch in batches:
+                    pending.append(executor.submit(layout_timeline_page, page_rows(batch), batch, per_page,
+                                                   select_islands(islands, batch) if islands is not None else None))
+                    if len(pending) > 2 * workers:
+                        write_page(pending.popleft())
+                while pending:
+                    write_page(pending.popleft())
+        else:
+            for batch in batches:
+                fig = timeline_page(df, batch, per_page, islands)
+                pdf.savefig(fig, bbox_inches='tight') 
+                plt.close(fig)
 
     print(f"\nPDF successfully generated at: {output_pdf}")
 
-def main(history_file, output_pdf):
+def main(history_file, output_pdf, workers=1):
     print("\nLoading data...")
     try:
-        df = pd.read_parquet(history_file)
-        df['snapshot_date'] = pd.to_datetime(df['snapshot_date']).dt.normalize()
-        print(f" * Loaded {len(df):,} ROA records.")
+        # With a prefix index (roa-prefix-index.py), each prefix's rows are read when its timeline is drawn.
+        df = PrefixLookup(history_file)
+        if df.indexed:
+            print(f" * Reading each prefix through the prefix index of {history_file}.")
+        else:
+            df = read_roas(history_file)
+            df['snapshot_date'] = pd.to_datetime(df['snapshot_date']).dt.normalize()
+            print(f" * Loaded {len(df):,} ROA records.")
+        # Islands of every (prefix, asn, max_len), computed once and cached next to the history file.
+        islands = load_islands(history_file)
     except Exception as e:
         print(f"!! ERROR: Could not read file '{history_file}'")
         print(e)
         return
 
-    generate_timeline_pdf(df, output_pdf, per_page=5)
+    generate_timeline_pdf(df, output_pdf, per_page=5, islands=islands, workers=workers)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--history_file', type=str, required=True)
     parser.add_argument('--output_pdf', type=str, required=True)
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of worker processes; with more than one, the pages are built and laid out in parallel.")
     args = parser.parse_args()
     
-    main(args.history_file, args.output_pdf)
\ No newline at end of file
+    main(args.history_file, args.output_pdf, args.workers)
\ No newline at end of file
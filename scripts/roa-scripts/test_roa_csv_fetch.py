@@ -0,0 +1,131 @@
+# Tests of roa-csv-fetch.py's downloads against a local HTTP stand-in for ftp.ripe.net/rpki (run with pytest from
+# this directory).
+
+import os
+import json
+import time
+import hashlib
+import threading
+import importlib.util
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+
+spec = importlib.util.spec_from_file_location('roa_csv_fetch', os.path.join(os.path.dirname(__file__), 'roa-csv-fetch.py'))
+fetch = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(fetch)
+
+
+class RpkiStandIn(BaseHTTPRequestHandler):
+    # Serves the files of server.files ({path: bytes}) with an ETag and Range/If-Range support. server.failures
+    # ({path: n}) answers the first n requests of a path with 503; every request is recorded in server.requests.
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, dict(self.headers)))
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            failing = server.failures.get(self.path, 0) > 0
+            if failing:
+                server.failures[self.path] -= 1
+        try:
+            time.sleep(server.delay)
+            body = server.files.get(self.path)
+            if failing:
+                self.send_error(503)
+                return
+            if body is None:
+                self.send_error(404)
+                return
+            etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+            start = 0
+            if self.headers.get('Range') and self.headers.get('If-Range') == etag:
+                start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+            self.send_response(206 if start else 200)
+            if start:
+                self.send_header('Content-Range', f"bytes {start}-{len(body) - 1}/{len(body)}")
+            self.send_header('Content-Length', str(len(body) - start))
+            self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(body[start:])
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), RpkiStandIn)
+    httpd.files, httpd.failures, httpd.requests = {}, {}, []
+    httpd.lock, httpd.delay, httpd.in_flight, httpd.max_in_flight = threading.Lock(), 0, 0, 0
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.root_url = f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.base_url = httpd.root_url + '/rpki/'
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def snapshot_path(repo, day):
+    return f"/rpki/{repo}/2025/01/{day:02d}/roas.csv.xz"
+
+
+def snapshot_body(repo, day):
+    return f"{repo} {day}\n".encode() * 500
+
+
+def test_server_errors_are_retried(server, tmp_path):
+    path = snapshot_path('ripencc.tal', 1)
+    server.files[path] = snapshot_body('ripencc.tal', 1)
+    server.failures[path] = 2
+    output = str(tmp_path / 'out.csv.xz')
+    entry, transferred = fetch.save_roas_csv(server.root_url + path, output, retries=3, backoff=0)
+    assert entry['complete'] and transferred == len(server.files[path])
+    assert open(output, 'rb').read() == server.files[path]
+    assert len(server.requests) == 3
+
+
+def test_client_errors_are_not_retried(server, tmp_path):
+    output = str(tmp_path / 'out.csv.xz')
+    entry, transferred = fetch.save_roas_csv(server.root_url + snapshot_path('ripencc.tal', 1), output, retries=3, backoff=0)
+    assert entry is None and transferred == 0
+    assert len(server.requests) == 1
+    assert not os.path.exists(output)
+
+
+def test_concurrent_downloads(server, tmp_path):
+    repos = ['apnic.tal', 'ripencc.tal']
+    for repo in repos:
+        for day in range(1, 32):
+            server.files[snapshot_path(repo, day)] = snapshot_body(repo, day)
+    server.delay = 0.02
+    fetch.main(repos, 2025, 1, None, str(tmp_path), workers=4, retries=0, backoff=0, base_url=server.base_url)
+    for repo in repos:
+        for day in range(1, 32):
+            with open(tmp_path / f"202501{day:02d}_{repo}_roas.csv.xz", 'rb') as f:
+                assert f.read() == snapshot_body(repo, day)
+    with open(tmp_path / fetch.MANIFEST_FILENAME) as f:
+        manifest = json.load(f)
+    assert len(manifest) == 62 and all(entry['complete'] for entry in manifest.values())
+    assert len(server.requests) == 62
+    assert server.max_in_flight > 1
+
+
+def test_partial_download_is_resumed(server, tmp_path):
+    path = snapshot_path('ripencc.tal', 1)
+    body = server.files[path] = snapshot_body('ripencc.tal', 1)
+    output = str(tmp_path / '20250101_ripencc.tal_roas.csv.xz')
+    # An earlier run got the first 1000 bytes and recorded the transfer's validators before it died.
+    with open(output + fetch.PART_SUFFIX, 'wb') as f:
+        f.write(body[:1000])
+    etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+    entry = {'url': server.root_url + path, 'complete': False, 'last_modified': None, 'etag': etag}
+    entry, transferred = fetch.save_roas_csv(server.root_url + path, output, entry=entry, retries=0, backoff=0)
+    assert entry['complete'] and transferred == len(body) - 1000
+    assert server.requests[0][1].get('Range') == 'bytes=1000-'
+    assert open(output, 'rb').read() == body
+    assert not os.path.exists(output + fetch.PART_SUFFIX)
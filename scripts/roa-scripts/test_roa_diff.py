@@ -0,0 +1,36 @@
+# Tests of the diff engine's pairing of removed and added ROAs (run with pytest from this directory).
+
+import datetime
+import pandas as pd
+from roa_diff import Snapshot, diff_snapshots
+
+
+def roas(rows):
+    return pd.DataFrame(rows, columns=['uri', 'asn', 'prefix', 'max_len', 'not_before', 'not_after'])
+
+
+def test_resigned_roas_keep_their_max_len():
+    # Prefixes with two ROAs of one ASN (max_len 22 and 24), both re-signed with new validity dates. Every pairing
+    # must be a ROA with its own re-signed version, whatever order the fingerprints hash into.
+    prev, curr = [], []
+    for k in range(120):
+        for max_len in ('22', '24'):
+            roa = [f"rsync://repo.example/roa-{k}.roa", 'AS65000', f"10.{k}.0.0/16", max_len]
+            prev.append(roa + ['2024-01-01 00:00:00', '2025-01-01 00:00:00'])
+            curr.append(roa + [f"2024-06-{k % 28 + 1:02d} 00:00:00", '2025-06-01 00:00:00'])
+    log = diff_snapshots(Snapshot(datetime.date(2024, 6, 1), roas(prev)), Snapshot(datetime.date(2024, 6, 2), roas(curr)))
+    assert len(log) == 240
+    assert (log['change'] == 'modified').all()
+    assert (log['old_max_len'] == log['new_max_len']).all()
+    assert all(changed == ['not_before', 'not_after'] for changed in log['changed'])
+
+
+def test_max_len_change_is_paired():
+    prev = roas([['rsync://repo.example/a.roa', 'AS65000', '10.0.0.0/16', '22', '2024-01-01 00:00:00', '2025-01-01 00:00:00'],
+                 ['rsync://repo.example/b.roa', 'AS65000', '10.0.0.0/16', '24', '2024-01-01 00:00:00', '2025-01-01 00:00:00']])
+    curr = roas([['rsync://repo.example/a.roa', 'AS65000', '10.0.0.0/16', '23', '2024-01-01 00:00:00', '2025-01-01 00:00:00'],
+                 ['rsync://repo.example/b.roa', 'AS65000', '10.0.0.0/16', '24', '2024-01-01 00:00:00', '2025-01-01 00:00:00']])
+    log = diff_snapshots(Snapshot(datetime.date(2024, 6, 1), prev), Snapshot(datetime.date(2024, 6, 2), curr))
+    assert list(log['change']) == ['modified']
+    assert (log['old_max_len'][0], log['new_max_len'][0]) == ('22', '23')
+    assert log['changed'][0] == ['max_len']
@@ -24,7 +24,7 @@ OUTPUT_FILENAME="all_roas_${TARGET_YEAR}"
 OUTPUT_PATH="${OUTPUT_DIR}/${OUTPUT_FILENAME}.parquet"
 
 # Output of 834
-EVENT_PATH="./output/event_details.csv"
+EVENT_PATH="./output/event_details.parquet"
 SUMMARY_PATH="./output/summary_details.csv"
 
 IPXO_PARQUET="./output/ipxo_roas_${TARGET_YEAR}.parquet"
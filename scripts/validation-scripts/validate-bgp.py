@@ -1,3 +1,5 @@
+import os
+import sys
 import requests
 import datetime
 import pandas as pd
@@ -5,6 +7,10 @@ import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 from matplotlib.lines import Line2D
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'roa-scripts'))
+from roa_islands import find_islands
+from roa_prefix_index import PrefixLookup, prefix_rows
+
 def fetch_bgp_history(prefix, starttime, endtime):
     url = "https://stat.ripe.net/data/routing-history/data.json"
     params = {
@@ -31,33 +37,16 @@ def parse_bgp_intervals(bgp_json):
     df = df.sort_values(["start", "asn"])
     return df
 
-def compute_intervals(example_df):
-    example_df = example_df.sort_values("snapshot_date")
-
-    intervals = []
-    for asn, group in example_df.groupby("asn"):
-        group = group.sort_values("snapshot_date")
-
-        start = group["snapshot_date"].iloc[0]
-        prev = start
-
-        for current in group["snapshot_date"].iloc[1:]:
-            if (current - prev).days > 1:
-                intervals.append((asn, start, prev))
-                start = current
-            prev = current
-
-        intervals.append((asn, start, prev))
-
-    return pd.DataFrame(intervals, columns=["asn", "start", "end"])
-
 def load_roa_intervals(df, prefix):
+    # df is either per-day ROA rows or the stored intervals of an interval-format history file, or a PrefixLookup
+    # of the history file, which reads only this prefix's rows.
     print("\n ** Computing ROA timeline intervals")
-    example_df = df[df["prefix"] == prefix].copy()
+    example_df = prefix_rows(df, prefix, stored=True).copy()
 
-    example_df["snapshot_date"] = pd.to_datetime(example_df["snapshot_date"]).dt.date
-
-    intervals = compute_intervals(example_df)
+    example_df["asn"] = example_df["asn"].astype(str)
+    intervals = find_islands(example_df, by=["asn"])
+    intervals["start"] = intervals["start"].dt.date
+    intervals["end"] = intervals["end"].dt.date
 
     print(f"\n--- Computed ROA Intervals for {prefix} ---")
     print(intervals.sort_values("start").to_string(index=False))
@@ -176,9 +165,8 @@ def main():
     print("\nLoading ROA Data")
     # history_file = "/Users/rakshita/Desktop/gatech/fall25/8903/code/output/all-roas-834-prefix.parquet"
     history_file = "/Users/rakshita/Desktop/gatech/fall25/8903/code/year-long/final/year-long-834-prefix-roas.parquet"
-    df = pd.read_parquet(history_file)
-
-    roa_df = load_roa_intervals(df, prefix)
+    # Reads only this prefix's rows: through the prefix index if roa-prefix-index.py built one, else a filtered scan.
+    roa_df = load_roa_intervals(PrefixLookup(history_file), prefix)
 
     print("\nComparing intervals...")
     bgp_valid, bgp_invalid, roa_unused = compare_intervals(bgp_df, roa_df)